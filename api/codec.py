@@ -0,0 +1,355 @@
+"""
+Packed binary encoding for ring frames and websocket messages. Lines, polylines and cleans are stored as
+fixed-width coordinates and ids as varints, anything else is carried as json inside the packed frame.
+
+Frame layout:
+    magic byte, version byte, flags byte
+    [tree: varint length, json list]             if FLAG_TREE
+    [trace: varint length, json list]            if FLAG_TRACE
+    [count: varint]                              if FLAG_BATCH
+    record * count (or one record)
+
+Record layout:
+    header byte: record kind in the low bits, wrapper bits above them
+    [id: varint]                                 if WRAP_PERSISTENT
+    [origin: varint length, utf-8]               if WRAP_PROPAGATE
+    [point count: varint]                        if polyline
+    coordinates, or varint length and json for RECORD_JSON
+"""
+import json
+import struct
+
+MAGIC = 0x56 # 'V'. Would be reserved block type as first byte of raw deflate, so the two are never mixed up.
+VERSION = 1
+CONTENT_TYPE = 'application/octet-stream'
+# Response code of peers that do not take packed frames
+REFUSED = 415
+# Header set on 400 response when packed body could not be decoded. Other 400 and 5xx responses are ordinary
+# failures, since the peer may have applied part of the frame.
+UNDECODABLE_HEADER = 'X-Ring-Undecodable'
+
+# Frame flags
+FLAG_BATCH = 1 # {'method':'batch', 'messages':[...]}
+FLAG_TREE = 2 # Frame has spanning tree descendants
+FLAG_TRACE = 4 # Frame has hop trace
+
+# Record kinds
+RECORD_JSON = 0 # Frame as json
+RECORD_LINE = 1 # float32 start x, start y, end x, end y
+RECORD_CLEAN = 2 # float32 x, y
+RECORD_LINE_WIDE = 3 # float64 coordinates, when float32 would lose precision
+RECORD_CLEAN_WIDE = 4
+RECORD_POLYLINE = 5 # float32 x, y pairs
+RECORD_POLYLINE_WIDE = 6
+RECORD_KIND_MASK = 7
+
+# Record wrappers
+WRAP_PROPAGATE = 8 # {'method':'propagate', 'message': message, 'origin': address}
+WRAP_PERSISTENT = 16 # {'method':'persistent', 'message': {'id': id, 'message': message}}
+
+HEADER = struct.Struct('<BBB')
+LINE = struct.Struct('<4f')
+CLEAN = struct.Struct('<2f')
+LINE_WIDE = struct.Struct('<4d')
+CLEAN_WIDE = struct.Struct('<2d')
+
+# Float64 record kinds
+WIDE = {
+    RECORD_LINE: RECORD_LINE_WIDE,
+    RECORD_CLEAN: RECORD_CLEAN_WIDE,
+    RECORD_POLYLINE: RECORD_POLYLINE_WIDE,
+}
+
+# Ints below this are exact in float32
+FLOAT32_EXACT = 1 << 24
+
+# Coordinate structs by record kind
+COORDINATES = {
+    RECORD_LINE: LINE,
+    RECORD_CLEAN: CLEAN,
+    RECORD_LINE_WIDE: LINE_WIDE,
+    RECORD_CLEAN_WIDE: CLEAN_WIDE,
+}
+
+
+def _number(value):
+    """
+    Give whole floats back as ints, so messages look the same as before packing.
+    """
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+def _is_coordinate(value):
+    return not isinstance(value, bool) and isinstance(value, (int, long, float))
+
+
+def _packer(kind, count):
+    """
+    Struct for coordinates of record kind.
+    :param kind: int record kind
+    :param count: int number of coordinates
+    :return: struct.Struct
+    """
+    if kind in COORDINATES:
+        return COORDINATES[kind]
+    return struct.Struct(('<%dd' if kind == RECORD_POLYLINE_WIDE else '<%df') % count)
+
+
+def _coordinates(message):
+    """
+    Get coordinates of plain line, polyline or clean message.
+    :param message: dict message
+    :return: tuple (record kind, coordinates), or (RECORD_JSON, None) if message cannot be packed without losing
+    anything
+    """
+    try:
+        if len(message) != 2:
+            return RECORD_JSON, None
+        method = message['method']
+        body = message['message']
+        if method == 'line':
+            if len(body) != 2 or len(body['start']) != 2 or len(body['end']) != 2:
+                return RECORD_JSON, None
+            values = (body['start']['x'], body['start']['y'], body['end']['x'], body['end']['y'])
+            kind = RECORD_LINE
+        elif method == 'clean':
+            if len(body) != 2:
+                return RECORD_JSON, None
+            values = (body['x'], body['y'])
+            kind = RECORD_CLEAN
+        elif method == 'polyline':
+            if len(body) != 1:
+                return RECORD_JSON, None
+            values = []
+            for point in body['points']:
+                if len(point) != 2:
+                    return RECORD_JSON, None
+                values.extend(point)
+            values = tuple(values)
+            kind = RECORD_POLYLINE
+        else:
+            return RECORD_JSON, None
+    except (KeyError, TypeError):
+        return RECORD_JSON, None
+    # Pixel coordinates are small ints, which float32 keeps exactly
+    if all(type(value) is int and -FLOAT32_EXACT < value < FLOAT32_EXACT for value in values):
+        return kind, values
+    for value in values:
+        if not _is_coordinate(value):
+            return RECORD_JSON, None
+    # Use float64 if float32 does not give the same numbers back
+    packer = _packer(kind, len(values))
+    if packer.unpack(packer.pack(*values)) != values:
+        kind = WIDE[kind]
+    return kind, values
+
+
+def _pack_varint(value, out):
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+
+def _unpack_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _pack_string(value, out):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    _pack_varint(len(value), out)
+    out.append(value)
+
+
+def _unpack_string(data, offset):
+    length, offset = _unpack_varint(data, offset)
+    if offset + length > len(data):
+        raise ValueError("Truncated string")
+    return data[offset:offset + length], offset + length
+
+
+def _pack_record(frame, out, compact_only):
+    """
+    Pack one frame as record.
+    :return: bool False if compact_only is set and the frame needs a json record
+    """
+    header = 0
+    message = frame
+    method = frame.get('method')
+    if method == 'propagate' and 'message' in frame and len(frame) <= 3 and \
+            (len(frame) == 2 or isinstance(frame.get('origin', ''), basestring)):
+        header = WRAP_PROPAGATE
+        message = frame['message']
+    elif method == 'persistent' and len(frame) == 2 and isinstance(frame.get('message'), dict) and \
+            len(frame['message']) == 2 and isinstance(frame['message'].get('id'), (int, long)) and \
+            'message' in frame['message'] and frame['message']['id'] >= 0:
+        header = WRAP_PERSISTENT
+        message = frame['message']['message']
+
+    kind, values = _coordinates(message) if isinstance(message, dict) else (RECORD_JSON, None)
+    if kind == RECORD_JSON:
+        if compact_only:
+            return False
+        out.append(chr(RECORD_JSON))
+        _pack_string(json.dumps(frame, separators=(',', ':')), out)
+        return True
+
+    out.append(chr(header | kind))
+    if header == WRAP_PERSISTENT:
+        _pack_varint(frame['message']['id'], out)
+    elif header == WRAP_PROPAGATE:
+        _pack_string(frame.get('origin') or '', out)
+    if kind in (RECORD_POLYLINE, RECORD_POLYLINE_WIDE):
+        _pack_varint(len(values) // 2, out)
+    out.append(_packer(kind, len(values)).pack(*values))
+    return True
+
+
+def _unpack_record(data, offset):
+    """
+    Unpack one record.
+    :return: tuple (frame, next offset)
+    """
+    if offset >= len(data):
+        raise ValueError("Truncated record")
+    header = ord(data[offset])
+    offset += 1
+    kind = header & RECORD_KIND_MASK
+    if kind == RECORD_JSON:
+        text, offset = _unpack_string(data, offset)
+        return json.loads(text), offset
+
+    message_id = origin = None
+    if header & WRAP_PERSISTENT:
+        message_id, offset = _unpack_varint(data, offset)
+    elif header & WRAP_PROPAGATE:
+        origin, offset = _unpack_string(data, offset)
+        origin = origin.decode('utf-8') or None
+
+    count = 0
+    if kind in (RECORD_POLYLINE, RECORD_POLYLINE_WIDE):
+        count, offset = _unpack_varint(data, offset)
+        if offset + count * 4 > len(data):
+            raise ValueError("Truncated polyline")
+    elif kind not in COORDINATES:
+        raise ValueError("Unknown record kind %d" % kind)
+    unpacker = _packer(kind, count * 2)
+    if offset + unpacker.size > len(data):
+        raise ValueError("Truncated record")
+    values = [_number(value) for value in unpacker.unpack_from(data, offset)]
+    offset += unpacker.size
+    if kind in (RECORD_LINE, RECORD_LINE_WIDE):
+        message = {'method': 'line', 'message': {'start': {'x': values[0], 'y': values[1]},
+                                                 'end': {'x': values[2], 'y': values[3]}}}
+    elif kind in (RECORD_POLYLINE, RECORD_POLYLINE_WIDE):
+        message = {'method': 'polyline', 'message': {'points': [values[index:index + 2]
+                                                                for index in xrange(0, len(values), 2)]}}
+    else:
+        message = {'method': 'clean', 'message': {'x': values[0], 'y': values[1]}}
+
+    if header & WRAP_PERSISTENT:
+        return {'method': 'persistent', 'message': {'id': message_id, 'message': message}}, offset
+    if header & WRAP_PROPAGATE:
+        return {'method': 'propagate', 'message': message, 'origin': origin}, offset
+    return message, offset
+
+
+def encode(frame, compact_only=False):
+    """
+    Pack frame. Batch frames are packed record by record.
+    :param frame: dict frame or message
+    :param compact_only: bool Give None instead of packing any part of the frame as json
+    :return: str packed frame, or None
+    """
+    flags = 0
+    tree = frame.get('tree')
+    if tree is not None:
+        flags |= FLAG_TREE
+    trace = frame.get('trace')
+    if trace is not None:
+        flags |= FLAG_TRACE
+    records = None
+    if frame.get('method') == 'batch' and isinstance(frame.get('messages'), list) and \
+            len(frame) == 2 + ('tree' in frame) + ('trace' in frame):
+        flags |= FLAG_BATCH
+        records = frame['messages']
+    elif tree is not None or trace is not None:
+        frame = dict(frame)
+        frame.pop('tree', None)
+        frame.pop('trace', None)
+
+    out = [HEADER.pack(MAGIC, VERSION, flags)]
+    if flags & FLAG_TREE:
+        _pack_string(json.dumps(tree, separators=(',', ':')), out)
+    if flags & FLAG_TRACE:
+        _pack_string(json.dumps(trace, separators=(',', ':')), out)
+    if records is None:
+        if not _pack_record(frame, out, compact_only):
+            return None
+    else:
+        _pack_varint(len(records), out)
+        for record in records:
+            if not _pack_record(record, out, compact_only):
+                return None
+    return ''.join(out)
+
+
+def decode(data):
+    """
+    Unpack frame.
+    :param data: str packed frame
+    :return: dict frame
+    :raise ValueError: if data is not a packed frame
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated frame")
+    magic, version, flags = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a packed frame")
+    offset = HEADER.size
+    tree = trace = None
+    if flags & FLAG_TREE:
+        text, offset = _unpack_string(data, offset)
+        tree = json.loads(text)
+    if flags & FLAG_TRACE:
+        text, offset = _unpack_string(data, offset)
+        trace = json.loads(text)
+    if flags & FLAG_BATCH:
+        count, offset = _unpack_varint(data, offset)
+        messages = []
+        for _ in xrange(count):
+            record, offset = _unpack_record(data, offset)
+            messages.append(record)
+        frame = {'method': 'batch', 'messages': messages}
+    else:
+        frame, offset = _unpack_record(data, offset)
+    if offset != len(data):
+        raise ValueError("Trailing bytes after frame")
+    if tree is not None:
+        frame['tree'] = tree
+    if trace is not None:
+        frame['trace'] = trace
+    return frame
+
+
+def refused(status, headers):
+    """
+    Whether peer answered packed frame as one it cannot read, so the frame can be sent again as json.
+    :param status: int response code
+    :param headers: dict-like response headers
+    :return: bool
+    """
+    return status == REFUSED or (status == 400 and bool(headers.get(UNDECODABLE_HEADER)))
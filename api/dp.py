@@ -1,16 +1,24 @@
 # For Rest API
-from flask import Flask, request
+from flask import Flask, request, Response, stream_with_context
 from flask.ext.restful import Resource, Api
 from flask.ext.cors import CORS
 
 # For Websocket
+import tornado.concurrent
 import tornado.escape
+import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 import tornado.websocket
 import os.path
 import os
+import zlib
+import json
 
 # Threading
 import threading, thread
@@ -22,7 +30,21 @@ import time
 import sys
 
 # Node class
-from node import Node
+from node import Node, coalesce_tasks, OVERFLOW_POLICIES, OVERFLOW_REJECT, DISSEMINATION_RING, DISSEMINATION_TREE, \
+    ELECTION_RING, ELECTION_VIEW
+from transport import AsyncTransport
+from detector import PhiAccrualDetector
+from wal import WriteAheadLog
+from messagelog import iter_chunks, log_headers, MAX_GAP
+from pubsub import Publisher, Subscriber, MAX_SUBSCRIBER_BUFFER
+import codec
+import metrics
+import simplify
+import spatial
+import tiles
+from Queue import Empty, Queue
+from itertools import groupby
+from collections import deque
 
 # Command line arguments
 import argparse
@@ -38,9 +60,40 @@ import random
 import string
 
 # Time between heartbeats
-HEARTBEAT_INTERVAL = 5
-# Amount of time allowed to miss
-HEARTBEAT_TOLERANCE = 11
+HEARTBEAT_INTERVAL = 0.25
+# Suspicion level of failure detector that makes node panic
+PHI_THRESHOLD = 8
+
+# Entries per chunk in streamed catch-up
+CATCHUP_CHUNK = 1000
+# Messages per websocket frame in history replay
+REPLAY_CHUNK = 500
+
+# Frames a websocket client can fall behind before slow client policy applies
+CLIENT_QUEUE_LIMIT = 1000
+# Slow client policies
+SLOW_DISCONNECT = 'disconnect' # Close connection, client reconnects and replays the board
+SLOW_DROP = 'drop' # Drop oldest queued frame
+SLOW_POLICIES = (SLOW_DISCONNECT, SLOW_DROP)
+# Points kept for unfinished stroke. Longer strokes are propagated in parts.
+MAX_STROKE_POINTS = 5000
+
+# Message methods websocket worker processes and observers can forward to the process owning the node
+FORWARDED_MESSAGES = ('line', 'polyline', 'clean')
+# Bytes of events an observer on another host can fall behind before it is disconnected
+OBSERVER_BUFFER = 4 * 1024 * 1024
+
+# Smallest frame sent deflated to clients that inflate frames themselves
+DEFLATE_MIN_SIZE = 256
+
+# Metrics updated on hot paths. Gauges read from node are registered at the end of the module.
+QUEUE_WAIT_SECONDS = metrics.registry.histogram('queue_wait_seconds', 'Time tasks wait in the outward queue')
+TASK_SECONDS = metrics.registry.histogram('queue_task_seconds', 'Time QueueHandler runs tasks by node method',
+                                          ('method', ))
+BROADCAST_SECONDS = metrics.registry.histogram('websocket_broadcast_seconds',
+                                               'Time to encode and queue message to all websocket clients')
+BROADCAST_DELAY_SECONDS = metrics.registry.histogram('websocket_broadcast_delay_seconds',
+                                                     'Time messages from send_updates wait for the IOLoop')
 
 # Rest api
 rest_server = Flask(__name__)
@@ -69,47 +122,90 @@ class Rest(threading.Thread):
 
 class QueueHandler(threading.Thread):
     """
-    Thread for outward message sending
+    Thread for outward message sending. With batch_size above one, pending propagate and persist tasks
+    are drained together and sent as batch frames.
     """
-    def __init__(self):
+    def __init__(self, batch_size=1, batch_window=0):
         threading.Thread.__init__(self)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+
+    def drain(self, tasks):
+        """
+        Collect pending tasks until batch size is full or batch window has passed.
+        :param tasks: list of tasks, extended in place
+        :return:
+        """
+        deadline = time.time() + self.batch_window
+        while len(tasks) < self.batch_size:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    tasks.append(node.queue.get(timeout=remaining))
+                else:
+                    tasks.append(node.queue.get_nowait())
+            except Empty:
+                break
 
     def run(self):
         global node
         while True:
-            task = node.queue.get()
-            if task['method']:
-                getattr(node, task['method'])(*task['args'])
-            try:
-                node.queue.task_done()
-            except ValueError:
-                continue
+            tasks = [node.queue.get()]
+            if self.batch_size > 1:
+                self.drain(tasks)
+                batch = coalesce_tasks(tasks)
+            else:
+                batch = tasks
+            now = time.time()
+            for task in tasks:
+                if 'queued' in task:
+                    QUEUE_WAIT_SECONDS.observe(now - task['queued'])
+            for task in batch:
+                if task['method']:
+                    started = time.time()
+                    try:
+                        getattr(node, task['method'])(*task['args'])
+                    except Exception:
+                        # One bad task must not stop outward messaging of the node
+                        logging.exception("NODE: Task %s failed", task['method'])
+                    TASK_SECONDS.observe(time.time() - started, (task['method'], ))
+            for task in tasks:
+                try:
+                    node.queue.task_done()
+                except ValueError:
+                    continue
 
 
 
-class Heartbeat(threading.Thread):
+class Heartbeat(object):
     """
-    Thread for heartbeat
+    Heartbeat scheduler on the IOLoop. Heartbeat is sent only if the follower has not accepted other ring
+    messages during the interval. Predecessor is suspected when phi of the failure detector goes over the
+    threshold.
     """
-    def __init__(self):
-        threading.Thread.__init__(self)
+    def __init__(self, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.callback = tornado.ioloop.PeriodicCallback(self.tick, interval * 1000)
 
-    def run(self):
+    def start(self):
+        self.callback.start()
+
+    def tick(self):
         global node
-        while True:
-            try:
-                if node.get_follower() is None:
-                    continue
-                node.heartbeat()
-                # Make sure we get heartbeats from previous host
-                if node.last_heartbeat is None:
-                    node.last_heartbeat = int(time.time())
-                if int(time.time()) - node.last_heartbeat > HEARTBEAT_TOLERANCE:
-                    node.panic(node.host)
-
-                time.sleep(HEARTBEAT_INTERVAL)
-            except socket.error, e:
-                continue
+        if node.get_follower() is None:
+            return
+        now = time.time()
+        if now - node.last_sent >= self.interval and not node.heartbeat_pending:
+            node.heartbeat_pending = True
+            node.enqueue({'method': 'keep_alive', 'args': ()}, force=True)
+        # Make sure we get heartbeats from previous host
+        if node.detector.last is None:
+            node.record_arrival()
+        elif node.detector.phi(now) > self.threshold:
+            logging.warning("HEARTBEAT: Predecessor suspected, phi %.1f", node.detector.phi(now))
+            node.detector.reset()
+            node.enqueue({'method': 'panic', 'args': (node.host,)}, force=True)
 
 class DistributionConnection(Resource):
     """
@@ -118,67 +214,17 @@ class DistributionConnection(Resource):
     def get(self):
         """
         Join the ring
-        :return: int 400 if malformed request, or 200 with {host: node_old_follower_address}.
+        :return: int 400 if malformed request, or 200 with {host: node_old_follower_address, members: ring order,
+        leader: [leader_address, leader_uid] or None}.
         """
-
-        # Check that the message is not malformed
-        host = request.args.get('host')
-        if host == '' or host is None:
-            return '', 400
-
-        # Get old follower
-        old_follower = node.get_follower()
-        # For initial ring creation
-        if old_follower is None:
-            old_follower = node.host
-        # Set joining host as follower
-        node.set_follower(host)
-
-        # Send connection message to websocket
-        msg = {"method": "connected", "message": node.get_follower()}
-        VectorSocketHandler.update_cache(msg)
-        VectorSocketHandler.send_updates(msg)
-
-        logging.info("API: %s is being merged to ring", host)
-        return {'host': old_follower}, 200
+        return join_ring(request.args.get('host'), request.args.get('uid', type=int))
 
     def post(self):
         """
         leave the ring. Requires json message {'host':leaving host, 'new_host': replacing host}
         :return: 400 if malformed request. 200 on success.
         """
-        data = request.json
-        leaving_host = data['host']
-        replacing_host = data['new_host']
-        if leaving_host is None or replacing_host is None:
-            return '', 400
-
-        logging.info("API: %s wants to leave", leaving_host)
-        if node.host == leaving_host: # Message gone already through the ring
-            logging.info("API: Message gone through the ring. Ready to leave.")
-            msg = {'method':'disconnected', 'message':node.get_follower()}
-            VectorSocketHandler.update_cache(msg)
-            VectorSocketHandler.send_updates(msg)
-            node.reset_node()
-
-            return '', 200
-        elif node.get_follower() != leaving_host: # Someone on the middle of the ring
-            logging.info("API:Unknown node, propagating.")
-            node.queue.put({'method': 'disconnect', 'args': (leaving_host, replacing_host)})
-            return '', 200
-        elif node.get_follower() == leaving_host: # Node that lost it's follower.
-            logging.info("API: Follower left. Chancing follower to %s", replacing_host)
-            if replacing_host != node.host: # If we are still a ring
-                node.queue.put({'method': 'disconnect', 'args': (leaving_host, replacing_host)})
-                node.propagate_message({'method': 'control', 'message': leaving_host + ' leaves.'})
-                node.set_follower(replacing_host)
-                node.leader_election("election", 0)
-                node.queue.put({'method': 'leader_election', 'args': ("election", 0)})
-            else:
-                node.set_follower(None)
-            return '', 200
-        else:
-            return '', 200
+        return '', leave_ring(request.json)
 
 
 class DistributionMessages(Resource):
@@ -188,59 +234,366 @@ class DistributionMessages(Resource):
 
     def get(self):
         """
-        Request messages in the channel
-        :return: dict in Node and 200
+        Request messages in the channel. Optional since parameter limits the messages to ones after given id.
+        Optional viewport parameter "x0,y0,x1,y1" limits them to strokes in the rectangle and messages without
+        position, like clean. With stream parameter messages are streamed as newline delimited json [id, message]
+        chunks, gzipped if client accepts it.
+        :return: dict in Node and 200, 400 on malformed viewport, or streamed response
         """
-        return node.messages, 200
+        since = request.args.get('since', 0, type=int)
+        try:
+            message_ids = select_messages(request.args.get('viewport'))
+        except ValueError:
+            return '', 400
+        if not request.args.get('stream'):
+            if message_ids is None:
+                return node.messages.to_dict(first=since + 1), 200
+            return dict(node.messages.select(message_id for message_id in message_ids if message_id > since)), 200
+
+        chunks = iter_chunks(node.messages, since, CATCHUP_CHUNK, message_ids)
+        headers = log_headers(node.messages)
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
 
     def post(self):
         """
         Send messages through the channel. Format is always {'method':some_method, 'message':some message}. Message
-        can be also another dictionary if required
-        :return: 200 on success, 400 on malformed request
+        can be also another dictionary if required. Batch frames {'method':'batch', 'messages':[...]} are unpacked
+        in order. Frames are json, or packed with codec if sent as application/octet-stream.
+        :return: 200 on success, 400 on malformed request, 415 on unknown content type
         """
+        data, status = decode_ring_frame(request.mimetype, request.get_data())
+        if data is None:
+            return '', status, refusal_headers(request.mimetype, status)
+        return '', receive_ring_frame(data, request.headers.get('X-Ring-Hop'))
 
-        data = request.json
-        command = data['method']
-        message = data['message']
-        logging.debug("API: Received message %r", data)
-        if command is None or message is None:
-            return '', 400
-        if command == "election" or command == "elected":  # {'method':'election' or 'elected', 'message': UID}
-            node.queue.put({'method': 'leader_election', 'args': (command, message)})
-        elif command == "propagate":  # {'method':'propagate', 'message': message}
-            node.queue.put({'method': 'propagate_message', 'args': (message,)})
-        elif command == "persistent": # {'method':'persistent', 'message': message}
-            if "method" in message:
-                if message["method"] == "clean":  # {'method':'persistent', 'message':
-                    # 'id': 23, method':'clean', 'message': {'x': 500, 'y': 500}}
-                    node.messages.clean()
-            VectorSocketHandler.update_cache(message['message'])
-            VectorSocketHandler.send_updates(message['message'])
-            if not node.is_leader():
-                node.queue.put({'method': 'persist_message', 'args': (message["message"], message["id"])})
+
+def gzip_chunks(chunks):
+    """
+    Compress chunks to single gzip stream. Every chunk is flushed, so receiver can use it right away.
+    :param chunks: iterator of strings
+    :return: iterator of compressed strings
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def deflate_raw(text):
+    """
+    Compress text to raw deflate stream without header, as read by DecompressionStream('deflate-raw').
+    :param text: str
+    :return: str compressed
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def join_ring(host, uid):
+    """
+    Merge host to the ring as follower of this node.
+    :param host: String joining host address
+    :param uid: int joining host uid, or None
+    :return: tuple (response, status). 400 if malformed request, or 200 with {host: node_old_follower_address,
+    members: ring order, leader: [leader_address, leader_uid] or None}.
+    """
+    # Check that the message is not malformed
+    if host == '' or host is None:
+        return '', 400
+
+    # Get old follower
+    old_follower = node.get_follower()
+    # For initial ring creation
+    if old_follower is None:
+        old_follower = node.host
+    # Set joining host as follower
+    node.set_follower(host)
+    node.add_member(host, uid, after=node.host)
+
+    # Send connection message to websocket
+    msg = {"method": "connected", "message": node.get_follower()}
+    VectorSocketHandler.update_cache(msg)
+    VectorSocketHandler.send_updates(msg)
+
+    logging.info("API: %s is being merged to ring", host)
+    leader = None
+    if node.leader_host is not None:
+        leader = [node.leader_host, node.leader]
+    return {'host': old_follower, 'members': node.members, 'leader': leader}, 200
+
+
+def leave_ring(data):
+    """
+    Handle leave message. Ring messages it causes are queued, so the caller is not blocked.
+    :param data: dict {'host':leaving host, 'new_host': replacing host}
+    :return: int status code. 400 if malformed request, 200 on success.
+    """
+    try:
+        leaving_host = data['host']
+        replacing_host = data['new_host']
+    except (KeyError, TypeError):
+        return 400
+    if leaving_host is None or replacing_host is None:
+        return 400
+
+    logging.info("API: %s wants to leave", leaving_host)
+    node.remove_member(leaving_host)
+    if node.host == leaving_host: # Message gone already through the ring
+        logging.info("API: Message gone through the ring. Ready to leave.")
+        msg = {'method':'disconnected', 'message':node.get_follower()}
+        VectorSocketHandler.update_cache(msg)
+        VectorSocketHandler.send_updates(msg)
+        node.reset_node()
+    elif node.get_follower() != leaving_host: # Someone on the middle of the ring
+        logging.info("API:Unknown node, propagating.")
+        node.enqueue({'method': 'disconnect', 'args': (leaving_host, replacing_host)}, force=True)
+    else: # Node that lost it's follower.
+        logging.info("API: Follower left. Chancing follower to %s", replacing_host)
+        if replacing_host != node.host: # If we are still a ring
+            # Tell the leaving node straight away. Follower is replaced before the queue sends it.
+            node.enqueue({'method': 'disconnect', 'args': (leaving_host, replacing_host, leaving_host)}, force=True)
+            node.set_follower(replacing_host)
+            node.enqueue({'method': 'propagate_message',
+                          'args': ({'method': 'control', 'message': leaving_host + ' leaves.'},)}, force=True)
+            node.enqueue({'method': 'elect', 'args': ()}, force=True)
         else:
-            logging.warning("API: Unknown message: %r", data)
+            node.set_follower(None)
+    return 200
+
+
+def select_messages(viewport):
+    """
+    Find messages in viewport.
+    :param viewport: "x0,y0,x1,y1" string, or None for all messages
+    :return: sorted list of sequence numbers, or None for all messages
+    :raise ValueError: if viewport is malformed
+    """
+    if not viewport:
+        return None
+    return node.index.query(spatial.parse_viewport(viewport))
+
+
+def decode_ring_frame(content_type, body):
+    """
+    Decode ring frame from request body.
+    :param content_type: String mimetype of the body
+    :param body: str request body
+    :return: tuple (frame, status). Frame is None if body cannot be decoded: status is 400 on malformed body,
+    415 on unknown content type.
+    """
+    if content_type == codec.CONTENT_TYPE:
+        try:
+            return codec.decode(body), 200
+        except ValueError:
+            return None, 400
+    if content_type != 'application/json':
+        return None, 415
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None, 400
+    if not isinstance(data, dict):
+        return None, 400
+    return data, 200
+
+
+def refusal_headers(content_type, status):
+    """
+    Headers of response to frame that could not be decoded. Sender sends packed frame again as json only if
+    the packed body itself could not be decoded.
+    :param content_type: String mimetype of the body
+    :param status: int status of decode_ring_frame
+    :return: dict of headers
+    """
+    if status == 400 and content_type == codec.CONTENT_TYPE:
+        return {codec.UNDECODABLE_HEADER: '1'}
+    return {}
+
+
+def receive_ring_frame(data, hop=None):
+    """
+    Handle frame posted by another node.
+    :param data: dict frame
+    :param hop: String X-Ring-Hop header. Set when the frame comes from the predecessor.
+    :return: int status code of handle_ring_message
+    """
+    logging.debug("API: Received message %r", data)
+    if data.get('method') == 'removed':
+        return handle_removed(data.get('message'), hop)
+    if hop:
+        node.record_arrival(hop)
+    return handle_ring_message(data)
+
+
+def handle_removed(sender, hop):
+    """
+    Handle notice that a member spliced this node out of the ring. Only the predecessor splices a node out,
+    so notices from other members or addresses are ignored. Joining again runs on the queue thread.
+    :param sender: String address of the member that removed this node, {'method':'removed', 'message': address}
+    :param hop: String X-Ring-Hop header of the notice
+    :return: int status code. 200 on success, 400 on malformed request
+    """
+    if not isinstance(sender, basestring):
+        return 400
+    if hop != sender or sender != node.predecessor or sender not in node.member_hosts():
+        logging.warning("NODE: Ignored removal notice from %s, hop %s", sender, hop)
+        return 200
+    node.enqueue({'method': 'rejoin', 'args': (sender, )}, force=True)
+    return 200
+
+
+def receive_heartbeat(data, hop=None):
+    """
+    Handle heartbeat. If host is set, ring is already panicking and the panic is passed on from the queue.
+    :param data: dict {'host': replacing host} or None for plain heartbeat
+    :param hop: String X-Ring-Hop header, address of the predecessor
+    :return: int status code
+    """
+    if data is not None:
+        if "host" in data:
+            if data['host'] != node.host:
+                node.enqueue({'method': 'panic', 'args': (data['host'],)}, force=True)
+    else:
+        node.record_arrival(hop)
+    return 200
+
+
+def handle_ring_message(data):
+    """
+    Handle single ring frame. Ring tasks are queued even over the queue capacity. Only messages of this node's
+    own clients are bounded, so a message is never lost mid-ring.
+    :param data: dict frame. Sampled frames have hop trace {'trace': [...]}, see tracing.
+    :return: int status code. 200 on success, 400 on malformed request
+    """
+    command = data.get('method')
+    trace = data.get('trace')
+    if trace is not None:
+        trace = node.receive_trace(trace)
+    if command == "batch":  # {'method':'batch', 'messages': [frame, frame, ...]}
+        messages = data.get('messages')
+        if messages is None:
+            return 400
+        # Consecutive frames of same kind are handled as one batch task. Trace goes on with the first one.
+        status = 200
+        for (command, origin), frames in groupby(messages, key=lambda frame: (frame.get('method'), frame.get('origin'))):
+            frames = list(frames)
+            if command == "propagate":
+                node.enqueue({'method': 'propagate_messages',
+                              'args': ([frame['message'] for frame in frames], origin, trace)}, force=True)
+                trace = None
+            elif command == "persistent":
+                entries = []
+                for frame in frames:
+                    entries.append((frame['message']['message'], frame['message']['id']))
+                    VectorSocketHandler.update_cache(frame['message']['message'])
+                    VectorSocketHandler.send_updates(frame['message']['message'])
+                if not node.is_leader():
+                    node.enqueue({'method': 'persist_messages', 'args': (entries, data.get('tree'), trace)},
+                                 force=True)
+                trace = None
+            else:
+                for frame in frames:
+                    status = max(status, handle_ring_message(frame))
+        return status
+
+    message = data.get('message')
+    if command is None or message is None:
+        return 400
+    if command == "election" or command == "elected":  # {'method':'election' or 'elected', 'message': UID}
+        # Messages carry ring order visited by the suggested leader's message, and elected message leader address
+        # {'method':'elected', 'message': UID, 'host': address, 'members': [[address, uid], ...]}
+        node.enqueue({'method': 'leader_election',
+                      'args': (command, message, data.get('host'), data.get('members'), trace)}, force=True)
+    elif command == "members":  # {'method':'members', 'message': [[address, uid], ...], 'origin': origin address,
+        # 'leader': [address, uid] or None}
+        node.enqueue({'method': 'update_members', 'args': (message, data.get('origin'), data.get('leader'))},
+                     force=True)
+    elif command == "propagate":  # {'method':'propagate', 'message': message, 'origin': origin address}
+        node.enqueue({'method': 'propagate_message', 'args': (message, data.get('origin'), trace)}, force=True)
+    elif command == "persistent": # {'method':'persistent', 'message': message, 'tree': [address, ...] or missing}
+        # Clean {'method':'persistent', 'message': {'id': 23, 'message': {'method':'clean', 'message': {'x': 500,
+        # 'y': 500}}}} compacts the message log when it is persisted.
+        VectorSocketHandler.update_cache(message['message'])
+        VectorSocketHandler.send_updates(message['message'])
+        if not node.is_leader():
+            node.enqueue({'method': 'persist_messages',
+                          'args': ([(message["message"], message["id"])], data.get('tree'), trace)}, force=True)
+    else:
+        logging.warning("API: Unknown message: %r", data)
+    return 200
+
+class DistributionQueue(Resource):
+    """
+    Queue resource. Shows outward queue depth and overflow counters.
+    """
+    def get(self):
+        """
+        Request queue statistics
+        :return: dict of queue statistics and 200
+        """
+        return node.queue_stats(), 200
+
+class DistributionMetrics(Resource):
+    """
+    Metrics resource. Node internals as json, or Prometheus text format with format=prometheus parameter or
+    text/plain Accept header. Ring API is served by the process owning the node, so with --workers websocket
+    metrics cover only the clients of that process.
+    """
+    def get(self):
+        """
+        Request metrics
+        :return: metrics and 200
+        """
+        body, content_type = render_metrics(request.args.get('format'), request.headers.get('Accept'))
+        return Response(body, status=200, content_type=content_type)
+
+
+class DistributionTrace(Resource):
+    """
+    Ring latency map resource. Per-hop latency aggregated from sampled hop traces, slowest first.
+    """
+    def get(self):
+        """
+        Request latency map
+        :return: dict {'traces', 'nodes', 'links'} and 200
+        """
+        return node.latency.to_dict(), 200
+
+    def delete(self):
+        """
+        Forget recorded traces
+        :return: 200
+        """
+        node.latency.clear()
         return '', 200
 
+
+def render_metrics(output_format, accept):
+    """
+    Render metrics of this process.
+    :param output_format: String 'prometheus' or 'json', or None to decide by accept
+    :param accept: String Accept header, or None
+    :return: tuple (body, content type)
+    """
+    if output_format == 'prometheus' or (output_format is None and 'text/plain' in (accept or '')):
+        return metrics.registry.to_prometheus(), metrics.PROMETHEUS_CONTENT_TYPE
+    return metrics.registry.to_json(), 'application/json'
+
+
 class DistributionHeartbeat(Resource):
     """
-    Heartbeat resource. When in ring, node has to get update from previous node inside HEARTBEAT_TOLERANCE.
-    If it's not getting updates, it will panic.
+    Heartbeat resource. When in ring, node has to get updates from previous node. If phi of the failure
+    detector gets over PHI_THRESHOLD, it will panic.
     """
     def post(self):
         """
         listen heartbeats. If host is set, ring is already panicking.
         :return: 200 on success.
         """
-        data = request.json
-        if data is not None:
-            if "host" in data:
-                if data['host'] != node.host:
-                    node.panic(data['host'])
-        else:
-            node.last_heartbeat = int(time.time())
-        return '', 200
+        return '', receive_heartbeat(request.json, request.headers.get('X-Ring-Hop'))
 
 # Declare API resources
 api.add_resource(DistributionConnection, '/api/connection/',
@@ -249,6 +602,159 @@ api.add_resource(DistributionMessages, '/api/messages/',
                     endpoint='messages')
 api.add_resource(DistributionHeartbeat, '/api/heartbeat/',
                  endpoint="heartbeat")
+api.add_resource(DistributionQueue, '/api/queue/',
+                 endpoint="queue")
+api.add_resource(DistributionMetrics, '/api/metrics', '/api/metrics/',
+                 endpoint="metrics")
+api.add_resource(DistributionTrace, '/api/trace/',
+                 endpoint="trace")
+
+
+class RingHandler(tornado.web.RequestHandler):
+    """
+    Base of ring API handlers served on the IOLoop. They answer like the Flask resources.
+    """
+    def respond(self, body, status):
+        """
+        Write response.
+        :param body: dict written as json, or '' for empty body
+        :param status: int status code
+        :return:
+        """
+        self.set_status(status)
+        if body != '':
+            self.write(body)
+
+    def json_body(self):
+        """
+        Request body as json.
+        :return: decoded body, None if it is empty or malformed
+        """
+        if not self.request.body:
+            return None
+        try:
+            return tornado.escape.json_decode(self.request.body)
+        except ValueError:
+            return None
+
+
+class ConnectionHandler(RingHandler):
+    """
+    Join and leave the ring, like DistributionConnection.
+    """
+    def get(self):
+        try:
+            uid = int(self.get_argument('uid', None))
+        except (TypeError, ValueError):
+            uid = None
+        self.respond(*join_ring(self.get_argument('host', None), uid))
+
+    def post(self):
+        self.respond('', leave_ring(self.json_body()))
+
+
+class MessagesHandler(RingHandler):
+    """
+    Request and send messages, like DistributionMessages.
+    """
+    @tornado.gen.coroutine
+    def get(self):
+        try:
+            since = int(self.get_argument('since', 0))
+        except ValueError:
+            since = 0
+        try:
+            message_ids = select_messages(self.get_argument('viewport', None))
+        except ValueError:
+            self.respond('', 400)
+            return
+        if not self.get_argument('stream', None):
+            if message_ids is None:
+                self.respond(node.messages.to_dict(first=since + 1), 200)
+            else:
+                self.respond(dict(node.messages.select(message_id for message_id in message_ids
+                                                       if message_id > since)), 200)
+            return
+
+        chunks = iter_chunks(node.messages, since, CATCHUP_CHUNK, message_ids)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        for name, value in log_headers(node.messages).iteritems():
+            self.set_header(name, value)
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            chunks = gzip_chunks(chunks)
+            self.set_header('Content-Encoding', 'gzip')
+        # Flush chunk by chunk, so other requests are served between them
+        for chunk in chunks:
+            self.write(chunk)
+            yield self.flush()
+
+    def post(self):
+        content_type = self.request.headers.get('Content-Type', '').split(';')[0].strip()
+        data, status = decode_ring_frame(content_type, self.request.body)
+        if data is None:
+            for name, value in refusal_headers(content_type, status).iteritems():
+                self.set_header(name, value)
+            self.respond('', status)
+            return
+        self.respond('', receive_ring_frame(data, self.request.headers.get('X-Ring-Hop')))
+
+
+class HeartbeatHandler(RingHandler):
+    """
+    Listen heartbeats, like DistributionHeartbeat.
+    """
+    def post(self):
+        self.respond('', receive_heartbeat(self.json_body(), self.request.headers.get('X-Ring-Hop')))
+
+    def options(self):
+        # Used for opening connection before the first message
+        self.respond('', 200)
+
+
+class QueueStatsHandler(RingHandler):
+    """
+    Queue statistics, like DistributionQueue.
+    """
+    def get(self):
+        self.respond(node.queue_stats(), 200)
+
+
+class MetricsHandler(RingHandler):
+    """
+    Metrics, like DistributionMetrics.
+    """
+    def get(self):
+        body, content_type = render_metrics(self.get_argument('format', None), self.request.headers.get('Accept'))
+        self.set_header('Content-Type', content_type)
+        self.write(body)
+
+
+class TraceHandler(RingHandler):
+    """
+    Ring latency map, like DistributionTrace.
+    """
+    def get(self):
+        self.respond(node.latency.to_dict(), 200)
+
+    def delete(self):
+        node.latency.clear()
+        self.respond('', 200)
+
+
+class RingApi(tornado.web.Application):
+    """
+    Ring API as Tornado app. Runs on the same IOLoop as the websocket app instead of the Flask thread.
+    """
+    def __init__(self):
+        handlers = [
+            (r"/api/connection/", ConnectionHandler),
+            (r"/api/messages/", MessagesHandler),
+            (r"/api/heartbeat/", HeartbeatHandler),
+            (r"/api/queue/", QueueStatsHandler),
+            (r"/api/metrics/?", MetricsHandler),
+            (r"/api/trace/", TraceHandler),
+        ]
+        super(RingApi, self).__init__(handlers)
 
 
 # The tornado architecture is influenced by https://github.com/tornadoweb/tornado/tree/master/demos/chat
@@ -260,6 +766,7 @@ class Vectors(tornado.web.Application):
         handlers = [
             (r"/", MainHandler),
             (r"/vectorsocket", VectorSocketHandler),
+            (r"/tiles/(\d+)/(-?\d+)/(-?\d+)\.png", TileHandler),
         ]
 
         settings = dict(
@@ -274,30 +781,119 @@ class Vectors(tornado.web.Application):
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
         """
-        Return main page
+        Return main page. Page paints tiles of given version first and gets newer messages through websocket.
         :return: main page in html
         """
-        self.render("index.html", messages=VectorSocketHandler.cache)
+        tile_info = None
+        if TileHandler.pyramid is not None:
+            tile_info = {'version': TileHandler.pyramid.version(), 'size': TileHandler.pyramid.tile_size}
+        self.render("index.html", messages=VectorSocketHandler.cache, tiles=tile_info)
+
+
+class TileRenderer(threading.Thread):
+    """
+    Thread rendering tiles, so rasterizing and encoding does not block the IOLoop.
+    """
+    def __init__(self, pyramid, requests, io_loop):
+        """
+        :param pyramid: tiles.TilePyramid
+        :param requests: Queue of ((z, x, y), tornado.concurrent.Future)
+        :param io_loop: tornado.ioloop.IOLoop futures are resolved on
+        """
+        threading.Thread.__init__(self)
+        self.pyramid = pyramid
+        self.requests = requests
+        self.io_loop = io_loop
+
+    def run(self):
+        while True:
+            key, future = self.requests.get()
+            try:
+                image = self.pyramid.png(*key)
+            except Exception:
+                self.io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                self.io_loop.add_callback(future.set_result, image)
+
+
+class TileHandler(tornado.web.RequestHandler):
+    """
+    Board tiles as PNG images. Tiles contain every message up to the version given to the page. Tiles that are
+    not cached are rendered by TileRenderer threads.
+    """
+    pyramid = None # tiles.TilePyramid, None if tiles are disabled
+    renders = Queue() # Render requests for TileRenderer threads
+
+    @tornado.gen.coroutine
+    def get(self, z, x, y):
+        """
+        Return tile
+        :param z: zoom level, 0 is full resolution
+        :param x: tile column
+        :param y: tile row
+        :return: PNG image, 404 if tiles are disabled or there is no such zoom level
+        """
+        if TileHandler.pyramid is None:
+            raise tornado.web.HTTPError(404)
+        key = (int(z), int(x), int(y))
+        image = TileHandler.pyramid.cached_png(*key)
+        if image is None:
+            future = tornado.concurrent.Future()
+            TileHandler.renders.put((key, future))
+            try:
+                image = yield future
+            except ValueError:
+                raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'image/png')
+        # Same tile url gets more strokes over time. Etag lets browser reuse unchanged tiles.
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(image)
 
 
 class VectorSocketHandler(tornado.websocket.WebSocketHandler):
     """
-    Vector websocket. Handles messaging between node and client.
+    Vector websocket. Handles messaging between node and client. Broadcast messages are encoded once and queued
+    to every client, which has its own bounded send queue.
     """
     waiters = set()
     cache = []
     cache_size = 100
+    io_loop = None # Loop broadcasts are sent from
+    queue_limit = CLIENT_QUEUE_LIMIT # Frames a client can fall behind
+    slow_policy = SLOW_DISCONNECT # What to do with clients over the limit
+    dropped = 0 # Frames dropped from slow clients
+    evicted = 0 # Slow clients disconnected
+    tolerance = simplify.TOLERANCE # Stroke simplification tolerance in pixels
+    quantum = simplify.QUANTUM # Grid stroke points are snapped to
+    publishers = [] # pubsub.Publishers passing broadcasts on to websocket worker processes and observers
+    upstream = None # pubsub.Subscriber of worker or observer. Client messages are forwarded through it to the node.
+    ring_commands = True # Clients can make the node join and leave the ring. Observers never join.
     global node
 
     def get_compression_options(self):
+        # Clients inflating pre-compressed frames themselves do not need per-connection compression.
+        if self.get_argument('deflate', None) == '1' or self.get_argument('binary', None) == '1':
+            return None
         # Non-None enables compression with default options.
         return {}
 
     def open(self):
         """
-        On client join.
+        On client join. Client asks for packed binary frames with binary=1 and pre-compressed binary frames with
+        deflate=1 parameter. Optional viewport=x0,y0,x1,y1 parameter limits strokes to ones in the rectangle.
+        Optional since parameter skips old messages up to it, for example ones the page painted from tiles.
         :return:
         """
+        self.binary = self.get_argument('binary', None) == '1'
+        self.deflate = self.get_argument('deflate', None) == '1'
+        self.replaying = False # Replay in progress. Live updates wait in the send queue until it ends.
+        self.replays = 0 # Replay generation
+        self.outbox = deque() # Encoded frames waiting to be written, (payload, binary)
+        self.sending = False # Send queue is being written
+        self.strokes = {} # Points of unfinished strokes by client stroke id
+        self.viewport = None # Rectangle of strokes sent to client, None for all
+        if self.get_argument('viewport', None):
+            self.set_viewport(self.get_argument('viewport'))
         VectorSocketHandler.waiters.add(self)
 
         # Send update about connection status
@@ -306,11 +902,163 @@ class VectorSocketHandler(tornado.websocket.WebSocketHandler):
             self.write_message(msg)
 
         # Write old messages
-        for key, value in node.messages.iteritems():
-            self.write_message({'method':value['method'], 'message':value['message']})
+        try:
+            since = int(self.get_argument('since', 0))
+        except ValueError:
+            since = 0
+        self.start_replay(since)
 
     def on_close(self):
-        VectorSocketHandler.waiters.remove(self)
+        VectorSocketHandler.waiters.discard(self)
+        self.outbox.clear()
+        # Keep what was drawn before the connection was lost
+        for stroke in self.strokes.keys():
+            self.finish_stroke(stroke, True)
+
+    def start_replay(self, since=0):
+        """
+        Start sending old messages. Earlier replay of this client is abandoned.
+        :param since: int sequence number after which messages are sent. Client has the ones before it already,
+        for example from tiles.
+        :return:
+        """
+        self.replaying = True
+        self.replays += 1
+        tornado.ioloop.IOLoop.current().spawn_callback(self.replay, self.replays, len(self.outbox), since)
+
+    @tornado.gen.coroutine
+    def replay(self, replay_id, queued=0, since=0):
+        """
+        Send old messages as batch frames of REPLAY_CHUNK messages. Next frame is written only after the
+        previous one is flushed, so a slow client cannot make the node buffer the whole board.
+        :param replay_id: int replay generation. Replay stops if a newer one is started.
+        :param queued: int frames queued before the replay started. They are written first.
+        :param since: int sequence number after which messages are sent
+        :return:
+        """
+        chunk = []
+        if self.viewport is None:
+            entries = node.messages.range(first=since + 1, last=node.messages.last_id())
+        else:
+            entries = node.messages.select(message_id for message_id in node.index.query(self.viewport)
+                                           if message_id > since)
+        try:
+            for _ in range(queued):
+                if not self.outbox:
+                    break
+                yield self.write_encoded(*self.outbox.popleft())
+            for message_id, value in entries:
+                chunk.append({'method': value['method'], 'message': value['message']})
+                if len(chunk) >= REPLAY_CHUNK:
+                    yield self.write_encoded(*self.encode({'method': 'batch', 'messages': chunk}))
+                    chunk = []
+                    if replay_id != self.replays:
+                        return
+            if chunk:
+                yield self.write_encoded(*self.encode({'method': 'batch', 'messages': chunk}))
+        except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+            return
+        if replay_id != self.replays:
+            return
+        self.replaying = False
+        self.pump()
+
+    def set_viewport(self, viewport):
+        """
+        Limit strokes sent to client to a rectangle.
+        :param viewport: "x0,y0,x1,y1" string, [x0, y0, x1, y1] list, or None for all strokes
+        :return: True if viewport was valid
+        """
+        if viewport is None:
+            self.viewport = None
+            return True
+        try:
+            self.viewport = spatial.parse_viewport(viewport)
+        except ValueError as e:
+            logging.warning("WS: Malformed viewport %r: %s", viewport, e)
+            self.write_message({"method": "error", "message": "Malformed viewport."})
+            return False
+        return True
+
+    def encode(self, message, encoded=None):
+        """
+        Encode message for this client. Messages of only lines and cleans are packed for binary clients, large
+        json is deflated for deflate clients.
+        :param message: dict message
+        :param encoded: dict of earlier encodings of the same message, filled in place. Broadcast shares it
+        between clients, so message is encoded once per format.
+        :return: tuple (payload, binary)
+        """
+        if encoded is None:
+            encoded = {}
+        if self.binary:
+            if 'packed' not in encoded:
+                encoded['packed'] = codec.encode(message, compact_only=True)
+            if encoded['packed'] is not None:
+                return encoded['packed'], True
+        if 'text' not in encoded:
+            encoded['text'] = tornado.escape.json_encode(message)
+        if self.deflate and len(encoded['text']) >= DEFLATE_MIN_SIZE:
+            if 'deflated' not in encoded:
+                encoded['deflated'] = deflate_raw(encoded['text'])
+            return encoded['deflated'], True
+        return encoded['text'], False
+
+    def write_encoded(self, payload, binary):
+        """
+        Write encoded frame.
+        :param payload: str json text, packed frame or deflated json
+        :param binary: bool True if payload is not json text
+        :return: Future resolved when frame is flushed
+        """
+        return self.write_message(payload, binary=binary)
+
+    def push(self, payload, binary):
+        """
+        Add encoded frame to the send queue. Client over the queue limit loses its oldest frame or is disconnected,
+        depending on slow_policy.
+        :param payload: str json text, packed frame or deflated json
+        :param binary: bool True if payload is not json text
+        :return:
+        """
+        if len(self.outbox) >= VectorSocketHandler.queue_limit:
+            if VectorSocketHandler.slow_policy == SLOW_DROP:
+                self.outbox.popleft()
+                VectorSocketHandler.dropped += 1
+            else:
+                logging.warning("WS: Client fell %d frames behind. Disconnecting.", len(self.outbox))
+                VectorSocketHandler.evicted += 1
+                VectorSocketHandler.waiters.discard(self)
+                self.outbox.clear()
+                self.close(1008, "Too slow")
+                return
+        self.outbox.append((payload, binary))
+        self.pump()
+
+    def pump(self):
+        """
+        Start writing the send queue unless it is written already or replay is in progress.
+        :return:
+        """
+        if self.sending or self.replaying or not self.outbox:
+            return
+        self.sending = True
+        tornado.ioloop.IOLoop.current().spawn_callback(self.drain)
+
+    @tornado.gen.coroutine
+    def drain(self):
+        """
+        Write the send queue one frame at a time.
+        :return:
+        """
+        try:
+            while self.outbox and not self.replaying:
+                payload, binary = self.outbox.popleft()
+                yield self.write_encoded(payload, binary)
+        except (tornado.websocket.WebSocketClosedError, tornado.iostream.StreamClosedError):
+            self.outbox.clear()
+        finally:
+            self.sending = False
 
     @classmethod
     def update_cache(cls, chat):
@@ -321,16 +1069,103 @@ class VectorSocketHandler(tornado.websocket.WebSocketHandler):
     @classmethod
     def send_updates(cls, message):
         """
-        Send updates to all node clients.
+        Send updates to all node clients. Safe to call from any thread, message is broadcast on the IOLoop.
         :param message: message to be sent
         :return:
         """
+        if cls.io_loop is None:
+            cls.broadcast(message)
+        else:
+            cls.io_loop.add_callback(cls.broadcast, message, time.time())
+
+    @classmethod
+    def broadcast(cls, message, queued=None):
+        """
+        Encode message once and queue it to all node clients. Strokes are sent only to clients whose viewport
+        they overlap.
+        :param message: message to be sent
+        :param queued: float time when send_updates was called, None if called on the IOLoop
+        :return:
+        """
+        started = time.time()
+        if queued is not None:
+            BROADCAST_DELAY_SECONDS.observe(started - queued)
         logging.info("WS: Sending message to %d waiters", len(cls.waiters))
-        for waiter in cls.waiters:
-            try:
-                waiter.write_message(message)
-            except:
-                logging.error("WS: Error sending message", exc_info=True)
+        for publisher in cls.publishers:
+            publisher.publish(['broadcast', message])
+        encoded = {}
+        box = spatial.bounds(message)
+        for waiter in list(cls.waiters):
+            if box is not None and waiter.viewport is not None and not spatial.intersects(box, waiter.viewport):
+                continue
+            waiter.push(*waiter.encode(message, encoded))
+        BROADCAST_SECONDS.observe(time.time() - started)
+
+    def enqueue(self, task):
+        """
+        Queue task for the node without blocking the IOLoop. Worker process forwards it to the process owning
+        the node. Client is told if the node is overloaded or cannot be reached.
+        :param task: dict {'method': node_method, 'args': arguments}
+        :return: True if task was queued
+        """
+        if VectorSocketHandler.upstream is not None:
+            if VectorSocketHandler.upstream.send(['enqueue', task]):
+                return True
+            error = "Node is not reachable. Message was not sent."
+        elif node.enqueue(task):
+            return True
+        else:
+            error = "Node is overloaded. Message was not sent."
+        try:
+            self.write_message({"method": "error", "message": error})
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        return False
+
+    def add_points(self, message):
+        """
+        Collect points of freehand stroke. Stroke is propagated when it ends, or in parts if it gets longer
+        than MAX_STROKE_POINTS.
+        :param message: dict {'stroke': client stroke id, 'points': [[x, y], ...], 'end': bool}
+        :return:
+        """
+        stroke = message.get('stroke')
+        points = message.get('points')
+        try:
+            if not isinstance(stroke, (int, long, basestring)):
+                raise ValueError("Stroke id must be int or string")
+            simplify.validate(points)
+        except ValueError as e:
+            logging.warning("WS: Malformed stroke: %s", e)
+            self.strokes.pop(stroke, None)
+            return
+        if stroke not in self.strokes:
+            # Client draws one stroke at a time. Earlier strokes lost their end.
+            for unfinished in self.strokes.keys():
+                self.finish_stroke(unfinished, True)
+            self.strokes[stroke] = []
+        self.strokes[stroke].extend(points)
+        if message.get('end'):
+            self.finish_stroke(stroke, True)
+        elif len(self.strokes[stroke]) >= MAX_STROKE_POINTS:
+            self.finish_stroke(stroke, False)
+
+    def finish_stroke(self, stroke, ended):
+        """
+        Simplify collected stroke points and propagate them as one polyline.
+        :param stroke: client stroke id
+        :param ended: bool False if stroke continues. Its last point is kept as start of the next part.
+        :return:
+        """
+        points = self.strokes.pop(stroke, [])
+        if not ended and points:
+            self.strokes[stroke] = [points[-1]]
+        points = simplify.simplify(points, VectorSocketHandler.tolerance, VectorSocketHandler.quantum)
+        if len(points) < 2:
+            return
+        logging.debug("WS: Stroke simplified to %d points", len(points))
+        self.enqueue({'method': 'propagate_message',
+                      'args': ({"method": "polyline", "message": {"points": points}}, )})
 
     def on_message(self, json_message):
         """
@@ -347,49 +1182,212 @@ class VectorSocketHandler(tornado.websocket.WebSocketHandler):
                 "message": parsed["message"],
                 "method": "line"
             }
-            node.queue.put({'method': 'propagate_message', 'args': (message, )})
+            self.enqueue({'method': 'propagate_message', 'args': (message, )})
+
+        elif method == "polyline":
+            if isinstance(parsed["message"], dict):
+                self.add_points(parsed["message"])
+
+        elif method == "viewport":
+            # {'method':'viewport', 'message': [x0, y0, x1, y1] or None}. Strokes in the new viewport are replayed.
+            if self.set_viewport(parsed["message"]):
+                self.start_replay()
 
         elif method == "clean":
             message = {
                 "message": parsed["message"],
                 "method": "clean"
             }
-            node.queue.put({'method': 'propagate_message', 'args': (message, )})
+            self.enqueue({'method': 'propagate_message', 'args': (message, )})
+
+        elif method in ("connect", "disconnect") and not VectorSocketHandler.ring_commands:
+            self.write_message({"method": "error", "message": "Observer does not join the ring."})
 
         elif method == "connect":
             target = parsed["message"]
             if target is None:
                 return
-            success = node.connect(target)
-            if success:
-                # Clean up the whiteboard
-                msg = {"method": "clean", "message": {'x':500, 'y':500}}
-                VectorSocketHandler.update_cache(msg)
-                VectorSocketHandler.send_updates(msg)
-
-                # Send connection message to node clients.
-                msg = {"method": "connected", "message": node.get_follower()}
-                VectorSocketHandler.update_cache(msg)
-                VectorSocketHandler.send_updates(msg)
-
-                # get messages from node follower
-                node.request_messages()
-
-                for key, value in node.messages.iteritems():
-                    VectorSocketHandler.update_cache(value)
-                    VectorSocketHandler.send_updates(value)
-                # Elect new leader
-                node.queue.put({'method': 'leader_election', 'args': ("election", 0)})
+            if VectorSocketHandler.upstream is not None:
+                VectorSocketHandler.upstream.send(['connect', target])
+            else:
+                connect_ring(target)
 
         elif method == "disconnect":
-            response = node.disconnect(node.host, node.get_follower())
-
-            # Message followers
-            msg = {"method": "disconnected", "message": node.get_follower()}
+            if VectorSocketHandler.upstream is not None:
+                VectorSocketHandler.upstream.send(['disconnect'])
+            else:
+                disconnect_ring()
         else:
             return
 
 
+def connect_ring(target):
+    """
+    Join ring through target node on request of a websocket client. Board is replaced with the ring's board.
+    Joining and catch-up run on the queue thread, see Node.join.
+    :param target: String address of a ring member
+    :return:
+    """
+    node.enqueue({'method': 'join', 'args': (target, )}, force=True)
+
+
+def ring_joined():
+    """
+    Called on the queue thread when the node joined a ring.
+    :return:
+    """
+    VectorSocketHandler.io_loop.add_callback(announce_connection, node.get_follower())
+
+
+def announce_connection(follower):
+    """
+    Replace board of clients with the ring's board. Runs on the IOLoop.
+    :param follower: String address of the new follower
+    :return:
+    """
+    # Clean up the whiteboard
+    # Broadcast right away, so clients get these before the replay
+    msg = {"method": "clean", "message": {'x':500, 'y':500}}
+    VectorSocketHandler.update_cache(msg)
+    VectorSocketHandler.broadcast(msg)
+
+    # Send connection message to node clients.
+    msg = {"method": "connected", "message": follower}
+    VectorSocketHandler.update_cache(msg)
+    VectorSocketHandler.broadcast(msg)
+
+
+def ring_caught_up():
+    """
+    Called on the queue thread when the node caught up with the board of the ring it joined.
+    :return:
+    """
+    VectorSocketHandler.io_loop.add_callback(replay_board)
+
+
+def replay_board():
+    """
+    Replay the board caught up from the ring to clients and workers. Runs on the IOLoop.
+    :return:
+    """
+    for waiter in VectorSocketHandler.waiters:
+        waiter.start_replay()
+    for publisher in VectorSocketHandler.publishers:
+        publisher.publish(['replay'])
+
+
+def disconnect_ring():
+    """
+    Leave ring on request of a websocket client. Runs on the IOLoop.
+    :return:
+    """
+    response = node.disconnect(node.host, node.get_follower())
+
+    # Message followers
+    msg = {"method": "disconnected", "message": node.get_follower()}
+
+
+def handle_subscriber_request(event):
+    """
+    Handle event from a websocket worker process. Workers only forward what their clients send.
+    :param event: list event, see pubsub
+    :return:
+    """
+    kind = event[0]
+    if kind == 'connect' and len(event) == 2 and isinstance(event[1], basestring):
+        connect_ring(event[1])
+    elif kind == 'disconnect':
+        disconnect_ring()
+    else:
+        handle_observer_request(event)
+
+
+def handle_observer_request(event):
+    """
+    Handle event from an observer. Observers can only forward strokes of their clients. The message is
+    propagated as created by this node, so subscribers cannot set its origin or trace.
+    :param event: list event, see pubsub
+    :return:
+    """
+    message = forwarded_message(event)
+    if message is None:
+        logging.warning("PUBSUB: Refused request %r", event)
+    elif not node.enqueue({'method': 'propagate_message', 'args': (message, )}):
+        logging.warning("PUBSUB: Node is overloaded. Forwarded message was not sent.")
+
+
+def forwarded_message(event):
+    """
+    Client message of forwarded propagate task.
+    :param event: list event ['enqueue', {'method': 'propagate_message', 'args': [message]}]
+    :return: dict message with only method and message, None if event is not a forwarded client message
+    """
+    if event[0] != 'enqueue' or len(event) != 2 or not isinstance(event[1], dict):
+        return None
+    task = event[1]
+    if task.get('method') != 'propagate_message' or not isinstance(task.get('args'), list) or \
+            len(task['args']) != 1:
+        return None
+    message = task['args'][0]
+    if not isinstance(message, dict) or message.get('method') not in FORWARDED_MESSAGES:
+        return None
+    return {'method': message['method'], 'message': message.get('message')}
+
+
+def handle_published_event(event):
+    """
+    Handle broadcast or replay event from the process owning the node.
+    :param event: list event, see pubsub
+    :return:
+    """
+    kind = event[0]
+    if kind == 'broadcast':
+        VectorSocketHandler.update_cache(event[1])
+        VectorSocketHandler.broadcast(event[1])
+    elif kind == 'replay':
+        for waiter in VectorSocketHandler.waiters:
+            waiter.start_replay()
+
+
+def publish(message):
+    """
+    Send committed message to node clients.
+    :param message: message to be sent
+    :return:
+    """
+    VectorSocketHandler.update_cache(message)
+    VectorSocketHandler.send_updates(message)
+
+
+# Gauges read when metrics are requested
+metrics.registry.gauge('queue_depth', 'Tasks in the outward queue', lambda: node.queue.qsize())
+metrics.registry.gauge('queue_capacity', 'Capacity of the outward queue', lambda: node.queue.maxsize)
+metrics.registry.counter_function('queue_overflow_total',
+                                  'Tasks over the outward queue capacity by what was done with them',
+                                  lambda: dict(((outcome, ), node.queue_stats()[outcome])
+                                               for outcome in ('rejected', 'dropped', 'coalesced', 'forced')),
+                                  ('outcome', ))
+metrics.registry.gauge('heartbeat_phi', 'Failure detector suspicion level of predecessor',
+                       lambda: node.detector.phi(time.time()))
+metrics.registry.gauge('heartbeat_interval_mean_seconds', 'Mean time between arrivals from predecessor',
+                       lambda: node.detector.stats()[0])
+metrics.registry.gauge('heartbeat_interval_std_seconds', 'Standard deviation of time between arrivals from predecessor',
+                       lambda: node.detector.stats()[1])
+metrics.registry.gauge('log_entries', 'Entries in the message log including holes', lambda: len(node.messages))
+metrics.registry.gauge('log_bytes', 'Approximate memory used by the message log', lambda: node.messages.size_bytes())
+metrics.registry.gauge('websocket_clients', 'Websocket clients connected to this process',
+                       lambda: len(VectorSocketHandler.waiters))
+metrics.registry.counter_function('websocket_dropped_frames_total',
+                                  'Frames dropped from slow websocket clients of this process',
+                                  lambda: VectorSocketHandler.dropped)
+metrics.registry.counter_function('websocket_evicted_clients_total',
+                                  'Slow websocket clients of this process disconnected',
+                                  lambda: VectorSocketHandler.evicted)
+metrics.registry.counter_function('pubsub_evicted_subscribers_total',
+                                  'Workers and observers disconnected for falling behind the board',
+                                  lambda: sum(publisher.evicted for publisher in VectorSocketHandler.publishers))
+
+
 # http://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib/166520#166520
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -412,45 +1410,214 @@ if __name__ == '__main__':
     parser.add_argument('--host', default=get_ip(),
                         help='Set hostname')
     parser.add_argument('--ssl', action="store_true")
+    parser.add_argument('--tornado-rest', action="store_true",
+                        help='Serve ring API on the Tornado IOLoop instead of a Flask server thread')
+    parser.add_argument('--prewarm', action="store_true",
+                        help='Open keep-alive connection to a new follower before the first message')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Maximum messages per ring frame. 1 disables batching')
+    parser.add_argument('--batch-window', type=float, default=0.01,
+                        help='Seconds to wait for more messages before sending a batch frame')
+    parser.add_argument('--async-transport', action="store_true",
+                        help='Send ring frames without blocking, as coroutines on the IOLoop')
+    parser.add_argument('--in-flight', type=int, default=4,
+                        help='Maximum ring frames in flight to the follower with --async-transport. The limit is '
+                             'across lanes: frames of one lane, like all persistent frames, go one at a time')
+    parser.add_argument('--ring-only', action="store_true",
+                        help='Propagate new messages hop by hop instead of sending them straight to the leader')
+    parser.add_argument('--election', choices=(ELECTION_RING, ELECTION_VIEW), default=ELECTION_RING,
+                        help='Vote leader around the ring or choose it from the membership view')
+    parser.add_argument('--dissemination', choices=(DISSEMINATION_RING, DISSEMINATION_TREE), default=DISSEMINATION_RING,
+                        help='Spread persistent messages around the ring or down a spanning tree from the leader')
+    parser.add_argument('--fanout', type=int, default=2,
+                        help='Children per node with --dissemination tree')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='Seconds between heartbeats when there is no other ring traffic')
+    parser.add_argument('--repair-after', type=int, default=3,
+                        help='Heartbeats in a row the follower has to miss before it is spliced out of the ring')
+    parser.add_argument('--phi-threshold', type=float, default=PHI_THRESHOLD,
+                        help='Failure detector suspicion level that makes node panic. With the default and 0.25 s '
+                             'heartbeats, a stopped predecessor is suspected about 0.83 s after its last heartbeat')
+    parser.add_argument('--data-dir', default=None,
+                        help='Directory for durable message log. Messages are kept only in memory if not set')
+    parser.add_argument('--max-log-gap', type=int, default=MAX_GAP,
+                        help='Missing entries a message can leave before it in the message log. Messages with '
+                             'sequence numbers further beyond the end of the log are refused')
+    parser.add_argument('--queue-size', type=int, default=10,
+                        help='Capacity of the outward message queue')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_REJECT,
+                        help='What to do with new messages when the outward queue is full')
+    parser.add_argument('--packed', action="store_true",
+                        help='Send ring frames in packed binary encoding. Peers that refuse them get json')
+    parser.add_argument('--simplify-tolerance', type=float, default=simplify.TOLERANCE,
+                        help='Pixels a freehand stroke may deviate from the drawn points after simplification')
+    parser.add_argument('--quantum', type=float, default=simplify.QUANTUM,
+                        help='Grid in pixels that freehand stroke points are snapped to')
+    parser.add_argument('--no-tiles', action="store_true",
+                        help='Do not serve board tiles. Page replays the whole history instead')
+    parser.add_argument('--tile-threads', type=int, default=2,
+                        help='Threads rendering board tiles')
+    parser.add_argument('--client-queue', type=int, default=CLIENT_QUEUE_LIMIT,
+                        help='Frames a websocket client can fall behind before slow client policy applies')
+    parser.add_argument('--slow-client', choices=SLOW_POLICIES, default=SLOW_DISCONNECT,
+                        help='Disconnect websocket clients that fall behind or drop their oldest frames')
+    parser.add_argument('--trace-rate', type=float, default=0.0,
+                        help='Share of new messages and elections that carry hop trace around the ring, 0 to 1')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes serving websocket clients. First one owns the node, others replicate its '
+                             'board. /api/metrics covers only the owner process')
+    parser.add_argument('--publish-buffer', type=int, default=MAX_SUBSCRIBER_BUFFER,
+                        help='Bytes of events a worker process can fall behind before it is disconnected. It '
+                             'subscribes again and gets the whole board')
+    parser.add_argument('--publish-port', type=int, default=None,
+                        help='Port the board is published on for observers. Not published if not set')
+    parser.add_argument('--observer-buffer', type=int, default=OBSERVER_BUFFER,
+                        help='Bytes of events an observer can fall behind before it is disconnected, so a slow or '
+                             'stalled observer cannot exhaust the memory of the ring member')
+    parser.add_argument('--publish-host', default='127.0.0.1',
+                        help='Address the board is published on. Subscribers are not authenticated, so use an '
+                             'interface only observers can reach')
+    parser.add_argument('--observe', nargs='+', default=None, metavar='HOST:PORT',
+                        help='Serve clients from the board of ring members publishing on these addresses, tried in '
+                             'turn, without joining the ring. Strokes are forwarded to the member')
 
     args = parser.parse_args()
+    observe_addresses = []
+    for address in args.observe or []:
+        host, _, port = address.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error("Observed address must be HOST:PORT, got %s" % address)
+        observe_addresses.append((host, int(port)))
+    if args.observe and args.workers > 1:
+        parser.error("Observer runs in one process")
 
     # Logging settings
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+    # Worker processes share the websocket port and get the board from the owner over a local socket.
+    # Sockets are bound and processes forked before anything creates an IOLoop or a thread.
+    socket_sockets = None
+    publish_sockets = None
+    worker = False
+    if args.workers > 1:
+        socket_sockets = tornado.netutil.bind_sockets(args.socketport)
+        publish_sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        publish_port = publish_sockets[0].getsockname()[1]
+        worker = tornado.process.fork_processes(args.workers) > 0
+    # Workers and observers serve clients from a replica of the board and never join the ring
+    replica = worker or bool(observe_addresses)
+
     prefix = ""
     if args.ssl:
         prefix = 'https://'
     else:
         prefix = 'http://'
-    node = Node(host=prefix + args.host + ":" + str(args.restport), port=args.restport)
+    node = Node(host=prefix + args.host + ":" + str(args.restport), port=args.restport,
+                queue_size=args.queue_size, overflow=args.overflow)
     node.secure = args.ssl
+    node.prewarm = args.prewarm
+    node.direct_submit = not args.ring_only
+    node.election = args.election
+    node.dissemination = args.dissemination
+    node.fanout = args.fanout
+    node.repair_after = args.repair_after
+    node.messages.max_gap = args.max_log_gap
+    node.committed = publish
+    node.joined = ring_joined
+    node.caught_up = ring_caught_up
+    node.detector = PhiAccrualDetector(first_interval=args.heartbeat_interval)
+    node.packed = args.packed
+    node.trace_rate = args.trace_rate
     logging.info("The client is hosted on %s:%s", args.host, args.socketport)
+    if args.async_transport and not replica:
+        node.transport = AsyncTransport(tornado.ioloop.IOLoop.current(), args.in_flight, node.timeout)
+        node.transport.on_delivered = node.mark_sent
+        node.transport.packs = node.packs
+        node.transport.on_refused = node.refuse_packed
+        node.transport.on_posted = node.record_post
+
+    if replica:
+        # Node of a worker or observer never joins the ring. It holds the replica of the owner's log.
+        if worker:
+            upstream_addresses = [('127.0.0.1', publish_port)]
+        else:
+            upstream_addresses = observe_addresses
+            VectorSocketHandler.ring_commands = False
+            logging.info("NODE: Observing %s", ", ".join("%s:%d" % address for address in observe_addresses))
+        VectorSocketHandler.upstream = Subscriber(tornado.ioloop.IOLoop.current(), node.messages,
+                                                  upstream_addresses)
+        VectorSocketHandler.upstream.on_event = handle_published_event
+        VectorSocketHandler.upstream.start()
+
+    # Durable message log
+    if args.data_dir and not replica:
+        storage = WriteAheadLog(args.data_dir)
+        storage.recover(node.messages)
+        node.index.rebuild(node.messages)
+        node.messages.listeners.append(storage)
+        tornado.ioloop.PeriodicCallback(storage.sync, storage.fsync_interval * 1000).start()
+
+    # Board tiles need numpy
+    if not args.no_tiles:
+        if tiles.numpy is None:
+            logging.warning("NODE: numpy is not installed. Tiles are disabled.")
+        else:
+            TileHandler.pyramid = tiles.TilePyramid(node.messages, node.index)
+            node.messages.listeners.append(TileHandler.pyramid)
+            for _ in range(max(1, args.tile_threads)):
+                renderer = TileRenderer(TileHandler.pyramid, TileHandler.renders, tornado.ioloop.IOLoop.current())
+                renderer.daemon = True
+                renderer.start()
 
     # Setup threading
-    handler = QueueHandler()
-    apiThread = Rest()
-    heartbeat = Heartbeat()
-
-    handler.daemon = True
-    handler.start()
-    heartbeat.daemon = True
-    heartbeat.start()
-    apiThread.daemon = True
-    apiThread.start()
+    if not replica:
+        handler = QueueHandler(args.batch_size, args.batch_window)
+        heartbeat = Heartbeat(args.heartbeat_interval, args.phi_threshold)
+
+        handler.daemon = True
+        handler.start()
+        heartbeat.start()
+        if not args.tornado_rest:
+            apiThread = Rest()
+            apiThread.daemon = True
+            apiThread.start()
+
+    # Board is published to local workers and to observers
+    publishers = []
+    if publish_sockets is not None and not worker:
+        publishers.append((publish_sockets, handle_subscriber_request, args.publish_buffer))
+    if args.publish_port is not None and not replica:
+        publishers.append((tornado.netutil.bind_sockets(args.publish_port, args.publish_host), handle_observer_request,
+                           args.observer_buffer))
+    for sockets, on_request, max_buffer in publishers:
+        publisher = Publisher(tornado.ioloop.IOLoop.current(), node.messages, max_buffer)
+        publisher.on_request = on_request
+        publisher.add_sockets(sockets)
+        node.messages.listeners.append(publisher)
+        VectorSocketHandler.publishers.append(publisher)
 
     # Setup Tornado
-    app = Vectors()
+    VectorSocketHandler.io_loop = tornado.ioloop.IOLoop.current()
+    VectorSocketHandler.queue_limit = args.client_queue
+    VectorSocketHandler.slow_policy = args.slow_client
+    VectorSocketHandler.tolerance = args.simplify_tolerance
+    VectorSocketHandler.quantum = args.quantum
+    ssl_options = None
     if node.secure:
-        app.listen(args.socketport, ssl_options={
-                "certfile": os.path.join(os.path.dirname(__file__), "../cert.crt"),
-                "keyfile": os.path.join(os.path.dirname(__file__), "../key.key")
-            })
+        ssl_options = {
+            "certfile": os.path.join(os.path.dirname(__file__), "../cert.crt"),
+            "keyfile": os.path.join(os.path.dirname(__file__), "../key.key")
+        }
+    if socket_sockets is None:
+        Vectors().listen(args.socketport, ssl_options=ssl_options)
     else:
-        app.listen(args.socketport)
+        tornado.httpserver.HTTPServer(Vectors(), ssl_options=ssl_options).add_sockets(socket_sockets)
+    if args.tornado_rest and not replica:
+        RingApi().listen(args.restport, ssl_options=ssl_options)
     try:
         tornado.ioloop.IOLoop.current().start()
     except KeyboardInterrupt:
-        node.disconnect(node.host, node.get_follower())
+        if not replica:
+            node.disconnect(node.host, node.get_follower())
         sys.exit()
 
@@ -0,0 +1,458 @@
+import json
+import logging
+import threading
+from array import array
+
+# Holes a stored message can leave before it by default. Each hole takes about 40 bytes.
+MAX_GAP = 1000000
+
+# Headers of streamed catch-up responses
+START_HEADER = 'X-Log-Start' # Sequence number of the first entry in the sender's log
+LAST_HEADER = 'X-Log-Last' # Sequence number of the last entry in the sender's log
+
+# Entry kinds
+KIND_HOLE = 0 # Not received yet
+KIND_LINE = 1 # Line stored in coordinate columns
+KIND_OTHER = 2 # Any other message stored as it is
+KIND_POLYLINE = 3 # Polyline stored in point columns
+
+
+def _number(value):
+    """
+    Give whole floats back as ints, so messages look the same as before storing.
+    """
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+def _is_clean(message):
+    """
+    Check whether message is clean {'method':'clean', 'message':{'x', 'y'}}.
+    """
+    try:
+        return message['method'] == 'clean'
+    except (KeyError, TypeError):
+        return False
+
+
+def _is_line(message):
+    """
+    Check that message is plain line {'method':'line', 'message':{'start':{'x','y'}, 'end':{'x','y'}}} that can be
+    stored in columns without losing anything.
+    """
+    try:
+        if len(message) != 2 or message['method'] != 'line':
+            return False
+        line = message['message']
+        if len(line) != 2:
+            return False
+        for point in (line['start'], line['end']):
+            if len(point) != 2:
+                return False
+            for coordinate in (point['x'], point['y']):
+                if isinstance(coordinate, bool) or not isinstance(coordinate, (int, long, float)):
+                    return False
+    except (KeyError, TypeError):
+        return False
+    return True
+
+
+def _polyline_coordinates(message):
+    """
+    Flat coordinates of plain polyline {'method':'polyline', 'message':{'points':[[x, y], ...]}} that can be
+    stored in float columns without losing anything. Points snapped to the whole pixel grid always can.
+    :return: array('f') of x0, y0, x1, y1, ..., None if message cannot be stored in point columns
+    """
+    try:
+        if len(message) != 2 or message['method'] != 'polyline':
+            return None
+        polyline = message['message']
+        if len(polyline) != 1:
+            return None
+        coordinates = []
+        for point in polyline['points']:
+            if not isinstance(point, (list, tuple)) or len(point) != 2:
+                return None
+            for coordinate in point:
+                if isinstance(coordinate, bool) or not isinstance(coordinate, (int, long, float)):
+                    return None
+                coordinates.append(coordinate)
+        packed = array('f', coordinates)
+    except (KeyError, TypeError, OverflowError):
+        return None
+    if packed.tolist() != coordinates:
+        return None
+    return packed
+
+
+class MessageLog(object):
+    """
+    Append-only message log with monotonic sequence numbers. Line coordinates are kept in typed array columns
+    instead of nested dicts, and polyline points in one flat coordinate array with offset and point count
+    columns. Other messages are kept as they are. Offers dict-like access, so it can be used where the old
+    {id: message} dict was.
+
+    Committed clean is a checkpoint: entries before it are discarded, so the log always starts at the latest
+    clean and replay or catch-up never contains lines that are already erased.
+
+    Listeners get on_append(message_id, message) for every stored message, on_compact(start) when entries
+    before start are discarded and on_clear() when the log is cleared.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.start = 1 # Sequence number of the first entry
+        self.kinds = array('B')
+        self.start_x = array('d')
+        self.start_y = array('d')
+        self.end_x = array('d')
+        self.end_y = array('d')
+        self.point_offset = array('I') # Index of the first coordinate of polyline in points
+        self.point_count = array('I') # Points of polyline
+        self.points = array('f') # Polyline coordinates x0, y0, x1, y1, ... Not in entry order.
+        self.others = {} # Other messages by sequence number
+        self.max_gap = MAX_GAP # Holes a stored message can leave before it. Messages further away are refused.
+
+    def next_id(self):
+        """
+        Sequence number of the next appended entry.
+        :return: int
+        """
+        return self.start + len(self.kinds)
+
+    def contiguous_id(self):
+        """
+        Sequence number of the last entry before the first hole. Entries up to it are known to be complete.
+        :return: int, start - 1 if the first entry is missing
+        """
+        with self.lock:
+            try:
+                return self.start + self.kinds.index(KIND_HOLE) - 1
+            except ValueError:
+                return self.last_id()
+
+    def last_id(self):
+        """
+        Sequence number of the last entry.
+        :return: int, start - 1 if log is empty
+        """
+        return self.next_id() - 1
+
+    def append(self, message):
+        """
+        Append message to the end of the log.
+        :param message: dict message
+        :return: int sequence number of the message
+        """
+        with self.lock:
+            message_id = self.next_id()
+            self[message_id] = message
+            return message_id
+
+    def _push(self, message_id, message):
+        coordinates = None
+        if _is_line(message):
+            line = message['message']
+            self.kinds.append(KIND_LINE)
+            self.start_x.append(line['start']['x'])
+            self.start_y.append(line['start']['y'])
+            self.end_x.append(line['end']['x'])
+            self.end_y.append(line['end']['y'])
+        else:
+            coordinates = _polyline_coordinates(message)
+            if coordinates is not None:
+                self.kinds.append(KIND_POLYLINE)
+            else:
+                self.kinds.append(KIND_OTHER if message is not None else KIND_HOLE)
+            for column in (self.start_x, self.start_y, self.end_x, self.end_y):
+                column.append(0)
+            if message is not None and coordinates is None:
+                self.others[message_id] = message
+        if coordinates is not None:
+            self.point_offset.append(len(self.points))
+            self.point_count.append(len(coordinates) // 2)
+            self.points.extend(coordinates)
+        else:
+            self.point_offset.append(0)
+            self.point_count.append(0)
+        if message is not None:
+            for listener in self.listeners:
+                listener.on_append(message_id, message)
+
+    def _replace(self, message_id, message):
+        index = message_id - self.start
+        self.others.pop(message_id, None)
+        if _is_line(message):
+            line = message['message']
+            self.kinds[index] = KIND_LINE
+            self.start_x[index] = line['start']['x']
+            self.start_y[index] = line['start']['y']
+            self.end_x[index] = line['end']['x']
+            self.end_y[index] = line['end']['y']
+        else:
+            coordinates = _polyline_coordinates(message)
+            if coordinates is not None:
+                # Stored after the others. Points of a replaced polyline are left until the next compaction.
+                self.kinds[index] = KIND_POLYLINE
+                self.point_offset[index] = len(self.points)
+                self.point_count[index] = len(coordinates) // 2
+                self.points.extend(coordinates)
+            else:
+                self.kinds[index] = KIND_OTHER
+                self.others[message_id] = message
+        for listener in self.listeners:
+            listener.on_append(message_id, message)
+
+    def __setitem__(self, message_id, message):
+        """
+        Store message with sequence number decided by the leader. Missing sequence numbers before it are
+        left as holes until they arrive. Message more than max_gap entries beyond the end of the log is refused,
+        so a bad sequence number from a peer cannot make the log fill a huge gap.
+        """
+        message_id = int(message_id)
+        with self.lock:
+            if message_id < self.start:
+                # Erased by later clean
+                return
+            if _is_clean(message) and message_id > self.start:
+                self._compact(message_id)
+            if message_id - self.next_id() > self.max_gap:
+                logging.warning("NODE: Refused message %d, %d entries beyond the end of the log",
+                                message_id, message_id - self.next_id())
+                return
+            while self.next_id() < message_id:
+                self._push(self.next_id(), None)
+            if message_id == self.next_id():
+                self._push(message_id, message)
+            else:
+                self._replace(message_id, message)
+
+    def _compact(self, start):
+        """
+        Discard entries before start.
+        :param start: int sequence number of the new first entry. Can be beyond the end of the log.
+        :return:
+        """
+        drop = min(start - self.start, len(self.kinds))
+        for column in self._entry_columns():
+            del column[:drop]
+        self._pack_points()
+        self.others = dict((message_id, message) for message_id, message in self.others.iteritems()
+                           if message_id >= start)
+        self.start = start
+        for listener in self.listeners:
+            listener.on_compact(start)
+
+    def __getitem__(self, message_id):
+        message_id = int(message_id)
+        with self.lock:
+            index = message_id - self.start
+            if index < 0 or index >= len(self.kinds):
+                raise KeyError(message_id)
+            kind = self.kinds[index]
+            if kind == KIND_LINE:
+                return {'method': 'line', 'message': {
+                    'start': {'x': _number(self.start_x[index]), 'y': _number(self.start_y[index])},
+                    'end': {'x': _number(self.end_x[index]), 'y': _number(self.end_y[index])}}}
+            if kind == KIND_POLYLINE:
+                offset = self.point_offset[index]
+                coordinates = self.points[offset:offset + 2 * self.point_count[index]]
+                return {'method': 'polyline', 'message': {
+                    'points': [[_number(x), _number(y)] for x, y in zip(coordinates[::2], coordinates[1::2])]}}
+            if kind == KIND_OTHER:
+                return self.others[message_id]
+            raise KeyError(message_id)
+
+    def get(self, message_id, default=None):
+        try:
+            return self[message_id]
+        except KeyError:
+            return default
+
+    def __contains__(self, message_id):
+        return self.get(message_id) is not None
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def range(self, first=None, last=None):
+        """
+        Iterate entries between sequence numbers. Holes are skipped.
+        :param first: int first sequence number, defaults to start of the log
+        :param last: int last sequence number, defaults to end of the log
+        :return: iterator of (sequence number, message)
+        """
+        if first is None or first < self.start:
+            first = self.start
+        if last is None or last > self.last_id():
+            last = self.last_id()
+        for message_id in xrange(first, last + 1):
+            message = self.get(message_id)
+            if message is not None:
+                yield message_id, message
+
+    def select(self, message_ids):
+        """
+        Iterate entries with given sequence numbers. Holes and discarded entries are skipped.
+        :param message_ids: iterable of int sequence numbers
+        :return: iterator of (sequence number, message)
+        """
+        for message_id in message_ids:
+            message = self.get(message_id)
+            if message is not None:
+                yield message_id, message
+
+    def iteritems(self):
+        return self.range()
+
+    def items(self):
+        return list(self.range())
+
+    def keys(self):
+        return [message_id for message_id, _ in self.range()]
+
+    def values(self):
+        return [message for _, message in self.range()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def to_dict(self, first=None, last=None):
+        """
+        Dict view of the log.
+        :return: dict {sequence number: message}
+        """
+        return dict(self.range(first, last))
+
+    def load(self, messages):
+        """
+        Store messages from a dict view, for example one received from another node.
+        :param messages: dict {sequence number: message}. Keys can be strings like in json.
+        :return:
+        """
+        for message_id in sorted(messages, key=int):
+            self[message_id] = messages[message_id]
+
+    def _entry_columns(self):
+        return (self.kinds, self.start_x, self.start_y, self.end_x, self.end_y, self.point_offset, self.point_count)
+
+    def columns(self):
+        """
+        Typed array columns: one value per entry in each, then the flat polyline coordinates.
+        :return: tuple of arrays
+        """
+        return self._entry_columns() + (self.points, )
+
+    def _pack_points(self):
+        """
+        Rewrite polyline coordinates in entry order, without points of discarded or replaced polylines.
+        """
+        points = array('f')
+        for index, kind in enumerate(self.kinds):
+            if kind == KIND_POLYLINE:
+                offset = self.point_offset[index]
+                self.point_offset[index] = len(points)
+                points.extend(self.points[offset:offset + 2 * self.point_count[index]])
+        self.points = points
+
+    def size_bytes(self):
+        """
+        Approximate memory used by the entries: size of the columns and json size of other messages. Goes through
+        other messages, so it is meant for occasional use like metrics.
+        :return: int bytes
+        """
+        with self.lock:
+            size = sum(column.itemsize * len(column) for column in self.columns())
+            others = self.others.values()
+        return size + sum(len(json.dumps(message)) for message in others)
+
+    def clear(self):
+        """
+        Remove all entries.
+        :return:
+        """
+        with self.lock:
+            self.start = 1
+            for column in self.columns():
+                del column[:]
+            self.others = {}
+            for listener in self.listeners:
+                listener.on_clear()
+
+    def snapshot(self):
+        """
+        Copy of the log state for compact snapshots.
+        :return: (start, list of column arrays, dict of other messages)
+        """
+        with self.lock:
+            return self.start, [column[:] for column in self.columns()], dict(self.others)
+
+    def restore(self, start, columns, others):
+        """
+        Replace log state with a snapshot. Listeners are not notified.
+        :param start: int sequence number of the first entry
+        :param columns: list of column arrays in columns() order. Snapshots written before polyline columns have
+        only the line columns.
+        :param others: dict of other messages by sequence number
+        :return:
+        """
+        columns = list(columns)
+        if len(columns) == 5:
+            count = len(columns[0])
+            columns += [array('I', [0]) * count, array('I', [0]) * count, array('f')]
+        with self.lock:
+            self.start = start
+            (self.kinds, self.start_x, self.start_y, self.end_x, self.end_y, self.point_offset, self.point_count,
+             self.points) = columns
+            self.others = dict((int(message_id), message) for message_id, message in others.iteritems())
+
+
+def iter_chunks(log, since=0, chunk_size=1000, message_ids=None):
+    """
+    Serialize log entries after since as newline delimited json [id, message] lines, chunk_size entries at
+    a time, so large logs can be streamed without building the whole response.
+    :param log: MessageLog
+    :param since: int sequence number after which entries are sent
+    :param chunk_size: int entries per chunk
+    :param message_ids: optional sorted list of sequence numbers to send instead of the whole log
+    :return: iterator of strings
+    """
+    if message_ids is None:
+        entries = log.range(since + 1)
+    else:
+        entries = log.select(message_id for message_id in message_ids if message_id > since)
+    lines = []
+    for message_id, message in entries:
+        lines.append(json.dumps([message_id, message]))
+        if len(lines) >= chunk_size:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def log_headers(log):
+    """
+    Headers telling the receiver of a catch-up stream which part of the history the sender has.
+    :param log: MessageLog
+    :return: dict of headers
+    """
+    with log.lock:
+        return {START_HEADER: str(log.start), LAST_HEADER: str(log.last_id())}
+
+
+def shares_prefix(log, since, start, last):
+    """
+    Check that a peer log has the history of log up to since, so the entries after since can be fetched from it.
+    Peer that compacted at a clean after since sends the clean, so log is compacted the same way. Peer of
+    another ring, or of a ring that was reset, starts at a clean that log does not have or ends before since.
+    :param log: MessageLog
+    :param since: int sequence number up to which log is complete
+    :param start: int sequence number of the first entry in the peer log
+    :param last: int sequence number of the last entry in the peer log
+    :return: bool
+    """
+    if last < since:
+        return False
+    return start == log.start or start > since
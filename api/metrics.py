@@ -0,0 +1,226 @@
+"""
+In-memory metrics of the node. Counters and histograms are updated on the hot paths, gauges and totals the
+owner counts itself are read when metrics are requested. Metrics are rendered as json or Prometheus text format.
+
+Recording is one lock and a few additions, so it can be left on in production.
+"""
+import bisect
+import json
+import threading
+
+# Default histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label_text(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for name, value in pairs)
+
+
+def _number_text(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """
+    Base of metrics. Values are kept per tuple of label values.
+    """
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        :param name: String metric name
+        :param description: String help text
+        :param labels: tuple of label names
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {} # Values by tuple of label values
+
+    def samples(self):
+        """
+        Current values.
+        :return: list of (label values, value)
+        """
+        with self.lock:
+            return sorted(self.values.items())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increase counter.
+        :param amount: number to add
+        :param labels: tuple of label values
+        :return:
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a function when metrics are requested.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description, function, labels=()):
+        """
+        :param function: callable returning a number, or a dict of numbers by tuple of label values
+        """
+        super(Gauge, self).__init__(name, description, labels)
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception:
+            # Owner of the value is not set up, for example node before startup
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return sorted(value.items())
+        return [((), value)]
+
+
+class CounterFunction(Gauge):
+    """
+    Counter read from a function when metrics are requested, for totals that the owner counts itself.
+    Function must return values that only grow.
+    """
+    kind = 'counter'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        """
+        :param buckets: sorted tuple of bucket upper bounds
+        """
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """
+        Record observation.
+        :param value: float observed value, for example seconds
+        :param labels: tuple of label values
+        :return:
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Count per bucket, count over the last bucket, sum, maximum
+                state = self.values[labels] = [[0] * len(self.buckets), 0, 0.0, 0.0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            else:
+                state[1] += 1
+            state[2] += value
+            state[3] = max(state[3], value)
+
+    def samples(self):
+        """
+        :return: list of (label values, dict with cumulative 'buckets', 'count', 'sum' and 'max')
+        """
+        samples = []
+        with self.lock:
+            for labels, (counts, over, total, largest) in sorted(self.values.items()):
+                cumulative = []
+                running = 0
+                for count in counts:
+                    running += count
+                    cumulative.append(running)
+                samples.append((labels, {'buckets': zip(self.buckets, cumulative), 'count': running + over,
+                                         'sum': total, 'max': largest}))
+        return samples
+
+
+class Registry(object):
+    """
+    Set of metrics, rendered together.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = [] # In registration order
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics = [old for old in self.metrics if old.name != metric.name] + [metric]
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, function, labels=()):
+        return self.register(Gauge(name, description, function, labels))
+
+    def counter_function(self, name, description, function, labels=()):
+        return self.register(CounterFunction(name, description, function, labels))
+
+    def histogram(self, name, description, labels=(), buckets=BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def to_dict(self):
+        """
+        All metrics as json serializable dict.
+        :return: dict {name: {'type', 'help', 'samples': [{'labels': {...}, 'value' or histogram fields}]}}
+        """
+        result = {}
+        for metric in list(self.metrics):
+            samples = []
+            for labels, value in metric.samples():
+                sample = {'labels': dict(zip(metric.labels, labels))}
+                if metric.kind == 'histogram':
+                    sample.update(value)
+                    sample['buckets'] = [[bound, count] for bound, count in value['buckets']]
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            result[metric.name] = {'type': metric.kind, 'help': metric.description, 'samples': samples}
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self):
+        """
+        All metrics in Prometheus text exposition format.
+        :return: String
+        """
+        lines = []
+        for metric in list(self.metrics):
+            lines.append('# HELP %s %s' % (metric.name, metric.description.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for labels, value in metric.samples():
+                if metric.kind == 'histogram':
+                    for bound, count in value['buckets']:
+                        lines.append('%s_bucket%s %d' % (metric.name, _label_text(metric.labels, labels,
+                                                                                  [('le', _number_text(bound))]),
+                                                         count))
+                    lines.append('%s_bucket%s %d' % (metric.name, _label_text(metric.labels, labels, [('le', '+Inf')]),
+                                                     value['count']))
+                    lines.append('%s_sum%s %s' % (metric.name, _label_text(metric.labels, labels),
+                                                  _number_text(value['sum'])))
+                    lines.append('%s_count%s %d' % (metric.name, _label_text(metric.labels, labels), value['count']))
+                else:
+                    lines.append('%s%s %s' % (metric.name, _label_text(metric.labels, labels), _number_text(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
@@ -1,15 +1,115 @@
+import json
 import logging
 import requests as ring
+from requests.adapters import HTTPAdapter
 import random
-from Queue import Queue
+import math
+import threading
+import time
+from Queue import Queue, Full
+
+import codec
+import metrics
+import tracing
+from detector import PhiAccrualDetector
+from messagelog import MessageLog, START_HEADER, LAST_HEADER, shares_prefix
+from spatial import GridIndex
+
+# Keep-alive connections kept open per ring peer
+POOL_CONNECTIONS = 1
+POOL_MAXSIZE = 4
+
+# Outward queue overflow policies
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE)
+
+# How leader is chosen
+ELECTION_RING = 'ring'
+ELECTION_VIEW = 'view'
+
+# How leader spreads persistent messages
+DISSEMINATION_RING = 'ring'
+DISSEMINATION_TREE = 'tree'
+
+# Node metrics
+RING_POST_SECONDS = metrics.registry.histogram('ring_post_seconds', 'Time of ring posts to peers by api url',
+                                               ('url', ))
+RING_POST_FAILURES = metrics.registry.counter('ring_post_failures_total',
+                                              'Ring posts that failed or were not accepted, by api url', ('url', ))
+ELECTIONS = metrics.registry.counter('elections_total', 'Leader elections started by this node')
+ELECTION_SECONDS = metrics.registry.histogram('election_seconds',
+                                              'Time from starting leader election to knowing the leader')
+HEARTBEAT_INTERVAL_SECONDS = metrics.registry.histogram('heartbeat_interarrival_seconds',
+                                                        'Time between messages or heartbeats from predecessor')
+
+# Queue tasks that can be merged into batch tasks
+BATCH_METHODS = {
+    'propagate_message': 'propagate_messages',
+    'propagate_messages': 'propagate_messages',
+    'persist_message': 'persist_messages',
+    'persist_messages': 'persist_messages',
+}
+
+
+def coalesce_tasks(tasks):
+    """
+    Merge consecutive propagate and persist tasks into batch tasks. Order of the messages is kept, propagated
+    messages are only merged with messages from the same origin and persisted messages with messages going
+    to the same subtree.
+    Merged task keeps the first hop trace of its tasks.
+    :param tasks: list of queue tasks {'method': node_method, 'args': arguments}
+    :return: list of queue tasks
+    """
+    merged = []
+    for task in tasks:
+        method = BATCH_METHODS.get(task['method'])
+        if method is None:
+            merged.append(task)
+            continue
+        args = task['args']
+        # Batch and propagate tasks can have trace after their two arguments
+        trace = args[2] if len(args) > 2 else None
+        if task['method'] == method:
+            # Batch task: (items, origin or tree)
+            items = list(args[0])
+            key = (method, args[1] if len(args) > 1 else None)
+        elif method == 'propagate_messages':
+            # (message, origin)
+            items = [args[0]]
+            key = (method, args[1] if len(args) > 1 else None)
+        else:
+            # (message, message_id)
+            items = [tuple(args)]
+            key = (method, None)
+        if merged and merged[-1].get('key') == key:
+            merged[-1]['args'][0].extend(items)
+            merged[-1]['trace'] = merged[-1]['trace'] or trace
+        else:
+            merged.append({'method': method, 'args': (items,) + key[1:], 'key': key, 'trace': trace})
+    for task in merged:
+        task.pop('key', None)
+        trace = task.pop('trace', None)
+        if trace is not None:
+            task['args'] += (trace, )
+    return merged
+
 
 class Node(object):
-    def __init__(self, host, port=5000):
+    def __init__(self, host, port=5000, queue_size=10, overflow=OVERFLOW_REJECT):
         """
         Node-class initializer. Handles node data-handling and outward messaging.
         """
-        self.queue = Queue(10) # Outward message queue
-        self.messages = {} # Message log
+        self.queue = Queue(queue_size) # Outward message queue
+        self.overflow = overflow # What to do when outward queue is full
+        self.rejected = 0 # Tasks rejected because of full queue
+        self.dropped = 0 # Queued tasks dropped to make room for new ones
+        self.coalesced = 0 # Tasks merged to already queued tasks
+        self.forced = 0 # Ring tasks queued over the capacity
+        self.messages = MessageLog() # Message log
+        self.index = GridIndex() # Spatial index of the message log
+        self.messages.listeners.append(self.index)
         self.secure = False
 
         self.follower = None # Follower address
@@ -22,27 +122,294 @@ class Node(object):
         self.heartbeatUrl = "/api/heartbeat/"
 
         self.leader = None # Current leader
+        self.leader_host = None # Current leader address
+        self.direct_submit = True # Send new messages straight to the leader
+        self.members = [] # Replicated ring order as [address, uid] pairs
+        self.election = ELECTION_RING # Voting around the ring or choice from membership view
+        self.dissemination = DISSEMINATION_RING # Ring lap or spanning tree for persistent messages
+        self.fanout = 2 # Children per node in tree dissemination
+        self.committed = None # Callback for messages committed without the ring lap returning them
+        self.joined = None # Callback after this node joined a ring, before it catches up with the board
+        self.caught_up = None # Callback after this node caught up with the board of the ring it joined
         self.voting = False # In-voting process
+        self.election_started = None # Time when election this node started was started
         self.uid = random.randint(1,100000000) # Identifier for voting
 
         self.last_heartbeat = None # Last time heartbeat was received
+        self.predecessor = None # Address frames and heartbeats last arrived from
+        self.last_sent = 0 # Last time follower accepted a message
+        self.heartbeat_pending = False # Heartbeat task waiting in the queue
+        self.follower_misses = 0 # Consecutive heartbeats follower did not answer
+        self.repair_after = 3 # Missed heartbeats before follower is spliced out of the ring
+        self.detector = PhiAccrualDetector() # Failure detector for predecessor
         self.timeout = 0.5
 
+        self.sessions = {} # Keep-alive sessions per peer address
+        self.sessions_lock = threading.Lock()
+        self.prewarm = False # Open follower connection before the first message
+        self.transport = None # Non-blocking transport for ring frames. None sends blocking requests.
+        self.packed = False # Send ring frames packed with codec instead of json
+        self.json_peers = set() # Peers that did not accept packed frames
+        self.trace_rate = 0.0 # Share of new messages and elections that carry hop trace
+        self.latency = tracing.LatencyMap() # Per-hop latency from traces this node has received
+
     def reset_node(self):
         """
         Reset node so it's ready for next connection
         :return:
         """
         self.queue.queue.clear() # Outward message queue
-        self.messages = {} # Message log
+        self.messages.clear() # Message log. Cleared in place, so its listeners stay attached.
 
         self.follower = None # Follower address
 
         self.leader = None # Current leader
+        self.leader_host = None # Current leader address
+        self.members = [] # Replicated ring order as [address, uid] pairs
         self.voting = False # In-voting process
+        self.election_started = None # Time when election this node started was started
         self.uid = random.randint(1,100000000) # Identifier for voting
 
         self.last_heartbeat = None # Last time heartbeat was received
+        self.predecessor = None # Address frames and heartbeats last arrived from
+        self.detector.reset()
+
+        self.close_sessions()
+
+    def enqueue(self, task, force=False):
+        """
+        Put task to outward queue without blocking. If the queue is full, overflow policy decides whether
+        the task is rejected, the oldest queued propagate task of this node's clients is dropped, or the task is
+        merged to the last queued task.
+        :param task: dict {'method': node_method, 'args': arguments}
+        :param force: Queue the task even over the capacity. Used for ring tasks that cannot be lost, including
+        messages of other nodes' clients that are already on their way around the ring.
+        :return: True if task was queued, False if it was rejected
+        """
+        # Wait time in the queue is measured from here
+        task['queued'] = time.time()
+        try:
+            self.queue.put_nowait(task)
+            return True
+        except Full:
+            pass
+
+        queue = self.queue
+        with queue.mutex:
+            pending = queue.queue
+            if force:
+                pending.append(task)
+                queue.unfinished_tasks += 1
+                queue.not_empty.notify()
+                self.forced += 1
+                return True
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                for index, queued in enumerate(pending):
+                    # Messages from other nodes have origin set and are not dropped mid-ring
+                    if BATCH_METHODS.get(queued['method']) == 'propagate_messages' and \
+                            (len(queued['args']) < 2 or queued['args'][1] is None):
+                        del pending[index]
+                        pending.append(task)
+                        self.dropped += 1
+                        logging.warning("NODE: Queue full. Dropped message %s", queued)
+                        return True
+            elif self.overflow == OVERFLOW_COALESCE and pending:
+                merged = coalesce_tasks([pending[-1], task])
+                if len(merged) == 1:
+                    pending[-1] = merged[0]
+                    self.coalesced += 1
+                    return True
+            self.rejected += 1
+        logging.warning("NODE: Queue full. Rejected task %s", task)
+        return False
+
+    def queue_stats(self):
+        """
+        Outward queue saturation counters.
+        :return: dict of queue depth, capacity and overflow counters
+        """
+        return {
+            'depth': self.queue.qsize(),
+            'capacity': self.queue.maxsize,
+            'policy': self.overflow,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'forced': self.forced,
+        }
+
+    def get_session(self, peer):
+        """
+        Get keep-alive session for peer. Connections are pooled per peer, so consecutive ring hops
+        reuse the same TCP connection and TLS handshake.
+        :param peer: String Peer full address.
+        :return: requests.Session for the peer
+        """
+        with self.sessions_lock:
+            session = self.sessions.get(peer)
+            if session is None:
+                session = ring.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[peer] = session
+            return session
+
+    def close_session(self, peer):
+        """
+        Close pooled connections to peer.
+        :param peer: String Peer full address.
+        :return:
+        """
+        with self.sessions_lock:
+            session = self.sessions.pop(peer, None)
+        if session is not None:
+            session.close()
+
+    def close_sessions(self):
+        """
+        Close all pooled connections.
+        :return:
+        """
+        with self.sessions_lock:
+            sessions = self.sessions.values()
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+    def warm_session(self, peer):
+        """
+        Open connection to peer before the first real message needs it.
+        :param peer: String Peer full address.
+        :return: True on success, False on errors.
+        """
+        try:
+            self.get_session(peer).options(peer + self.heartbeatUrl, timeout=self.timeout)
+        except (ring.exceptions.ConnectionError, ring.exceptions.Timeout) as e:
+            logging.warning("NODE: Cannot warm up connection to %s.", peer)
+            return False
+        return True
+
+    def ring_post(self, peer, url, message=None, hop=False):
+        """
+        Post message to peer using its pooled session.
+        :param peer: String Peer full address.
+        :param url: String API url.
+        :param message: Json serializable message, or None for empty body.
+        :param hop: bool Send ring hop header even if peer is not the follower
+        :return: requests.Response
+        """
+        headers = {}
+        if hop or peer == self.follower:
+            # Tell follower that this is a ring hop, so it counts as a heartbeat
+            headers = self.hop_headers()
+        response = None
+        started = time.time()
+        try:
+            if message is not None and self.packs(peer + url):
+                response = self.get_session(peer).post(peer + url, data=codec.encode(message), timeout=self.timeout,
+                                                       headers=dict(headers, **{'Content-Type': codec.CONTENT_TYPE}))
+                if codec.refused(response.status_code, response.headers):
+                    self.refuse_packed(peer + url)
+                    response = None
+            if response is None:
+                response = self.get_session(peer).post(peer + url, json=message, headers=headers,
+                                                       timeout=self.timeout)
+        except Exception:
+            self.record_post(url, time.time() - started, False)
+            raise
+        self.record_post(url, time.time() - started, response.status_code < 300)
+        if peer == self.follower:
+            self.last_sent = time.time()
+            self.follower_misses = 0
+        return response
+
+    def record_post(self, url, seconds, delivered):
+        """
+        Record time and outcome of ring post for metrics.
+        :param url: String API url or full url
+        :param seconds: float Time the post took
+        :param delivered: bool False if post failed or peer did not accept it
+        :return:
+        """
+        for api_url in (self.messageUrl, self.connectionUrl, self.heartbeatUrl):
+            if url.endswith(api_url):
+                url = api_url
+                break
+        RING_POST_SECONDS.observe(seconds, (url, ))
+        if not delivered:
+            RING_POST_FAILURES.inc(labels=(url, ))
+
+    def packs(self, url):
+        """
+        Check whether frame to url is sent packed.
+        :param url: String Full url
+        :return: True if frame is packed
+        """
+        if not self.packed or not url.endswith(self.messageUrl):
+            return False
+        return url[:-len(self.messageUrl)] not in self.json_peers
+
+    def refuse_packed(self, url):
+        """
+        Record that peer did not accept packed frame. Frames to it are sent as json from now on.
+        :param url: String Full url of the refused frame
+        :return:
+        """
+        peer = url[:-len(self.messageUrl)]
+        if peer not in self.json_peers:
+            logging.warning("NODE: %s does not accept packed frames. Using json.", peer)
+            self.json_peers.add(peer)
+
+    def hop_headers(self):
+        """
+        Headers for messages sent to follower.
+        :return: dict of headers
+        """
+        return {'X-Ring-Hop': self.host}
+
+    def mark_sent(self, url):
+        """
+        Record that a message was delivered. Delivery to follower proves its liveness.
+        :param url: String Full url of the delivered message
+        :return:
+        """
+        if self.follower is not None and url.startswith(self.follower):
+            self.last_sent = time.time()
+            self.follower_misses = 0
+
+    def receive_trace(self, trace):
+        """
+        Record hops of traced frame and add arrival at this node, so the trace can go on with the frame.
+        :param trace: list trace of the received frame
+        :return: list trace to send on, None if trace was malformed
+        """
+        now = time.time()
+        try:
+            self.latency.record(trace, self.host, now)
+        except ValueError:
+            logging.warning("NODE: Malformed trace %r", trace)
+            return None
+        return tracing.arrive(trace, self.host, now)
+
+    def record_arrival(self, sender=None):
+        """
+        Record message or heartbeat from predecessor. Arrivals of a new predecessor start a new window in the
+        failure detector.
+        :param sender: String address of predecessor, or None if not known
+        :return:
+        """
+        now = time.time()
+        if sender is not None and sender != self.predecessor:
+            if self.predecessor is not None:
+                logging.info("HEARTBEAT: Predecessor changed from %s to %s", self.predecessor, sender)
+                self.detector.reset()
+                self.last_heartbeat = None
+            self.predecessor = sender
+        if self.last_heartbeat is not None:
+            HEARTBEAT_INTERVAL_SECONDS.observe(now - self.last_heartbeat)
+        self.last_heartbeat = now
+        self.detector.heartbeat(now)
 
     def set_uid(self, uid):
         """
@@ -67,7 +434,17 @@ class Node(object):
         :return: True on success
         """
         logging.debug("NODE: New follower: %s", host)
+        old_follower = self.follower
         self.follower = host
+        if host != old_follower:
+            self.follower_misses = 0
+        if old_follower is not None and old_follower != host:
+            self.close_session(old_follower)
+        if self.prewarm and host is not None and host != old_follower:
+            try:
+                self.queue.put_nowait({'method': 'warm_session', 'args': (host,)})
+            except Full:
+                pass
         return True
 
     def get_follower(self):
@@ -103,11 +480,63 @@ class Node(object):
         """
         return self.leader is self.uid
 
-    def leader_election(self, state, leader):
+    def adopt_leader(self, host, uid):
+        """
+        Set known leader.
+        :param host: String leader address
+        :param uid: Int leader UID
+        :return: True on success
+        """
+        self.leader = self.uid if host == self.host else uid
+        self.leader_host = host
+        self.voting = False
+        self.election_finished()
+        return True
+
+    def election_finished(self):
+        """
+        Record duration of election started by this node, now that the leader is known.
+        :return:
+        """
+        if self.election_started is not None:
+            ELECTION_SECONDS.observe(time.time() - self.election_started)
+            self.election_started = None
+
+    def elect(self, candidate=None):
+        """
+        Start leader election. With view election the leader is chosen from the membership view without
+        voting: current leader keeps leading while it is a member, a dead leader is replaced by the candidate,
+        and otherwise the biggest UID leads like in ring voting. The choice travels with the new view, so
+        no member is ever without a leader. Ring election votes around the ring.
+        :param candidate: String address preferred as leader if the current leader is gone
+        :return: True on success, False on errors
+        """
+        ELECTIONS.inc()
+        if self.election_started is None:
+            self.election_started = time.time()
+        if self.election != ELECTION_VIEW or self.host not in self.member_hosts():
+            trace = tracing.start(self.host) if tracing.sample(self.trace_rate) else None
+            return self.leader_election("election", 0, trace=trace)
+        uids = dict((host, uid) for host, uid in self.members)
+        if self.leader_host in uids:
+            leader_host = self.leader_host
+        elif candidate in uids:
+            leader_host = candidate
+        else:
+            leader_host = max(self.members, key=lambda member: member[1])[0]
+        self.adopt_leader(leader_host, uids[leader_host])
+        logging.debug("NODE: Leader chosen from membership view: %s", leader_host)
+        return self.send_frames([self.members_frame(self.host)])
+
+    def leader_election(self, state, leader, leader_host=None, members=None, trace=None):
         """
-        Leader election algorithm. Select node with biggest UID as new leader.
+        Leader election algorithm. Select node with biggest UID as new leader. Voting message of the winner
+        collects ring order on its lap, and the announcement replicates it to every member.
         :param state: String. Should be either "election" (currently voting) or "elected" (leader has been selected).
         :param leader: Int. Suggested or selected leader UID
+        :param leader_host: String. Address of the selected leader. Only used with "elected".
+        :param members: list of [address, uid] pairs visited by the suggested leader's message.
+        :param trace: list hop trace of the voting message, or None
         :return: False on problems/end, True on normal voting process.
         """
         leader = int(leader)
@@ -115,26 +544,35 @@ class Node(object):
         method = ""
         if state == "election":
             self.leader = None
+            self.leader_host = None
             logging.debug("NODE: Voting for leader. Current leader %s", leader)
             if leader > self.uid:
                 # Smaller UID. Not gonna lead
                 method = "election"
                 self.voting = True
+                members = (members or []) + [[self.host, self.uid]]
                 logging.debug("NODE: My uid is smaller %d. Current leader %d", self.uid, leader)
             elif leader < self.uid and not self.voting:
                 # Bigger UID. Might be a leader
                 method = "election"
                 self.voting = True
                 leader = self.uid
+                members = [[self.host, self.uid]]
                 logging.debug("NODE: My uid is bigger %d. Current leader %d", self.uid, leader)
             elif leader == self.uid and not self.voting:
                 self.uid = random.randint(1, 100000000)
                 logging.debug("NODE: Hitted same uid. Generating a new one.")
-                self.leader_election("election", leader)
+                self.leader_election("election", leader, trace=trace)
             elif leader == self.uid:
                 # Voting is over. I got the biggest UID
                 self.leader = self.uid
+                self.leader_host = self.host
+                leader_host = self.host
+                if members:
+                    self.members = members
+                    logging.debug("NODE: Ring members: %s", members)
                 self.voting = False
+                self.election_finished()
                 method = "elected"
                 logging.debug("NODE: I'm new leader. Current leader: %d", leader)
             else:
@@ -146,55 +584,74 @@ class Node(object):
                 return False
             self.voting = False
             self.leader = leader
+            self.leader_host = leader_host
+            if members:
+                self.members = members
+            self.election_finished()
             method = "elected"
-            logging.debug("NODE: Selected new leader %d", leader)
+            logging.debug("NODE: Selected new leader %d at %s", leader, leader_host)
 
         # send the message out.
-        message = {"method": method, "message": leader}
-        try:
-            ring.post(self.follower + self.messageUrl, json=message, timeout=self.timeout)
-        except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-            logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, message)
-            return False
-        except TypeError:
-            return False
-        return True
+        message = {"method": method, "message": leader, "members": members}
+        if method == "elected":
+            message["host"] = leader_host
+        return self.send_frames([message], trace=trace)
 
-    def propagate_message(self, message):
+    def propagate_message(self, message, origin=None, trace=None):
         """
         Propagate messages through the ring. The message is propagated until it reaches the leader.
         :param message: String message to be propagated.
+        :param origin: String address of the node where message was created. Defaults to own address.
+        :param trace: list hop trace of the received frame, or None
+        :return: boolean True on success, False if there is errors like missing follower.
+        """
+        return self.propagate_messages([message], origin, trace)
+
+    def propagate_messages(self, messages, origin=None, trace=None):
+        """
+        Propagate several messages through the ring in one frame. Leader persists the whole batch with
+        contiguous ids. New messages are traced at trace_rate, and the trace goes on with the persistent frames.
+        :param messages: list of messages to be propagated.
+        :param origin: String address of the node where messages were created. Defaults to own address.
+        :param trace: list hop trace of the received frame, or None
         :return: boolean True on success, False if there is errors like missing follower.
         """
+        if origin is None:
+            origin = self.host
+            if trace is None and tracing.sample(self.trace_rate):
+                trace = tracing.start(self.host)
         if (not self.is_connected()):
             return False
         # If we are not leading. We have to keep propagating the message.
         if not self.is_leader():
-            logging.debug("NODE: Propagating message: %s", message)
-            msg = {'method':'propagate', 'message': message}
-            try:
-                ring.post(self.follower + self.messageUrl, json=msg, timeout=self.timeout)
-            except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-                logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, msg)
-                return False
+            logging.debug("NODE: Propagating %d message(s): %s", len(messages), messages)
+            frames = [{'method': 'propagate', 'message': message, 'origin': origin} for message in messages]
+            if self.direct_submit and self.leader_host is not None and self.leader_host != self.follower:
+                return self.submit_to_leader(frames, origin, trace)
+            return self.send_frames(frames, ('propagate', origin), trace)
         # We are leader. Lets persist the message
         else:
-            logging.debug("NODE: Starting persisting process for message %s", message)
+            logging.debug("NODE: Starting persisting process for %d message(s): %s", len(messages), messages)
 
-            # Get free id for message
-            message_id = len(self.messages) + 1
+            # Get free id range for the batch
+            first_id = self.messages.next_id()
 
-            # Save message to cache.
-            self.messages[message_id] = message
+            frames = []
+            for offset, message in enumerate(messages):
+                # Save message to cache.
+                message_id = first_id + offset
+                self.messages[message_id] = message
+                frames.append({'method': 'persistent', 'message': {'id': message_id, 'message': message}})
 
-            # Announce
-            msg = {'method': 'persistent', 'message': {'id': message_id, 'message': message}}
-            try:
-                ring.post(self.follower + self.messageUrl, json=msg, timeout=self.timeout)
-            except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-                logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, message)
-                return False
-        return True
+            # Spread through spanning tree. Leader does not get the messages back, so commit them here.
+            if self.dissemination == DISSEMINATION_TREE and len(self.members) > 1:
+                if self.committed is not None:
+                    for message in messages:
+                        self.committed(message)
+                return self.disseminate(frames, self.ring_order(self.host), trace)
+
+        # Announce
+        return self.send_frames(frames, 'persistent', trace)
 
     def persist_message(self, message, message_id):
         """
@@ -203,16 +660,129 @@ class Node(object):
         :param message_id: message id decided by leader
         :return:
         """
+        return self.persist_messages([(message, message_id)])
+
+    def persist_messages(self, entries, tree=None, trace=None):
+        """
+        Save several persistent messages to Node cache and propagate them to others in one frame.
+        :param entries: list of (message, message_id) pairs
+        :param tree: list of descendant addresses if messages came through spanning tree, None for ring.
+        :param trace: list hop trace of the received frame, or None
+        :return: True on success, False on errors
+        """
         if not self.is_connected():
             return False
-        logging.debug("NODE: Persisting message: %s", message)
-        self.messages[message_id] = message
+        logging.debug("NODE: Persisting %d message(s): %s", len(entries), entries)
+
+        frames = []
+        for message, message_id in entries:
+            self.messages[message_id] = message
+            frames.append({'method': 'persistent', 'message': {'id': message_id, 'message': message}})
+        if tree is not None:
+            return self.disseminate(frames, tree, trace)
+        return self.send_frames(frames, 'persistent', trace)
+
+    def tree_children(self, hosts):
+        """
+        Split hosts to subtrees. Each subtree is contiguous part of the ring order and its first host is
+        the child. Subtrees shrink by fanout on every level, so depth is log_fanout(N).
+        :param hosts: list of addresses under this node
+        :return: list of (child address, list of child's descendants)
+        """
+        if not hosts:
+            return []
+        size = int(math.ceil(len(hosts) / float(self.fanout)))
+        children = []
+        for start in range(0, len(hosts), size):
+            subtree = hosts[start:start + size]
+            children.append((subtree[0], subtree[1:]))
+        return children
+
+    def disseminate(self, frames, hosts, trace=None):
+        """
+        Send persistent frames down the spanning tree. If a child cannot be reached, its descendants are
+        served directly.
+        :param frames: list of persistent frames
+        :param hosts: list of addresses under this node
+        :param trace: list hop trace, or None
+        :return: True on success, False if some subtree could not be reached
+        """
+        success = True
+        for child, descendants in self.tree_children(hosts):
+            if len(frames) == 1:
+                msg = dict(frames[0])
+            else:
+                msg = {'method': 'batch', 'messages': frames}
+            msg['tree'] = descendants
+            if trace is not None:
+                msg['trace'] = tracing.depart(trace, time.time())
+            if self.transport is not None:
+                fallback = lambda descendants=descendants: self.disseminate(frames, descendants, trace)
+                self.transport.send(child + self.messageUrl, msg, ('tree', child), on_error=fallback)
+                continue
+            try:
+                self.ring_post(child, self.messageUrl, msg)
+            except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
+                logging.error("NODE: Cannot connect host %s. Sending to its subtree.", child)
+                success = self.disseminate(frames, descendants, trace) and success
+        return success
+
+    def submit_to_leader(self, frames, origin, trace=None):
+        """
+        Send propagate frames straight to the leader instead of hop by hop. Ring is used as fallback if the
+        leader cannot be reached.
+        :param frames: list of propagate frames
+        :param origin: String address of the node where messages were created
+        :param trace: list hop trace, or None
+        :return: True on success, False on errors
+        """
+        leader_host = self.leader_host
+        msg = self.frame(frames, trace)
+        logging.debug("NODE: Submitting %d message(s) to leader %s", len(frames), leader_host)
+        if self.transport is not None:
+            fallback = lambda: self.send_frames(frames, ('propagate', origin), trace)
+            self.transport.send(leader_host + self.messageUrl, msg, ('direct', origin), on_error=fallback)
+            return True
+        try:
+            self.ring_post(leader_host, self.messageUrl, msg)
+        except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
+            logging.warning("NODE: Cannot reach leader %s. Using ring instead.", leader_host)
+            return self.send_frames(frames, ('propagate', origin), trace)
+        return True
+
+    def frame(self, frames, trace=None):
+        """
+        Wrap frames to one ring frame. Several frames are wrapped to single batch frame.
+        :param frames: list of {'method':some_method, 'message':some message} frames
+        :param trace: list hop trace, or None. Departure from this node is added to it.
+        :return: dict frame
+        """
+        if len(frames) == 1:
+            msg = frames[0]
+        else:
+            msg = {'method': 'batch', 'messages': frames}
+        if trace is not None:
+            msg = dict(msg, trace=tracing.depart(trace, time.time()))
+        return msg
 
-        msg = {'method': 'persistent', 'message': {'id': message_id, 'message': message}}
+    def send_frames(self, frames, lane='control', trace=None):
+        """
+        Send ring frames to follower. Several frames are wrapped to single batch frame.
+        :param frames: list of {'method':some_method, 'message':some message} frames
+        :param lane: Ordering key for the non-blocking transport. Frames on same lane are delivered in order.
+        :param trace: list hop trace, or None
+        :return: True on success, False on errors
+        """
+        if self.follower is None:
+            return False
+        msg = self.frame(frames, trace)
+        if self.transport is not None:
+            self.transport.send(self.follower + self.messageUrl, msg, lane, headers=self.hop_headers())
+            return True
         try:
-            ring.post(self.follower + self.messageUrl, json=msg, timeout=self.timeout)
+            self.ring_post(self.follower, self.messageUrl, msg)
         except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-            logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, message)
+            logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, msg)
             return False
         return True
 
@@ -227,37 +797,79 @@ class Node(object):
             return False
 
         # Suggest ourselves as follower
-        message_dictionary = {"host": self.host}
+        message_dictionary = {"host": self.host, "uid": self.uid}
         try:
-            r = ring.get(target_node + self.connectionUrl, message_dictionary, timeout=self.timeout)
+            r = self.get_session(target_node).get(target_node + self.connectionUrl, params=message_dictionary,
+                                                  timeout=self.timeout)
         except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
             logging.error("NODE: Cannot connect host %s.", target_node)
+            self.close_session(target_node)
             return False
         if r.status_code == 200:
             # We are accepted
             data = r.json()
             # Set the target host old follower to our follower
             self.set_follower(data['host'])
+            self.members = data.get('members') or []
+            if data.get('leader'):
+                self.adopt_leader(data['leader'][0], data['leader'][1])
+            if target_node != self.follower:
+                self.close_session(target_node)
             logging.debug("NODE: connected between %s and %s", target_node, data['host'])
             return True
         else:
+            self.close_session(target_node)
+            return False
+
+    def join(self, target_node):
+        """
+        Join ring through target node, catch up with its board and elect a leader. Runs on the queue thread,
+        so the blocking requests of joining and catch-up do not stall websocket clients.
+        :param target_node: Target node full address.
+        :return: True on success, False if the node was not accepted
+        """
+        if not self.connect(target_node):
             return False
+        if self.joined is not None:
+            self.joined()
+        self.request_messages()
+        if self.caught_up is not None:
+            self.caught_up()
+        self.elect()
+        return True
+
+    def rejoin(self, target_node):
+        """
+        Join ring again after the predecessor spliced this node out, for example after a network blip.
+        Messages in the log and queue are kept.
+        :param target_node: String address of the member that removed this node
+        :return: True on success, False if the node left the ring already or was not accepted
+        """
+        if self.follower is None:
+            # Already left the ring
+            return False
+        logging.warning("NODE: Spliced out of the ring by %s. Joining again.", target_node)
+        self.set_follower(None)
+        self.members = []
+        return self.join(target_node)
 
-    def disconnect(self, leaving_node, new_target):
+    def disconnect(self, leaving_node, new_target, receiver=None):
         """
         Disconnect the ring
         :param leaving_node: String. Address of leaving node
         :param new_target: String. Node that replaces the leaving one
+        :param receiver: String. Node the message is sent to, defaults to follower
         :return: True on success, False on fails.
         """
         if not self.is_connected(leaderless=True):
             return False
         if self.follower is not None:
+            receiver = receiver or self.follower
             message = {"host": leaving_node, "new_host": new_target}
             try:
-                ring.post(self.follower + self.connectionUrl, json=message, timeout=self.timeout)
+                self.ring_post(receiver, self.connectionUrl, message)
             except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-                logging.error("NODE: Cannot connect host %s. Unsend message: %s", self.follower, message)
+                logging.error("NODE: Cannot connect host %s. Unsend message: %s", receiver, message)
                 return False
             return True
 
@@ -270,12 +882,31 @@ class Node(object):
             return False
         try:
             logging.debug("NODE: Sending heartbeat to %s", self.follower)
-            ring.post(self.follower + self.heartbeatUrl, timeout=self.timeout)
+            self.ring_post(self.follower, self.heartbeatUrl)
             return True
         except (ring.exceptions.ConnectionError, ring.exceptions.Timeout) as e:
             logging.error("NODE: Cannot connect host %s.", self.follower)
             return False
 
+    def keep_alive(self):
+        """
+        Send heartbeat to follower and splice around it if it has not answered repair_after heartbeats in a row,
+        so a short network blip or pause of the follower does not fork the ring.
+        :return: True if follower is alive or ring was repaired, False otherwise
+        """
+        try:
+            if self.heartbeat():
+                return True
+            if self.follower is None:
+                return False
+            self.follower_misses += 1
+            if self.follower_misses < self.repair_after:
+                logging.warning("NODE: Follower %s missed %d heartbeat(s)", self.follower, self.follower_misses)
+                return False
+            return self.repair()
+        finally:
+            self.heartbeat_pending = False
+
     def panic(self, host):
         """
         Panic if too many heartbeats are lost. If some of the host cannot be connected,
@@ -288,13 +919,127 @@ class Node(object):
         logging.debug("NODE: %s is panicking!", host)
         msg = {"host": host}
         try:
-            ring.post(self.follower + self.heartbeatUrl, json=msg, timeout=self.timeout)
+            self.ring_post(self.follower, self.heartbeatUrl, msg)
             return True
         except (ring.exceptions.ConnectionError, ring.exceptions.Timeout) as e:
             if host != self.host:
+                dead = self.follower
                 self.set_follower(host)
-                self.leader_election("election", 0)
+                self.elect()
+                self.notify_removed(dead)
+            return True
+
+    def member_hosts(self):
+        """
+        Get member addresses in ring order.
+        :return: list of addresses
+        """
+        return [member[0] for member in self.members]
+
+    def ring_order(self, start):
+        """
+        Get member addresses following start in ring order, ending with its predecessor.
+        :param start: String address to start from
+        :return: list of addresses without start
+        """
+        hosts = self.member_hosts()
+        if start not in hosts:
+            return hosts
+        index = hosts.index(start)
+        return hosts[index + 1:] + hosts[:index]
+
+    def add_member(self, host, uid, after):
+        """
+        Insert new member to the membership view.
+        :param host: String address of new member
+        :param uid: Int UID of new member
+        :param after: String address of member preceding the new one
+        :return: True on success
+        """
+        if not self.members:
+            self.members = [[self.host, self.uid]]
+        self.remove_member(host)
+        hosts = self.member_hosts()
+        index = hosts.index(after) + 1 if after in hosts else len(hosts)
+        self.members.insert(index, [host, uid])
+        return True
+
+    def remove_member(self, host):
+        """
+        Remove member from the membership view.
+        :param host: String address of removed member
+        :return: True if member was known
+        """
+        members = [member for member in self.members if member[0] != host]
+        removed = len(members) != len(self.members)
+        self.members = members
+        return removed
+
+    def members_frame(self, origin):
+        """
+        Build membership view message.
+        :param origin: String address of the member that changed the view
+        :return: dict {'method':'members', 'message': view, 'origin': origin, 'leader': [address, uid] or None}
+        """
+        leader = None
+        if self.leader_host is not None:
+            leader = [self.leader_host, self.leader]
+        return {'method': 'members', 'message': self.members, 'origin': origin, 'leader': leader}
+
+    def update_members(self, members, origin, leader=None):
+        """
+        Adopt membership view sent by another member and pass it on until it returns to origin.
+        :param members: list of [address, uid] pairs in ring order
+        :param origin: String address of the member that changed the view
+        :param leader: [address, uid] of the leader in the view, or None
+        :return: True on success, False on end of lap or errors
+        """
+        if origin == self.host:
+            return False
+        self.members = members
+        if leader:
+            self.adopt_leader(leader[0], leader[1])
+        logging.debug("NODE: Ring members updated by %s: %s", origin, members)
+        return self.send_frames([self.members_frame(origin)])
+
+    def repair(self):
+        """
+        Splice around a dead follower using the membership view. Its successor becomes our follower and the
+        new view is passed around the ring. New election is only needed if the leader died.
+        :return: True if ring was repaired, False if membership view cannot help
+        """
+        dead = self.follower
+        if dead is None or dead not in self.member_hosts():
+            return False
+        successor = self.ring_order(dead)[0]
+        logging.warning("NODE: Follower %s is dead. Splicing ring to %s", dead, successor)
+        self.remove_member(dead)
+        if successor == self.host:
+            # We are alone
+            self.set_follower(None)
+            return True
+        self.set_follower(successor)
+        if dead == self.leader_host:
+            # Successor got every persistent message from the dead leader first
+            self.elect(candidate=successor)
+        else:
+            self.send_frames([self.members_frame(self.host)])
+        self.notify_removed(dead)
+        return True
+
+    def notify_removed(self, host):
+        """
+        Tell member that it was spliced out of the ring, so it joins again if it is still alive. The notice
+        carries the hop header, because the member only accepts it from its predecessor.
+        :param host: String address of the removed member
+        :return: True if member got the message
+        """
+        try:
+            self.ring_post(host, self.messageUrl, {'method': 'removed', 'message': self.host}, hop=True)
             return True
+        except (ring.exceptions.ConnectionError, ring.exceptions.Timeout) as e:
+            logging.debug("NODE: Removed member %s cannot be reached", host)
+            return False
 
     def is_connected(self, leaderless=False):
         """
@@ -307,24 +1052,50 @@ class Node(object):
             return False
         elif self.leader is None and leaderless is False:
             logging.warning("NODE: There is no leader. Message not sent.")
-            self.leader_election("election", 0)
+            self.elect()
             return False
         return True
 
-    def request_messages(self):
+    def request_messages(self, attempts=3):
         """
         Request messages from following node so the new node doesn't have to start from blank whiteboard.
+        Only messages after the complete part of the log are requested. They are streamed in chunks and applied
+        as they arrive, and after a failure the request resumes from the last applied message. If the history
+        of the follower does not have the complete part, for example after joining another ring, the log is
+        cleared and fetched whole.
+        :param attempts: int Number of tries
         :return: True on normal run, False on fail.
         """
         if not self.is_connected(leaderless=True):
             return False
-        logging.debug("NODE: Requesting old messages from %s", self.follower)
-        try:
-            resp = ring.get(self.follower + self.messageUrl, timeout=self.timeout)
-        except (ring.exceptions.ConnectionError, ring.exceptions.ReadTimeout) as e:
-            logging.error("NODE: Cannot connect host %s.", self.follower)
-            return False
-        self.messages = resp.json()
-        return True
-
-
+        since = self.messages.contiguous_id()
+        failures = 0
+        while failures < attempts:
+            logging.debug("NODE: Requesting messages after %d from %s", since, self.follower)
+            try:
+                resp = self.get_session(self.follower).get(self.follower + self.messageUrl,
+                                                           params={'since': since, 'stream': 1},
+                                                           stream=True, timeout=self.timeout)
+                if resp.headers.get('Content-Type', '').startswith('application/json'):
+                    # Node without streaming support
+                    self.messages.load(resp.json())
+                    return True
+                start, last = resp.headers.get(START_HEADER), resp.headers.get(LAST_HEADER)
+                if since > 0 and start is not None and last is not None and \
+                        not shares_prefix(self.messages, since, int(start), int(last)):
+                    logging.warning("NODE: Log up to %d is not in the history of %s (%s-%s). Fetching it whole.",
+                                    since, self.follower, start, last)
+                    resp.close()
+                    self.messages.clear()
+                    since = self.messages.contiguous_id()
+                    continue
+                for line in resp.iter_lines():
+                    if line:
+                        message_id, message = json.loads(line)
+                        self.messages[message_id] = message
+                        since = message_id
+                return True
+            except (ring.exceptions.RequestException, ValueError) as e:
+                logging.error("NODE: Catch-up from %s failed after message %d.", self.follower, since)
+                failures += 1
+        return False
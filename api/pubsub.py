@@ -0,0 +1,215 @@
+"""
+Publish/subscribe of the board between processes. The process owning the node publishes every stored
+message, clear and websocket broadcast as one json event per line over TCP, to its local worker processes and
+to observers on other hosts. Subscribers keep a read-only replica of the message log for replay and pass
+broadcasts on to their own websocket clients. Subscribers send client messages the other way on the same
+connection.
+
+Subscriber that falls behind by more than the publisher's buffer limit is disconnected, like slow websocket
+clients. It subscribes again and gets the whole log, so its replica never misses events.
+
+Events from publisher:
+    ['append', sequence number, message]   message stored in the log
+    ['clear']                              log cleared
+    ['broadcast', message]                 message sent to websocket clients
+    ['replay']                             board was replaced, clients should replay it
+
+Events from subscriber:
+    ['enqueue', task]                      task for the node, {'method': node_method, 'args': arguments}
+    ['connect', address] / ['disconnect']  ring commands of websocket clients, from workers only
+"""
+import json
+import logging
+import socket
+
+import tornado.gen
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
+
+# Seconds between attempts to reach the publisher
+RECONNECT_DELAY = 1.0
+# Longest event line accepted, in bytes
+MAX_EVENT_SIZE = 64 * 1024 * 1024
+# Log entries per write when a new subscriber gets the whole log
+SNAPSHOT_CHUNK = 1000
+# Bytes of events a subscriber can fall behind by default before it is disconnected
+MAX_SUBSCRIBER_BUFFER = 16 * 1024 * 1024
+
+
+def encode_event(event):
+    return json.dumps(event, separators=(',', ':')) + '\n'
+
+
+class Publisher(tornado.tcpserver.TCPServer):
+    """
+    Publishes the log and broadcasts of this process to subscribers. Listens to MessageLog, so it follows
+    appends and clearing. A new subscriber gets live events right away and the whole log in chunks along
+    them. Events are encoded once for all subscribers.
+    """
+    def __init__(self, io_loop, log, max_buffer=MAX_SUBSCRIBER_BUFFER):
+        """
+        :param io_loop: tornado.ioloop.IOLoop events are sent from
+        :param log: MessageLog that is published
+        :param max_buffer: int bytes of unsent events a subscriber can have before it is disconnected
+        """
+        super(Publisher, self).__init__(max_buffer_size=MAX_EVENT_SIZE)
+        self.io_loop = io_loop
+        self.log = log
+        self.max_buffer = max_buffer
+        self.subscribers = set() # IOStreams of subscribers
+        self.evicted = 0 # Subscribers disconnected for falling behind
+        self.on_request = None # Optional callable run on the IOLoop with every event from subscribers
+
+    def publish(self, event):
+        """
+        Send event to all subscribers. Safe to call from any thread, events are sent on the IOLoop in the order
+        they were published.
+        :param event: json serializable list
+        :return:
+        """
+        self.io_loop.add_callback(self._send, event)
+
+    def _send(self, event):
+        if not self.subscribers:
+            return
+        line = encode_event(event)
+        for stream in list(self.subscribers):
+            if stream.closed():
+                self.subscribers.discard(stream)
+            else:
+                self._write(stream, line)
+
+    def _write(self, stream, data):
+        """
+        Write to subscriber, or disconnect it if it has fallen too far behind.
+        :return: Future resolved when data is flushed, None if subscriber was disconnected
+        """
+        try:
+            return stream.write(data)
+        except tornado.iostream.StreamBufferFullError:
+            logging.warning("PUBSUB: Subscriber fell %d bytes behind. Disconnecting it.", self.max_buffer)
+            self.evicted += 1
+            self.subscribers.discard(stream)
+            stream.close()
+            return None
+
+    def on_append(self, message_id, message):
+        self.publish(['append', message_id, message])
+
+    def on_compact(self, start):
+        # Subscribers compact their replicas when the same clean is appended
+        pass
+
+    def on_clear(self):
+        self.publish(['clear'])
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        logging.info("PUBSUB: Subscriber %s joined", address)
+        stream.max_write_buffer_size = self.max_buffer
+        # Live events are sent from the start, so none is missed while the log is sent. Appends arriving
+        # twice or out of order are idempotent, and entries erased by a later clean are skipped by the replica.
+        self.subscribers.add(stream)
+        try:
+            message_id = self.log.start
+            while message_id <= self.log.last_id():
+                # Lock is held for one chunk at a time, and the next chunk is read after this one is flushed.
+                # Chunk takes at most a quarter of the buffer, so live events have room next to it.
+                lines = []
+                size = 0
+                with self.log.lock:
+                    message_id = max(message_id, self.log.start)
+                    last = min(message_id + SNAPSHOT_CHUNK - 1, self.log.last_id())
+                    for entry_id, message in self.log.range(message_id, last):
+                        lines.append(encode_event(['append', entry_id, message]))
+                        size += len(lines[-1])
+                        if size >= self.max_buffer // 4:
+                            last = entry_id
+                            break
+                    message_id = last + 1
+                if lines:
+                    flushed = self._write(stream, ''.join(lines))
+                    if flushed is None:
+                        return
+                    yield flushed
+            while True:
+                line = yield stream.read_until('\n', max_bytes=MAX_EVENT_SIZE)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning("PUBSUB: Malformed event from subscriber %s", address)
+                    continue
+                if self.on_request is not None and isinstance(event, list) and event:
+                    self.on_request(event)
+        except tornado.iostream.StreamClosedError:
+            logging.info("PUBSUB: Subscriber %s left", address)
+        finally:
+            self.subscribers.discard(stream)
+
+
+class Subscriber(object):
+    """
+    Keeps a replica of the publisher's log. Publishers are tried in turn until one answers, and again when the
+    connection is lost. Events other than log changes are given to on_event.
+    """
+    def __init__(self, io_loop, log, addresses):
+        """
+        :param io_loop: tornado.ioloop.IOLoop running the subscription
+        :param log: MessageLog replica. Cleared when a publisher is reached, which then sends its whole log.
+        :param addresses: list of (host, port) of publishers
+        """
+        self.io_loop = io_loop
+        self.log = log
+        self.addresses = addresses
+        self.stream = None # IOStream to the current publisher, None if not connected
+        self.on_event = None # Optional callable run on the IOLoop with broadcast and replay events
+
+    def start(self):
+        self.io_loop.spawn_callback(self.run)
+
+    @tornado.gen.coroutine
+    def run(self):
+        attempt = 0
+        while True:
+            host, port = self.addresses[attempt % len(self.addresses)]
+            try:
+                self.stream = yield tornado.tcpclient.TCPClient().connect(host, port,
+                                                                          max_buffer_size=MAX_EVENT_SIZE)
+                logging.info("PUBSUB: Subscribed to %s:%d", host, port)
+                self.log.clear()
+                while True:
+                    line = yield self.stream.read_until('\n', max_bytes=MAX_EVENT_SIZE)
+                    self.apply(json.loads(line))
+            except (tornado.iostream.StreamClosedError, socket.error, IOError, ValueError) as e:
+                logging.warning("PUBSUB: Lost publisher %s:%d: %s", host, port, e)
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            attempt += 1
+            yield tornado.gen.sleep(RECONNECT_DELAY)
+
+    def apply(self, event):
+        """
+        Apply event from publisher.
+        :param event: list event
+        :return:
+        """
+        kind = event[0]
+        if kind == 'append':
+            self.log[event[1]] = event[2]
+        elif kind == 'clear':
+            self.log.clear()
+        elif self.on_event is not None:
+            self.on_event(event)
+
+    def send(self, event):
+        """
+        Send event to the publisher.
+        :param event: json serializable list
+        :return: True if publisher is connected
+        """
+        if self.stream is None or self.stream.closed():
+            return False
+        self.stream.write(encode_event(event))
+        return True
@@ -0,0 +1,124 @@
+"""
+Freehand stroke simplification. Points are snapped to a grid, repeated points are dropped and the rest is
+simplified with Douglas-Peucker, so a stroke keeps its shape within tolerance with a fraction of the points.
+NumPy is used when available, pure python otherwise.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Default maximum distance of dropped points from the simplified stroke, in pixels
+TOLERANCE = 1.0
+# Default grid the points are snapped to, in pixels
+QUANTUM = 1.0
+
+
+def _is_coordinate(value):
+    return not isinstance(value, bool) and isinstance(value, (int, long, float)) and not math.isinf(value) and \
+        not math.isnan(value)
+
+
+def validate(points):
+    """
+    Check that points are [[x, y], ...] with numeric coordinates.
+    :param points: list of points
+    :raise ValueError: if points are malformed
+    """
+    if not isinstance(points, list):
+        raise ValueError("Points must be a list")
+    for point in points:
+        if not isinstance(point, (list, tuple)) or len(point) != 2 or not _is_coordinate(point[0]) or \
+                not _is_coordinate(point[1]):
+            raise ValueError("Malformed point %r" % (point,))
+
+
+def simplify(points, tolerance=TOLERANCE, quantum=QUANTUM):
+    """
+    Simplify stroke.
+    :param points: list of [x, y] points
+    :param tolerance: float Maximum distance of dropped points from the simplified stroke
+    :param quantum: float Grid the points are snapped to. Whole quantum gives int coordinates.
+    :return: list of [x, y] points. First and last point are always kept.
+    :raise ValueError: if points are malformed
+    """
+    validate(points)
+    if not points:
+        return []
+    if numpy is not None:
+        return _simplify_numpy(points, tolerance, quantum)
+    return _simplify_python(points, tolerance, quantum)
+
+
+def _simplify_numpy(points, tolerance, quantum):
+    points = numpy.round(numpy.asarray(points, dtype=numpy.float64) / quantum) * quantum
+    # Drop points repeating the previous one
+    moved = numpy.any(points[1:] != points[:-1], axis=1)
+    points = points[numpy.concatenate(([True], moved))]
+
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        direction = points[last] - start
+        offsets = points[first + 1:last] - start
+        length = math.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            # Distance from the line through first and last point
+            distances = numpy.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        index = int(distances.argmax())
+        if distances[index] > tolerance:
+            index += first + 1
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    points = points[keep]
+    if float(quantum).is_integer():
+        points = points.astype(numpy.int64)
+    return points.tolist()
+
+
+def _simplify_python(points, tolerance, quantum):
+    whole = float(quantum).is_integer()
+    snapped = []
+    for x, y in points:
+        point = [round(x / quantum) * quantum, round(y / quantum) * quantum]
+        if whole:
+            point = [int(point[0]), int(point[1])]
+        if not snapped or snapped[-1] != point:
+            snapped.append(point)
+
+    keep = [False] * len(snapped)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(snapped) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start_x, start_y = snapped[first]
+        direction_x = snapped[last][0] - start_x
+        direction_y = snapped[last][1] - start_y
+        length = math.hypot(direction_x, direction_y)
+        farthest, index = -1.0, first
+        for candidate in xrange(first + 1, last):
+            offset_x = snapped[candidate][0] - start_x
+            offset_y = snapped[candidate][1] - start_y
+            if length == 0:
+                distance = math.hypot(offset_x, offset_y)
+            else:
+                distance = abs(direction_x * offset_y - direction_y * offset_x) / length
+            if distance > farthest:
+                farthest, index = distance, candidate
+        if farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(snapped, keep) if kept]
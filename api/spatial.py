@@ -0,0 +1,174 @@
+"""
+Spatial index over the message log. Strokes are kept in a uniform grid of square cells by their bounding
+boxes, so strokes in a viewport can be found without going through the whole log.
+"""
+import math
+import threading
+
+# Default cell side in pixels
+CELL_SIZE = 256
+# Strokes covering more cells than this are kept in one list and checked on every query
+MAX_CELLS = 64
+
+
+def bounds(message):
+    """
+    Bounding box of stroke message.
+    :param message: dict message
+    :return: tuple (min x, min y, max x, max y), or None if message has no position, like clean
+    """
+    try:
+        method = message['method']
+        if method == 'line':
+            line = message['message']
+            xs = (line['start']['x'], line['end']['x'])
+            ys = (line['start']['y'], line['end']['y'])
+        elif method == 'polyline':
+            points = message['message']['points']
+            if not points:
+                return None
+            xs = [point[0] for point in points]
+            ys = [point[1] for point in points]
+        else:
+            return None
+        box = float(min(xs)), float(min(ys)), float(max(xs)), float(max(ys))
+    except (KeyError, TypeError, IndexError, ValueError):
+        return None
+    for coordinate in box:
+        if math.isinf(coordinate) or math.isnan(coordinate):
+            return None
+    return box
+
+
+def parse_viewport(value):
+    """
+    Parse viewport given as "x0,y0,x1,y1" string or [x0, y0, x1, y1] list.
+    :param value: string or list
+    :return: tuple (min x, min y, max x, max y)
+    :raise ValueError: if viewport is malformed
+    """
+    if isinstance(value, basestring):
+        value = value.split(',')
+    try:
+        x0, y0, x1, y1 = [float(coordinate) for coordinate in value]
+    except TypeError:
+        raise ValueError("Viewport must have four coordinates")
+    for coordinate in (x0, y0, x1, y1):
+        if math.isinf(coordinate) or math.isnan(coordinate):
+            raise ValueError("Viewport coordinates must be finite")
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def intersects(box, viewport):
+    """
+    Check whether bounding box and viewport overlap. Boxes touching the edge overlap.
+    """
+    return box[0] <= viewport[2] and box[2] >= viewport[0] and box[1] <= viewport[3] and box[3] >= viewport[1]
+
+
+class GridIndex(object):
+    """
+    Uniform grid index. Listens to MessageLog, so it follows appends, compaction and clearing. Messages without
+    position, like cleans, are kept aside and returned by every query.
+    """
+    def __init__(self, cell_size=CELL_SIZE):
+        """
+        :param cell_size: int Cell side in pixels
+        """
+        self.cell_size = cell_size
+        self.lock = threading.Lock()
+        self.cells = {} # Sequence numbers by (column, row)
+        self.boxes = {} # Bounding boxes by sequence number
+        self.large = set() # Strokes covering more than MAX_CELLS cells
+        self.unplaced = set() # Messages without position
+
+    def _cell_range(self, box):
+        size = float(self.cell_size)
+        return (int(box[0] // size), int(box[1] // size), int(box[2] // size), int(box[3] // size))
+
+    def _remove(self, message_id):
+        box = self.boxes.pop(message_id, None)
+        self.unplaced.discard(message_id)
+        if box is None:
+            return
+        if message_id in self.large:
+            self.large.discard(message_id)
+            return
+        first_column, first_row, last_column, last_row = self._cell_range(box)
+        for column in xrange(first_column, last_column + 1):
+            for row in xrange(first_row, last_row + 1):
+                cell = self.cells.get((column, row))
+                if cell is not None:
+                    cell.discard(message_id)
+                    if not cell:
+                        del self.cells[(column, row)]
+
+    def add(self, message_id, message):
+        """
+        Index message. Earlier message with the same sequence number is replaced.
+        :param message_id: int sequence number
+        :param message: dict message
+        :return:
+        """
+        box = bounds(message)
+        with self.lock:
+            self._remove(message_id)
+            if box is None:
+                self.unplaced.add(message_id)
+                return
+            self.boxes[message_id] = box
+            first_column, first_row, last_column, last_row = self._cell_range(box)
+            if (last_column - first_column + 1) * (last_row - first_row + 1) > MAX_CELLS:
+                self.large.add(message_id)
+                return
+            for column in xrange(first_column, last_column + 1):
+                for row in xrange(first_row, last_row + 1):
+                    self.cells.setdefault((column, row), set()).add(message_id)
+
+    def query(self, viewport):
+        """
+        Find messages in viewport.
+        :param viewport: tuple (min x, min y, max x, max y)
+        :return: sorted list of sequence numbers of strokes overlapping the viewport and messages without position
+        """
+        with self.lock:
+            found = set(self.unplaced)
+            first_column, first_row, last_column, last_row = self._cell_range(viewport)
+            if (last_column - first_column + 1) * (last_row - first_row + 1) > len(self.cells):
+                # Viewport covers more cells than there are in use
+                candidates = self.boxes.iterkeys()
+            else:
+                candidates = set(self.large)
+                for column in xrange(first_column, last_column + 1):
+                    for row in xrange(first_row, last_row + 1):
+                        candidates.update(self.cells.get((column, row), ()))
+            for message_id in candidates:
+                if intersects(self.boxes[message_id], viewport):
+                    found.add(message_id)
+        return sorted(found)
+
+    def rebuild(self, log):
+        """
+        Index all messages of the log, for example after it was restored from a snapshot.
+        :param log: MessageLog
+        :return:
+        """
+        self.on_clear()
+        for message_id, message in log.range():
+            self.add(message_id, message)
+
+    def on_append(self, message_id, message):
+        self.add(message_id, message)
+
+    def on_compact(self, start):
+        with self.lock:
+            for message_id in [message_id for message_id in self.boxes if message_id < start]:
+                self._remove(message_id)
+            self.unplaced = set(message_id for message_id in self.unplaced if message_id >= start)
+
+    def on_clear(self):
+        with self.lock:
+            self.cells = {}
+            self.boxes = {}
+            self.large = set()
+            self.unplaced = set()
@@ -0,0 +1,293 @@
+"""
+Raster tile pyramid of the board. Tiles are rendered from the spatial index when first requested, kept in
+a bounded cache and drawn into as new strokes are stored, so the page can paint the board from a few PNG
+images instead of replaying the whole history.
+
+Tile (z, x, y) covers board pixels [x * size * 2^z, (x + 1) * size * 2^z) horizontally and the same
+vertically, so level 0 is full resolution and every level above it halves the resolution.
+"""
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Tile side in pixels
+TILE_SIZE = 256
+# Number of zoom levels
+LEVELS = 4
+# Tiles kept in memory. Others are rendered again from the index when requested.
+MAX_TILES = 1024
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+PNG_GRAY_ALPHA = 4
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(coverage):
+    """
+    Encode stroke coverage as black gray-alpha PNG.
+    :param coverage: square numpy uint8 array, 255 where a stroke is
+    :return: str PNG image
+    """
+    height, width = coverage.shape
+    # Every row starts with filter type 0, then gray and alpha of each pixel
+    rows = numpy.zeros((height, 1 + width * 2), dtype=numpy.uint8)
+    rows[:, 2::2] = coverage
+    header = struct.pack('>IIBBBBB', width, height, 8, PNG_GRAY_ALPHA, 0, 0, 0)
+    return PNG_SIGNATURE + _png_chunk('IHDR', header) + _png_chunk('IDAT', zlib.compress(rows.tostring(), 6)) + \
+        _png_chunk('IEND', '')
+
+
+def stroke_points(message):
+    """
+    Points of stroke message.
+    :param message: dict message
+    :return: list of [x, y] points, empty if message is not a stroke
+    """
+    try:
+        method = message['method']
+        if method == 'line':
+            line = message['message']
+            return [[line['start']['x'], line['start']['y']], [line['end']['x'], line['end']['y']]]
+        if method == 'polyline':
+            return list(message['message']['points'])
+    except (KeyError, TypeError):
+        pass
+    return []
+
+
+def segments(messages):
+    """
+    Line segments of stroke messages.
+    :param messages: iterable of dict messages
+    :return: tuple of numpy arrays (starts, ends), shape (segments, 2)
+    """
+    starts = []
+    ends = []
+    for message in messages:
+        try:
+            points = [[float(x), float(y)] for x, y in stroke_points(message)]
+        except (TypeError, ValueError):
+            # Malformed coordinates. Stroke is left out of the tiles.
+            continue
+        if len(points) == 1:
+            points = points * 2
+        starts.extend(points[:-1])
+        ends.extend(points[1:])
+    return (numpy.array(starts, dtype=numpy.float64).reshape(-1, 2),
+            numpy.array(ends, dtype=numpy.float64).reshape(-1, 2))
+
+
+def clip(starts, ends, low, high):
+    """
+    Clip segments to square [low, high] on both axes.
+    :return: tuple of numpy arrays (starts, ends) of the visible parts
+    """
+    delta = ends - starts
+    enter = numpy.zeros(len(starts))
+    leave = numpy.ones(len(starts))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for axis in (0, 1):
+            direction = delta[:, axis]
+            position = starts[:, axis]
+            to_low = (low - position) / direction
+            to_high = (high - position) / direction
+            parallel = direction == 0
+            enter = numpy.maximum(enter, numpy.where(parallel, -numpy.inf, numpy.minimum(to_low, to_high)))
+            leave = numpy.minimum(leave, numpy.where(parallel, numpy.inf, numpy.maximum(to_low, to_high)))
+            # Parallel segment outside the square
+            leave[parallel & ((position < low) | (position > high))] = -1
+    visible = enter <= leave
+    starts, delta = starts[visible], delta[visible]
+    return starts + delta * enter[visible, None], starts + delta * leave[visible, None]
+
+
+def draw(tile, starts, ends):
+    """
+    Rasterize segments into tile by sampling every pixel step along them.
+    :param tile: square numpy uint8 array
+    :param starts: numpy array of segment starts in tile pixels
+    :param ends: numpy array of segment ends in tile pixels
+    :return:
+    """
+    size = tile.shape[0]
+    starts, ends = clip(starts, ends, -1.0, size + 1.0)
+    if not len(starts):
+        return
+    delta = ends - starts
+    steps = numpy.ceil(numpy.abs(delta).max(axis=1)).astype(numpy.int64) + 1
+    segment = numpy.repeat(numpy.arange(len(steps)), steps)
+    step = numpy.arange(steps.sum()) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+    fraction = step / numpy.maximum(steps - 1, 1)[segment].astype(numpy.float64)
+    pixels = numpy.floor(starts[segment] + delta[segment] * fraction[:, None]).astype(numpy.int64)
+    inside = ((pixels >= 0) & (pixels < size)).all(axis=1)
+    tile[pixels[inside, 1], pixels[inside, 0]] = 255
+
+
+class TilePyramid(object):
+    """
+    Tile pyramid following MessageLog. Cached tiles are drawn into on every stored stroke and dropped when the
+    board is cleaned. Tiles render from the spatial index, so they always contain every stroke up to the
+    contiguous id of the log.
+    """
+    def __init__(self, log, index, tile_size=TILE_SIZE, levels=LEVELS, max_tiles=MAX_TILES):
+        """
+        :param log: MessageLog
+        :param index: spatial.GridIndex of the log
+        :param tile_size: int Tile side in pixels
+        :param levels: int Number of zoom levels
+        :param max_tiles: int Tiles kept in memory
+        """
+        self.log = log
+        self.index = index
+        self.tile_size = tile_size
+        self.levels = levels
+        self.max_tiles = max_tiles
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict() # Coverage arrays by (z, x, y), oldest first
+        self.images = {} # Encoded PNG images by (z, x, y)
+        self.rendering = [] # [key, appended segments or None if cleaned] of tiles being rendered
+
+    def span(self, z):
+        """
+        Board pixels covered by one tile side on level z.
+        """
+        return self.tile_size * 2 ** z
+
+    def version(self):
+        """
+        Sequence number up to which tiles are complete.
+        :return: int
+        """
+        return self.log.contiguous_id()
+
+    def cached_png(self, z, x, y):
+        """
+        Get tile as PNG image if it is encoded already. Does not wait for the log lock.
+        :return: str PNG image, None if tile has to be rendered
+        """
+        with self.lock:
+            return self.images.get((z, x, y))
+
+    def png(self, z, x, y):
+        """
+        Get tile as PNG image. Strokes of the tile are copied under the log lock, and the tile is rasterized and
+        encoded after releasing it, so appends and other requests are not blocked. Strokes appended meanwhile
+        are drawn in before the tile is cached. Meant to be called from a rendering thread.
+        :param z: int zoom level
+        :param x: int tile column
+        :param y: int tile row
+        :return: str PNG image
+        :raise ValueError: if there is no such zoom level
+        """
+        if not 0 <= z < self.levels:
+            raise ValueError("No zoom level %d" % z)
+        key = (z, x, y)
+        while True:
+            # [key, segments appended since the copy or None if board was cleaned]
+            rendering = [key, []]
+            tile = starts = ends = None
+            # Log lock first, like when the log calls listeners
+            with self.log.lock:
+                with self.lock:
+                    image = self.images.get(key)
+                    if image is not None:
+                        return image
+                    tile = self.tiles.pop(key, None)
+                    if tile is not None:
+                        # Keep recently used tiles last
+                        self.tiles[key] = tile
+                        tile = tile.copy()
+                    self.rendering.append(rendering)
+                if tile is None:
+                    starts, ends = self._segments(key)
+            try:
+                if tile is None:
+                    tile = self._render(key, starts, ends)
+                image = encode_png(tile)
+            except Exception:
+                with self.lock:
+                    self._forget(rendering)
+                raise
+            with self.lock:
+                self._forget(rendering)
+                changes = rendering[1]
+                if changes is not None:
+                    # Drawing only sets pixels, so late strokes give the same tile as the cached one gets
+                    for starts, ends in changes:
+                        self._draw(key, tile, starts, ends)
+                    if changes:
+                        image = encode_png(tile)
+                    self._store(key, tile, image)
+                    return image
+
+    def _forget(self, rendering):
+        self.rendering = [other for other in self.rendering if other is not rendering]
+
+    def _segments(self, key):
+        z, x, y = key
+        span = self.span(z)
+        left, top = x * span, y * span
+        message_ids = self.index.query((left, top, left + span, top + span))
+        return segments(message for _, message in self.log.select(message_ids))
+
+    def _render(self, key, starts, ends):
+        tile = numpy.zeros((self.tile_size, self.tile_size), dtype=numpy.uint8)
+        self._draw(key, tile, starts, ends)
+        return tile
+
+    def _draw(self, key, tile, starts, ends):
+        z, x, y = key
+        span = self.span(z)
+        origin = numpy.array([x * span, y * span], dtype=numpy.float64)
+        draw(tile, (starts - origin) / 2 ** z, (ends - origin) / 2 ** z)
+
+    def _store(self, key, tile, image):
+        self.tiles[key] = tile
+        self.images[key] = image
+        while len(self.tiles) > self.max_tiles:
+            old, _ = self.tiles.popitem(last=False)
+            self.images.pop(old, None)
+
+    @staticmethod
+    def _overlaps(key, span, low, high):
+        z, x, y = key
+        left, top = x * span, y * span
+        return not (high[0] < left or low[0] > left + span or high[1] < top or low[1] > top + span)
+
+    def on_append(self, message_id, message):
+        if isinstance(message, dict) and message.get('method') == 'clean':
+            self.on_clear()
+            return
+        starts, ends = segments([message])
+        if not len(starts):
+            return
+        low = numpy.minimum(starts, ends).min(axis=0)
+        high = numpy.maximum(starts, ends).max(axis=0)
+        with self.lock:
+            for key, tile in self.tiles.iteritems():
+                if self._overlaps(key, self.span(key[0]), low, high):
+                    self._draw(key, tile, starts, ends)
+                    self.images.pop(key, None)
+            for rendering in self.rendering:
+                if rendering[1] is not None and self._overlaps(rendering[0], self.span(rendering[0][0]), low, high):
+                    rendering[1].append((starts, ends))
+
+    def on_compact(self, start):
+        self.on_clear()
+
+    def on_clear(self):
+        with self.lock:
+            self.tiles = OrderedDict()
+            self.images = {}
+            # Tiles being rendered are rendered again
+            for rendering in self.rendering:
+                rendering[1] = None
@@ -0,0 +1,135 @@
+"""
+Sampled hop tracing of ring frames. Traced frame carries
+
+    'trace': [origin time, [host, in, out], [host, in, out], ...]
+
+where origin time is seconds since epoch when the origin started handling the message, and in and out are
+milliseconds after it when the frame arrived at a host and when the host sent it on. Every node records the
+hops of traced frames it receives to its LatencyMap, so the node at the end of a lap has seen every hop. Trace
+goes on with the persistent lap, so a node can get the same trace again. Then it records only the hops added
+since it sent the frame on.
+
+Residence (in to out) is measured by one clock. Link latency (out of sender to in of receiver) also contains
+the clock difference of the two hosts.
+"""
+import random
+import threading
+import time
+
+
+def sample(rate):
+    """
+    Decide whether new message is traced.
+    :param rate: float share of messages traced, 0 to 1
+    :return: bool
+    """
+    return rate > 0 and random.random() < rate
+
+
+def start(host, now=None):
+    """
+    Start trace at origin.
+    :param host: String origin address
+    :param now: float time, defaults to current time
+    :return: list trace
+    """
+    return [now or time.time(), [host, 0.0]]
+
+
+def _offset(trace, now):
+    return round((now - trace[0]) * 1000, 2)
+
+
+def arrive(trace, host, now):
+    """
+    Trace with arrival at host added.
+    :return: list new trace
+    """
+    return trace + [[host, _offset(trace, now)]]
+
+
+def depart(trace, now):
+    """
+    Trace with departure from the last host added.
+    :return: list new trace
+    """
+    last = trace[-1]
+    return trace[:-1] + [last[:2] + [_offset(trace, now)]]
+
+
+class LatencyMap(object):
+    """
+    Per-hop latency aggregated from traces: residence time of each node and latency of each link between nodes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = 0 # Traces recorded
+        self.nodes = {} # [count, total ms, max ms, last ms] of residence by host
+        self.links = {} # [count, total ms, max ms, last ms] of link latency by (sender, receiver)
+
+    @staticmethod
+    def _add(table, key, value):
+        stats = table.get(key)
+        if stats is None:
+            table[key] = [1, value, value, value]
+        else:
+            stats[0] += 1
+            stats[1] += value
+            stats[2] = max(stats[2], value)
+            stats[3] = value
+
+    def record(self, trace, host, now):
+        """
+        Record hops of trace that arrived at host. Hops before the last visit of host are recorded already.
+        :param trace: list trace
+        :param host: String receiving address
+        :param now: float arrival time
+        :return:
+        :raise ValueError: if trace is malformed
+        """
+        try:
+            origin_time = float(trace[0])
+            hops = [(hop[0], float(hop[1]), float(hop[2]) if len(hop) > 2 else None) for hop in trace[1:]]
+        except (TypeError, IndexError, KeyError):
+            raise ValueError("Malformed trace")
+        if not hops:
+            raise ValueError("Trace has no hops")
+        visits = [index for index, hop in enumerate(hops) if hop[0] == host]
+        first = visits[-1] if visits else 0
+        with self.lock:
+            # Origin of the trace has not recorded it either
+            if first == 0:
+                self.traces += 1
+            for index, (sender, arrived, departed) in enumerate(hops):
+                if index < first or departed is None:
+                    continue
+                self._add(self.nodes, sender, departed - arrived)
+                if index + 1 < len(hops):
+                    receiver, received = hops[index + 1][0], hops[index + 1][1]
+                else:
+                    receiver, received = host, (now - origin_time) * 1000
+                self._add(self.links, (sender, receiver), received - departed)
+
+    def to_dict(self):
+        """
+        Latency map, slowest first.
+        :return: dict {'traces': count, 'nodes': [...], 'links': [...]} with count, mean_ms, max_ms and last_ms
+        """
+        def summary(stats):
+            count, total, largest, last = stats
+            return {'count': count, 'mean_ms': total / count, 'max_ms': largest, 'last_ms': last}
+
+        with self.lock:
+            nodes = [dict(summary(stats), host=host) for host, stats in self.nodes.iteritems()]
+            links = [dict(summary(stats), sender=sender, receiver=receiver)
+                     for (sender, receiver), stats in self.links.iteritems()]
+            traces = self.traces
+        nodes.sort(key=lambda entry: entry['mean_ms'], reverse=True)
+        links.sort(key=lambda entry: entry['mean_ms'], reverse=True)
+        return {'traces': traces, 'nodes': nodes, 'links': links}
+
+    def clear(self):
+        with self.lock:
+            self.traces = 0
+            self.nodes = {}
+            self.links = {}
@@ -0,0 +1,117 @@
+import logging
+import socket
+from collections import deque
+
+import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.locks
+
+import codec
+
+# Curl client keeps connections alive between frames. Simple client is used when pycurl is missing.
+try:
+    import pycurl
+    tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+except ImportError:
+    pycurl = None
+
+
+class AsyncTransport(object):
+    """
+    Non-blocking ring transport. Frames are posted as coroutines on the Tornado IOLoop. Frames on the same
+    lane are sent one after another, so ordering is kept per lane, while frames on different lanes can be
+    in flight at the same time. Frames of a lane are not pipelined: receivers pass persistent frames on to
+    clients as they arrive, so a line overtaken by a later clean would be drawn after the board was cleaned.
+    """
+    def __init__(self, io_loop, max_in_flight=4, timeout=0.5):
+        """
+        :param io_loop: tornado.ioloop.IOLoop running the transport
+        :param max_in_flight: int Maximum number of frames on the wire at once across lanes. Each lane has
+        at most one.
+        :param timeout: float Request timeout in seconds
+        """
+        self.io_loop = io_loop
+        self.timeout = timeout
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=max_in_flight)
+        self.in_flight = tornado.locks.Semaphore(max_in_flight)
+        self.lanes = {} # Pending frames per lane
+        self.on_delivered = None # Optional callable run with url after each delivered frame
+        self.packs = None # Optional callable run with url. Frame is sent packed with codec if it returns True.
+        self.on_refused = None # Optional callable run with url if peer did not accept packed frame
+        self.on_posted = None # Optional callable run with url, seconds and whether frame was delivered
+
+    def send(self, url, message, lane, on_error=None, headers=None):
+        """
+        Queue frame for sending. Can be called from any thread.
+        :param url: String Full target url
+        :param message: Json serializable frame
+        :param lane: Hashable ordering key. Frames with same key are delivered in order.
+        :param on_error: Optional callable run on the IOLoop if the frame cannot be delivered
+        :param headers: Optional dict of extra headers
+        :return:
+        """
+        self.io_loop.add_callback(self._enqueue, url, message, lane, on_error, headers)
+
+    def _enqueue(self, url, message, lane, on_error, headers):
+        if lane in self.lanes:
+            self.lanes[lane].append((url, message, on_error, headers))
+        else:
+            self.lanes[lane] = deque([(url, message, on_error, headers)])
+            self.io_loop.spawn_callback(self._drain, lane)
+
+    @tornado.gen.coroutine
+    def _post(self, url, message, headers):
+        """
+        Post frame, packed if the peer reads packed frames. Refused packed frame is sent again as json.
+        :param url: String Full target url
+        :param message: Json serializable frame
+        :param headers: dict of headers
+        :return:
+        """
+        if self.packs is not None and self.packs(url):
+            try:
+                yield self.client.fetch(url, method='POST', body=codec.encode(message),
+                                        headers=dict(headers, **{'Content-Type': codec.CONTENT_TYPE}),
+                                        request_timeout=self.timeout)
+                return
+            except tornado.httpclient.HTTPError as e:
+                if not codec.refused(e.code, e.response.headers if e.response is not None else {}):
+                    raise
+                if self.on_refused is not None:
+                    self.on_refused(url)
+        yield self.client.fetch(url, method='POST', body=tornado.escape.json_encode(message),
+                                headers=headers, request_timeout=self.timeout)
+
+    @tornado.gen.coroutine
+    def _drain(self, lane):
+        """
+        Send frames of one lane in order.
+        :param lane: Lane key
+        :return:
+        """
+        pending = self.lanes[lane]
+        while pending:
+            url, message, on_error, headers = pending.popleft()
+            request_headers = {'Content-Type': 'application/json'}
+            if headers:
+                request_headers.update(headers)
+            yield self.in_flight.acquire()
+            started = self.io_loop.time()
+            try:
+                yield self._post(url, message, request_headers)
+                if self.on_posted is not None:
+                    self.on_posted(url, self.io_loop.time() - started, True)
+                if self.on_delivered is not None:
+                    self.on_delivered(url)
+            except (tornado.httpclient.HTTPError, socket.error, IOError) as e:
+                if self.on_posted is not None:
+                    self.on_posted(url, self.io_loop.time() - started, False)
+                if on_error is not None:
+                    on_error()
+                else:
+                    logging.error("NODE: Cannot connect %s. Unsend message: %s", url, message)
+            finally:
+                self.in_flight.release()
+        del self.lanes[lane]
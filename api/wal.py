@@ -0,0 +1,190 @@
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+
+SEGMENT_PREFIX = "segment-"
+SNAPSHOT_PREFIX = "snapshot-"
+
+
+class WriteAheadLog(object):
+    """
+    Durable storage for MessageLog. Entries are appended to segment files as json lines and fsynced in
+    batches. Every snapshot_interval entries the log is written as a compact snapshot of its columns and
+    the segments covered by it are removed. Attach as MessageLog listener after recover().
+    """
+    def __init__(self, directory, segment_size=10000, fsync_interval=0.05, snapshot_interval=50000):
+        """
+        :param directory: String directory for segments and snapshots
+        :param segment_size: int Entries per segment file
+        :param fsync_interval: float Maximum seconds between fsyncs
+        :param snapshot_interval: int Entries between snapshots
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.log = None # MessageLog being stored
+        self.segment = None # Open segment file
+        self.segment_entries = 0
+        self.since_snapshot = 0
+        self.dirty = False # Written but not fsynced
+        self.last_sync = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def files(self, prefix):
+        """
+        Files with prefix sorted by the sequence number in their name.
+        :param prefix: String file name prefix
+        :return: list of (sequence number, path)
+        """
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and not name.endswith(".tmp"):
+                found.append((int(name[len(prefix):].split(".")[0]), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def recover(self, log):
+        """
+        Load latest snapshot and the segments after it to the log.
+        :param log: MessageLog to fill
+        :return: int sequence number of the last recovered entry
+        """
+        self.log = log
+        snapshots = self.files(SNAPSHOT_PREFIX)
+        if snapshots:
+            self.read_snapshot(snapshots[-1][1])
+        for _, path in self.files(SEGMENT_PREFIX):
+            self.read_segment(path)
+        logging.info("WAL: Recovered %d entries from %s", len(log), self.directory)
+        return log.last_id()
+
+    def read_snapshot(self, path):
+        with open(path, "rb") as snapshot:
+            header = json.loads(snapshot.readline())
+            columns = []
+            # Snapshots before polyline columns have one count for all columns
+            counts = header.get('counts') or [header['count']] * len(header['typecodes'])
+            for typecode, count in zip(header['typecodes'], counts):
+                column = array(str(typecode))
+                column.fromfile(snapshot, count)
+                columns.append(column)
+        self.log.restore(header['start'], columns, header['others'])
+
+    def read_segment(self, path):
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as segment:
+            data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                line = data.readline()
+                while line:
+                    try:
+                        message_id, message = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the segment
+                        logging.warning("WAL: Skipping broken entry in %s", path)
+                        break
+                    self.log[message_id] = message
+                    line = data.readline()
+            finally:
+                data.close()
+
+    def on_append(self, message_id, message):
+        """
+        MessageLog listener. Write entry to the current segment.
+        """
+        with self.lock:
+            if self.segment is None or self.segment_entries >= self.segment_size:
+                self.roll(message_id)
+            self.segment.write(json.dumps([message_id, message]) + "\n")
+            self.segment_entries += 1
+            self.since_snapshot += 1
+            self.dirty = True
+            if time.time() - self.last_sync >= self.fsync_interval:
+                self._sync()
+        if self.since_snapshot >= self.snapshot_interval:
+            self.write_snapshot()
+
+    def on_compact(self, start):
+        """
+        MessageLog listener. Entries before start were erased by clean, so replace the segments with a snapshot
+        of the retained log.
+        """
+        self.write_snapshot()
+
+    def on_clear(self):
+        """
+        MessageLog listener. Remove stored entries.
+        """
+        with self.lock:
+            self.close()
+            for _, path in self.files(SEGMENT_PREFIX) + self.files(SNAPSHOT_PREFIX):
+                os.remove(path)
+            self.since_snapshot = 0
+
+    def roll(self, message_id):
+        """
+        Start new segment file.
+        :param message_id: int sequence number of the first entry in the segment
+        :return:
+        """
+        self.close()
+        path = os.path.join(self.directory, "%s%012d.log" % (SEGMENT_PREFIX, message_id))
+        self.segment = open(path, "ab")
+        self.segment_entries = 0
+
+    def sync(self):
+        """
+        Fsync written entries. Called periodically, so entries are durable even if no more arrive.
+        :return:
+        """
+        with self.lock:
+            if self.dirty:
+                self._sync()
+
+    def _sync(self):
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+        self.dirty = False
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.segment is not None:
+            self._sync()
+            self.segment.close()
+            self.segment = None
+
+    def write_snapshot(self):
+        """
+        Write compact snapshot of the log and remove segments it covers.
+        :return:
+        """
+        with self.lock:
+            start, columns, others = self.log.snapshot()
+            last_id = start + len(columns[0]) - 1
+            # Later entries go to a new segment, so all current segments are covered by the snapshot
+            self.close()
+            path = os.path.join(self.directory, "%s%012d.snap" % (SNAPSHOT_PREFIX, last_id))
+            header = {'start': start, 'count': len(columns[0]), 'others': others,
+                      'typecodes': [column.typecode for column in columns],
+                      'counts': [len(column) for column in columns]}
+            with open(path + ".tmp", "wb") as snapshot:
+                snapshot.write(json.dumps(header) + "\n")
+                for column in columns:
+                    column.tofile(snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(path + ".tmp", path)
+            for _, old in self.files(SEGMENT_PREFIX):
+                os.remove(old)
+            for _, old in self.files(SNAPSHOT_PREFIX)[:-1]:
+                os.remove(old)
+            self.since_snapshot = 0
+            logging.info("WAL: Snapshot of %d entries written", len(columns[0]))
@@ -0,0 +1,66 @@
+"""
+Wire format benchmark. Encodes and decodes persistent line frames of growing batch size as json and packed
+with codec, and reports size and time per frame for each format as json lines.
+
+    python bench/codec.py --batch-sizes 1 8 64 --frames 2000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../api"))
+
+import codec
+
+
+def line_frame(message_id):
+    return {'method': 'persistent', 'message': {'id': message_id, 'message': {
+        'method': 'line', 'message': {'start': {'x': random.randint(0, 1000), 'y': random.randint(0, 1000)},
+                                      'end': {'x': random.randint(0, 1000), 'y': random.randint(0, 1000)}}}}}
+
+
+def build_frame(batch_size, first_id):
+    frames = [line_frame(first_id + offset) for offset in range(batch_size)]
+    if batch_size == 1:
+        return frames[0]
+    return {'method': 'batch', 'messages': frames}
+
+
+def run(batch_size, frames):
+    """
+    Measure one batch size.
+    :return: list of dicts of results
+    """
+    frame = build_frame(batch_size, 100000)
+    formats = (
+        ('json', lambda value: json.dumps(value), json.loads),
+        ('packed', codec.encode, codec.decode),
+    )
+    results = []
+    for name, encode, decode in formats:
+        data = encode(frame)
+        encode_time = timeit.timeit(lambda: encode(frame), number=frames) / frames
+        decode_time = timeit.timeit(lambda: decode(data), number=frames) / frames
+        results.append({
+            'format': name,
+            'batch_size': batch_size,
+            'bytes': len(data),
+            'encode_us': encode_time * 1e6,
+            'decode_us': decode_time * 1e6,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Wire format benchmark.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 64, 512])
+    parser.add_argument('--frames', type=int, default=2000,
+                        help='Frames encoded and decoded per measurement')
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        for result in run(batch_size, args.frames):
+            print(json.dumps(result))
@@ -0,0 +1,124 @@
+"""
+Election benchmark. Runs leader election on simulated in-process rings of growing size and reports
+time-to-leader and message count for each election mode as json lines.
+
+    python bench/election.py --sizes 4 8 16 32 64 --hop-latency 0.002
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../api"))
+
+from node import Node, ELECTION_RING, ELECTION_VIEW
+
+
+class Network(object):
+    """
+    Simulated network. Messages are delivered in order of their arrival time.
+    """
+    def __init__(self, hop_latency):
+        self.hop_latency = hop_latency
+        self.nodes = {}
+        self.events = []
+        self.now = 0.0
+        self.sequence = 0
+        self.messages = 0
+
+    def send(self, target, message):
+        self.messages += 1
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + self.hop_latency, self.sequence, target, message))
+
+    def run(self, done):
+        """
+        Deliver messages until there are none left.
+        :param done: callable returning True when election has finished
+        :return: simulated time when done first returned True, or None
+        """
+        finished = None
+        while self.events:
+            self.now, _, target, message = heapq.heappop(self.events)
+            self.deliver(self.nodes[target], message)
+            if finished is None and done():
+                finished = self.now
+        return finished
+
+    def deliver(self, node, message):
+        method = message['method']
+        if method == 'election' or method == 'elected':
+            node.leader_election(method, message['message'], message.get('host'), message.get('members'))
+        elif method == 'members':
+            node.update_members(message['message'], message.get('origin'), message.get('leader'))
+
+
+class SimulatedNode(Node):
+    """
+    Node that sends ring frames through the simulated network.
+    """
+    def __init__(self, host, network):
+        Node.__init__(self, host)
+        self.network = network
+
+    def send_frames(self, frames, lane='control', trace=None):
+        if self.follower is None:
+            return False
+        for frame in frames:
+            self.network.send(self.follower, frame)
+        return True
+
+
+def build_ring(size, mode, hop_latency):
+    network = Network(hop_latency)
+    nodes = [SimulatedNode("node%d" % index, network) for index in range(size)]
+    members = [[node.host, node.uid] for node in nodes]
+    for index, node in enumerate(nodes):
+        node.set_follower(nodes[(index + 1) % size].host)
+        node.members = [list(member) for member in members]
+        node.election = mode
+        network.nodes[node.host] = node
+    return network, nodes
+
+
+def agreed(nodes):
+    leaders = set(node.leader_host for node in nodes)
+    return len(leaders) == 1 and None not in leaders and all(node.leader is not None for node in nodes)
+
+
+def run(size, mode, hop_latency):
+    """
+    Start election from a random node on a leaderless ring.
+    :return: dict of results
+    """
+    network, nodes = build_ring(size, mode, hop_latency)
+    started = time.time()
+    random.choice(nodes).elect()
+    finished = network.run(lambda: agreed(nodes))
+    return {
+        'mode': mode,
+        'size': size,
+        'messages': network.messages,
+        'time_to_leader': finished,
+        'wall_time': time.time() - started,
+        'agreed': agreed(nodes),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Leader election benchmark.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128])
+    parser.add_argument('--hop-latency', type=float, default=0.002,
+                        help='Simulated seconds per ring hop')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    for size in args.sizes:
+        for mode in (ELECTION_RING, ELECTION_VIEW):
+            for _ in range(args.repeat):
+                print(json.dumps(run(size, mode, args.hop_latency)))
@@ -0,0 +1,344 @@
+"""
+Ring benchmark. Launches nodes of api/dp.py on localhost ports, joins them into a ring and drives synthetic
+websocket clients drawing lines at a given rate. Reports stroke commit latency at the origin node, visibility
+latency at the node seeing the stroke last, ring frames per stroke, join catch-up time per board size and
+repair time after a node is killed, as json lines.
+
+    python bench/ring.py --nodes 4 --clients 8 --rate 10 --duration 10 --board-sizes 1000 5000 -- --batch-size 8
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+
+DP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../api/dp.py")
+# Log line written for every ring frame a node receives
+FRAME_LOG = "API: Received message"
+
+
+def percentiles(values):
+    """
+    Summary of latencies.
+    :param values: list of float seconds
+    :return: dict of nearest-rank percentiles and maximum, None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    summary = {}
+    for percentile in (50, 90, 99):
+        index = max(0, int(round(percentile / 100.0 * len(values))) - 1)
+        summary['p%d' % percentile] = values[index]
+    summary['max'] = values[-1]
+    return summary
+
+
+class Cluster(object):
+    """
+    Node processes on consecutive localhost ports. Node i serves the ring api on base_port + 2 * i and
+    websocket on the port after it.
+    """
+    def __init__(self, base_port, log_dir, node_args):
+        self.base_port = base_port
+        self.log_dir = log_dir
+        self.node_args = node_args
+        self.processes = {} # Popen by node index
+
+    def rest_port(self, index):
+        return self.base_port + 2 * index
+
+    def address(self, index):
+        return 'http://127.0.0.1:%d' % self.rest_port(index)
+
+    def socket_url(self, index):
+        return 'ws://127.0.0.1:%d/vectorsocket' % (self.rest_port(index) + 1)
+
+    def log_path(self, index):
+        return os.path.join(self.log_dir, 'node%d.log' % index)
+
+    def start(self, index):
+        port = self.rest_port(index)
+        # Own process group, so nodes forking worker processes are stopped as a whole
+        self.processes[index] = subprocess.Popen(
+            [sys.executable, DP, '-rp', str(port), '-sp', str(port + 1), '--host', '127.0.0.1'] + self.node_args,
+            stdout=open(self.log_path(index), 'a'), stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def kill(self, index):
+        process = self.processes.pop(index)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.wait()
+
+    def stop(self):
+        for index in list(self.processes):
+            self.kill(index)
+
+    def frames_received(self):
+        """
+        Ring frames received by all nodes so far, counted from their logs.
+        :return: int
+        """
+        total = 0
+        for name in os.listdir(self.log_dir):
+            with open(os.path.join(self.log_dir, name)) as log:
+                total += sum(1 for line in log if FRAME_LOG in line)
+        return total
+
+
+class Client(object):
+    """
+    Websocket client of one node. Records when each benchmark stroke was first seen.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.connection = None
+        self.seen = {} # Receive time by stroke key
+        self.lines = 0 # Lines received since the last clean
+
+    @tornado.gen.coroutine
+    def connect(self, url):
+        self.connection = yield tornado.websocket.websocket_connect(url)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read)
+
+    @tornado.gen.coroutine
+    def read(self):
+        while True:
+            frame = yield self.connection.read_message()
+            if frame is None:
+                return
+            now = time.time()
+            message = json.loads(frame)
+            messages = message.get('messages', []) if message.get('method') == 'batch' else [message]
+            for message in messages:
+                if message.get('method') == 'line':
+                    self.lines += 1
+                    start = message['message']['start']
+                    self.seen.setdefault((start['x'], start['y']), now)
+                elif message.get('method') == 'clean':
+                    self.lines = 0
+
+    def send(self, message):
+        self.connection.write_message(json.dumps(message))
+
+    def draw(self, key):
+        """
+        Send line identified by key (x, y) of its start.
+        :return: float send time
+        """
+        self.send({'method': 'line', 'message': {'start': {'x': key[0], 'y': key[1]},
+                                                 'end': {'x': key[0] + 1, 'y': key[1] + 1}}})
+        return time.time()
+
+
+@tornado.gen.coroutine
+def wait_for(condition, timeout, interval=0.01):
+    """
+    Wait until condition returns True.
+    :return: float time when it did, None on timeout
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            raise tornado.gen.Return(time.time())
+        yield tornado.gen.sleep(interval)
+    raise tornado.gen.Return(None)
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.cluster = Cluster(args.base_port, args.log_dir, args.node_args)
+        self.observers = {} # Non-drawing client per node index
+        self.sequence = 0
+
+    def next_key(self, client_id):
+        self.sequence += 1
+        return (client_id, self.sequence)
+
+    @tornado.gen.coroutine
+    def join(self, index):
+        """
+        Start node and join it to the ring through node 0. Node connects on command of its websocket client,
+        which posts to /api/connection/ of node 0.
+        """
+        self.cluster.start(index)
+        observer = Client('observer%d' % index)
+        yield tornado.gen.sleep(self.args.startup)
+        yield observer.connect(self.cluster.socket_url(index))
+        self.observers[index] = observer
+        if index > 0:
+            observer.send({'method': 'connect', 'message': self.cluster.address(0)})
+        raise tornado.gen.Return(observer)
+
+    @tornado.gen.coroutine
+    def draw_phase(self):
+        clients = []
+        for client_id in range(self.args.clients):
+            client = Client('client%d' % client_id)
+            yield client.connect(self.cluster.socket_url(client_id % self.args.nodes))
+            clients.append(client)
+        frames_before = self.cluster.frames_received()
+        sent = {} # (send time, origin node) by stroke key
+        interval = 1.0 / self.args.rate
+        started = time.time()
+        tick = 0
+        while time.time() - started < self.args.duration:
+            for client_id, client in enumerate(clients):
+                key = self.next_key(client_id)
+                sent[key] = (client.draw(key), client_id % self.args.nodes)
+            tick += 1
+            yield tornado.gen.sleep(max(0, started + tick * interval - time.time()))
+        observers = self.observers.values()
+        yield wait_for(lambda: all(key in observer.seen for key in sent for observer in observers),
+                       self.args.drain)
+        # Frames of the last strokes may still be on their way around the ring
+        yield tornado.gen.sleep(self.args.settle)
+        commit = []
+        visibility = []
+        for key, (sent_at, origin) in sent.iteritems():
+            if key in self.observers[origin].seen:
+                commit.append(self.observers[origin].seen[key] - sent_at)
+            if all(key in observer.seen for observer in observers):
+                visibility.append(max(observer.seen[key] for observer in observers) - sent_at)
+        for client in clients:
+            client.connection.close()
+        raise tornado.gen.Return({
+            'phase': 'draw',
+            'nodes': self.args.nodes,
+            'clients': self.args.clients,
+            'rate': self.args.rate,
+            'strokes': len(sent),
+            'committed': len(commit),
+            'visible_everywhere': len(visibility),
+            'commit_latency': percentiles(commit),
+            'visibility_latency': percentiles(visibility),
+            'ring_frames_per_stroke': (self.cluster.frames_received() - frames_before) / float(max(len(sent), 1)),
+        })
+
+    @tornado.gen.coroutine
+    def fill(self, board_size):
+        """
+        Draw from node 0 until its board has board_size lines. At most fill_window lines are in flight, so the
+        node queue is not overrun. Lines not seen in a second are taken as rejected.
+        """
+        observer = self.observers[0]
+        pending = deque() # (stroke key, send time)
+        while observer.lines < board_size:
+            while pending and (pending[0][0] in observer.seen or time.time() - pending[0][1] > 1.0):
+                pending.popleft()
+            while len(pending) < self.args.fill_window and observer.lines + len(pending) < board_size:
+                key = self.next_key(-1)
+                pending.append((key, observer.draw(key)))
+            yield tornado.gen.sleep(0.005)
+        raise tornado.gen.Return(observer.lines)
+
+    @tornado.gen.coroutine
+    def catch_up_phase(self, board_size, index):
+        board = yield self.fill(board_size)
+        joiner = yield self.join(index)
+        # Startup time of the process is not part of catch-up
+        started = time.time()
+        finished = yield wait_for(lambda: joiner.lines >= board, self.args.drain)
+        joiner.send({'method': 'disconnect', 'message': None})
+        yield tornado.gen.sleep(self.args.settle)
+        del self.observers[index]
+        joiner.connection.close()
+        self.cluster.kill(index)
+        raise tornado.gen.Return({
+            'phase': 'catch_up',
+            'board_size': board,
+            'seconds': finished - started if finished is not None else None,
+        })
+
+    @tornado.gen.coroutine
+    def repair_phase(self):
+        victim = self.args.nodes - 1
+        del self.observers[victim]
+        survivors = self.observers.values()
+        probes = []
+        killed = time.time()
+        self.cluster.kill(victim)
+
+        def repaired():
+            return any(all(key in observer.seen for observer in survivors) for key in probes)
+
+        finished = None
+        while finished is None and time.time() - killed < self.args.repair_timeout:
+            probes.append(self.next_key(-2))
+            self.observers[0].draw(probes[-1])
+            finished = yield wait_for(repaired, self.args.probe_interval)
+        raise tornado.gen.Return({
+            'phase': 'repair',
+            'nodes': self.args.nodes,
+            'seconds': finished - killed if finished is not None else None,
+        })
+
+    @tornado.gen.coroutine
+    def run(self):
+        for index in range(self.args.nodes):
+            yield self.join(index)
+            yield tornado.gen.sleep(self.args.settle)
+        print(json.dumps((yield self.draw_phase())))
+        sys.stdout.flush()
+        for board_size in sorted(self.args.board_sizes):
+            print(json.dumps((yield self.catch_up_phase(board_size, self.args.nodes))))
+            sys.stdout.flush()
+        if self.args.nodes >= 3:
+            print(json.dumps((yield self.repair_phase())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ring benchmark.')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=4,
+                        help='Drawing websocket clients, spread over the nodes')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='Lines per second per client')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of drawing')
+    parser.add_argument('--board-sizes', type=int, nargs='*', default=[1000],
+                        help='Board sizes in lines at which a new node joins and catches up')
+    parser.add_argument('--fill-window', type=int, default=8,
+                        help='Lines in flight while the board is grown for catch-up')
+    parser.add_argument('--base-port', type=int, default=6000)
+    parser.add_argument('--log-dir', default=None,
+                        help='Directory for node logs. Temporary directory if not set')
+    parser.add_argument('--startup', type=float, default=1.5,
+                        help='Seconds to wait for a node process to start')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds to wait after joins and at the end of phases')
+    parser.add_argument('--drain', type=float, default=30,
+                        help='Seconds to wait for strokes to arrive at every node')
+    parser.add_argument('--repair-timeout', type=float, default=30)
+    parser.add_argument('--probe-interval', type=float, default=0.05,
+                        help='Seconds between strokes sent to detect ring repair')
+    parser.add_argument('node_args', nargs=argparse.REMAINDER,
+                        help='Arguments after -- are passed to every node')
+    args = parser.parse_args()
+    if args.node_args and args.node_args[0] == '--':
+        args.node_args = args.node_args[1:]
+    if args.log_dir is None:
+        args.log_dir = tempfile.mkdtemp(prefix='ring-bench-')
+    elif not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    logging.basicConfig(level=logging.WARNING)
+    # Stop nodes also when the benchmark is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    benchmark = Benchmark(args)
+    try:
+        tornado.ioloop.IOLoop.current().run_sync(benchmark.run)
+    finally:
+        benchmark.cluster.stop()
@@ -0,0 +1,77 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../api"))
+
+from detector import PhiAccrualDetector
+
+# Defaults of dp.py
+HEARTBEAT_INTERVAL = 0.25
+PHI_THRESHOLD = 8
+
+
+class PhiAccrualDetectorTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        self.detector = PhiAccrualDetector(first_interval=HEARTBEAT_INTERVAL)
+
+    def arrivals(self, now, seconds):
+        """
+        Heartbeats every one to two ticks with bursts of ring frames 5 ms apart in between.
+        :return: generator of arrival times
+        """
+        end = now + seconds
+        while now < end:
+            now += random.choice((1, 2)) * HEARTBEAT_INTERVAL + random.uniform(0, 0.02)
+            yield now
+            if random.random() < 0.5:
+                for _ in range(random.randint(5, 50)):
+                    now += 0.005
+                    yield now
+
+    def receive(self, now, seconds):
+        """
+        Record arrivals for seconds.
+        :return: float time of the last arrival
+        """
+        for now in self.arrivals(now, seconds):
+            self.detector.heartbeat(now)
+        return now
+
+    def test_silence_after_burst_is_not_suspected(self):
+        now = self.receive(0.0, 30)
+        for _ in range(50):
+            now += 0.005
+            self.detector.heartbeat(now)
+        self.assertLess(self.detector.phi(now + 0.27), 1)
+        self.assertLess(self.detector.phi(now + 2 * HEARTBEAT_INTERVAL + 0.05), PHI_THRESHOLD)
+
+    def test_steady_heartbeats_are_not_suspected(self):
+        now = 0.0
+        for _ in range(100):
+            now += HEARTBEAT_INTERVAL
+            self.detector.heartbeat(now)
+        self.assertLess(self.detector.phi(now + 0.6), PHI_THRESHOLD)
+
+    def test_traffic_stays_below_threshold(self):
+        for now in self.arrivals(0.0, 120):
+            # Phi just before every arrival is the highest it gets during the gap
+            self.assertLess(self.detector.phi(now - 0.0001), PHI_THRESHOLD)
+            self.detector.heartbeat(now)
+
+    def test_stopped_heartbeats_are_suspected_within_a_second(self):
+        now = 0.0
+        for _ in range(100):
+            now += HEARTBEAT_INTERVAL
+            self.detector.heartbeat(now)
+        self.assertGreater(self.detector.phi(now + 0.95), PHI_THRESHOLD)
+
+    def test_dead_predecessor_is_suspected(self):
+        now = self.receive(0.0, 30)
+        self.assertGreater(self.detector.phi(now + 2.0), PHI_THRESHOLD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../api"))
+
+from messagelog import MessageLog
+
+LINE = {'method': 'line', 'message': {'start': {'x': 1, 'y': 2}, 'end': {'x': 3, 'y': 4}}}
+CLEAN = {'method': 'clean', 'message': {'x': 500, 'y': 500}}
+
+
+class MessageLogGapTest(unittest.TestCase):
+    def setUp(self):
+        self.log = MessageLog()
+        self.log.max_gap = 100
+        self.log.append(LINE)
+
+    def test_small_gap_is_left_as_holes(self):
+        self.log[50] = LINE
+        self.assertEqual(len(self.log), 50)
+        self.assertEqual(self.log.contiguous_id(), 1)
+        self.assertEqual(self.log[50], LINE)
+
+    def test_far_message_is_refused(self):
+        self.log[10 ** 9] = LINE
+        self.assertEqual(len(self.log), 1)
+        self.assertEqual(self.log.last_id(), 1)
+
+    def test_far_clean_compacts_without_holes(self):
+        self.log[10 ** 9] = CLEAN
+        self.assertEqual(self.log.start, 10 ** 9)
+        self.assertEqual(len(self.log), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../api"))
+
+import tracing
+from tracing import LatencyMap
+
+
+class LatencyMapTest(unittest.TestCase):
+    def setUp(self):
+        self.maps = dict((host, LatencyMap()) for host in "ABC")
+
+    def lap(self, trace, hosts, now):
+        """
+        Pass trace around hosts. Every host records it, stays 1 ms and sends it on after 2 ms link.
+        :return: (list trace, float time)
+        """
+        for host in hosts:
+            now += 0.002
+            self.maps[host].record(trace, host, now)
+            trace = tracing.depart(tracing.arrive(trace, host, now), now + 0.001)
+            now += 0.001
+        return trace, now
+
+    def counts(self, host):
+        latency = self.maps[host].to_dict()
+        return (latency['traces'], sum(entry['count'] for entry in latency['nodes']),
+                sum(entry['count'] for entry in latency['links']))
+
+    def test_every_hop_is_recorded_once(self):
+        # A starts, propagate goes to leader C and persistent lap goes back to C
+        trace = tracing.depart(tracing.start("A", 100.0), 100.001)
+        trace, now = self.lap(trace, "BC", 100.001)
+        self.lap(trace, "ABC", now)
+        # Hops up to the last arrival at each host: A B C A B C
+        self.assertEqual(self.counts("A"), (1, 3, 3))
+        self.assertEqual(self.counts("B"), (1, 4, 4))
+        self.assertEqual(self.counts("C"), (1, 5, 5))
+        links = dict(((entry['sender'], entry['receiver']), entry['count'])
+                     for entry in self.maps["C"].to_dict()['links'])
+        self.assertEqual(links, {("A", "B"): 2, ("B", "C"): 2, ("C", "A"): 1})
+
+    def test_malformed_trace_is_refused(self):
+        self.assertRaises(ValueError, self.maps["A"].record, [100.0], "A", 100.0)
+        self.assertRaises(ValueError, self.maps["A"].record, [100.0, 5], "A", 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,68 @@
-// Mouse movement
-var startX, startY, endX, endY
+// Freehand strokes. Points are collected and sent once per animation frame, node simplifies the stroke
+// and propagates it as one polyline when it ends.
+var stroke = {
+    id: 0,
+    drawing: false,
+    last: null, // Last point drawn locally
+    points: [], // Points not sent yet
+    scheduled: false,
+
+    start: function(point) {
+        stroke.id += 1
+        stroke.drawing = true
+        stroke.last = point
+        stroke.points = [[point.x, point.y]]
+        stroke.schedule()
+    },
+
+    move: function(point) {
+        if (!stroke.drawing) {
+            return
+        }
+        newLine(stroke.last, point)
+        stroke.last = point
+        stroke.points.push([point.x, point.y])
+        stroke.schedule()
+    },
+
+    end: function(point) {
+        if (!stroke.drawing) {
+            return
+        }
+        stroke.move(point)
+        stroke.drawing = false
+        stroke.send(true)
+    },
+
+    schedule: function() {
+        if (!stroke.scheduled) {
+            stroke.scheduled = true
+            window.requestAnimationFrame(function() {
+                stroke.scheduled = false
+                if (stroke.drawing && stroke.points.length > 0) {
+                    stroke.send(false)
+                }
+            })
+        }
+    },
+
+    send: function(end) {
+        newMessage('polyline', {'stroke': stroke.id, 'points': stroke.points, 'end': end})
+        stroke.points = []
+    }
+}
+
+function canvasPoint(canvas, e) {
+    return {'x': e.pageX - canvas.offsetLeft, 'y': e.pageY - canvas.offsetTop}
+}
 $('#whiteboard').mousedown(function(e){
-  startX = e.pageX - this.offsetLeft;
-  startY = e.pageY - this.offsetTop;
+  stroke.start(canvasPoint(this, e))
 });
-$('#whiteboard').mouseup(function(e){
-  endX = e.pageX - this.offsetLeft;
-  endY = e.pageY - this.offsetTop;
-  newMessage('line', {'start':{'x':startX, 'y':startY},'end':{'x':endX, 'y':endY}})
+$('#whiteboard').mousemove(function(e){
+  stroke.move(canvasPoint(this, e))
+});
+$('#whiteboard').on('mouseup mouseleave', function(e){
+  stroke.end(canvasPoint(this, e))
 });
 
 // Send message through socket
@@ -19,6 +74,8 @@ function newMessage(method, message) {
 // Socket initialization
 var messenger = {
     socket: null,
+    // Frames are handled in order, also when some of them are inflated asynchronously
+    pending: null,
 
     start: function() {
         var url = ""
@@ -28,9 +85,45 @@ var messenger = {
           url = "ws://" + location.host + "/vectorsocket";
           
         }
+        // Lines and cleans are sent packed. Other large frames are sent deflated once for all clients, if
+        // browser can inflate them
+        url += "?binary=1"
+        // Strokes outside the board are not needed
+        var board = $('#whiteboard')
+        url += "&viewport=0,0," + board.width() + "," + board.height()
+        // Messages up to tile version are painted from tiles
+        if (tileInfo) {
+            url += "&since=" + tileInfo.version
+        }
+        var deflate = typeof DecompressionStream !== "undefined"
+        if (deflate) {
+            url += "&deflate=1"
+        }
+        messenger.pending = Promise.resolve()
         messenger.socket = new WebSocket(url)
+        messenger.socket.binaryType = "arraybuffer"
         messenger.socket.onmessage = function(event) {
-            messenger.handleMessage(JSON.parse(event.data));
+            var data = event.data
+            if (typeof data !== "string" && new Uint8Array(data)[0] == packed.MAGIC) {
+                data = packed.decode(data)
+            }
+            if (!deflate) {
+                messenger.handleMessage(typeof data === "string" ? JSON.parse(data) : data)
+                return
+            }
+            messenger.pending = messenger.pending.then(function() {
+                if (data instanceof ArrayBuffer) {
+                    return inflate(data).then(JSON.parse)
+                }
+                return typeof data === "string" ? JSON.parse(data) : data
+            }).then(messenger.handleMessage)
+        }
+        messenger.socket.onclose = function(event) {
+            // Node disconnects clients that fall too far behind. Reconnect and get the board again.
+            if (event.code == 1008) {
+                $("#messages").append("<p>Fell behind the node, reconnecting")
+                setTimeout(messenger.start, 1000)
+            }
         }
     },
 
@@ -51,16 +144,170 @@ var messenger = {
                 end = {'x': message.message.end.x, 'y': message.message.end.y}
                 newLine(start, end)
                 break
+            case "polyline":
+                newPolyline(message.message.points)
+                break
             case "clean":
                 clearScreen(message.message.x, message.message.y)
                 break
+            case "batch":
+                message.messages.forEach(messenger.handleMessage)
+                break
+            case "error":
+                $("#messages").append("<p>Error: " + message.message)
+                break
+        }
+    }
+}
+
+// Packed frames, see api/codec.py
+var packed = {
+    MAGIC: 0x56,
+    VERSION: 1,
+    FLAG_BATCH: 1,
+    FLAG_TREE: 2,
+    RECORD_JSON: 0,
+    RECORD_LINE: 1,
+    RECORD_CLEAN: 2,
+    RECORD_LINE_WIDE: 3,
+    RECORD_CLEAN_WIDE: 4,
+    RECORD_POLYLINE: 5,
+    RECORD_POLYLINE_WIDE: 6,
+    RECORD_KIND_MASK: 7,
+    WRAP_PROPAGATE: 8,
+    WRAP_PERSISTENT: 16,
+
+    decode: function(buffer) {
+        var reader = {view: new DataView(buffer), offset: 3}
+        if (reader.view.getUint8(1) != packed.VERSION) {
+            throw new Error("Unknown packed frame version")
+        }
+        var flags = reader.view.getUint8(2)
+        var tree = null
+        if (flags & packed.FLAG_TREE) {
+            tree = JSON.parse(packed.string(reader))
+        }
+        var frame
+        if (flags & packed.FLAG_BATCH) {
+            var count = packed.varint(reader)
+            var messages = []
+            for (var i = 0; i < count; i++) {
+                messages.push(packed.record(reader))
+            }
+            frame = {"method": "batch", "messages": messages}
+        } else {
+            frame = packed.record(reader)
         }
+        if (tree !== null) {
+            frame.tree = tree
+        }
+        return frame
+    },
+
+    record: function(reader) {
+        var header = reader.view.getUint8(reader.offset++)
+        var kind = header & packed.RECORD_KIND_MASK
+        if (kind == packed.RECORD_JSON) {
+            return JSON.parse(packed.string(reader))
+        }
+        var id = null, origin = null
+        if (header & packed.WRAP_PERSISTENT) {
+            id = packed.varint(reader)
+        } else if (header & packed.WRAP_PROPAGATE) {
+            origin = packed.string(reader) || null
+        }
+        var wide = kind == packed.RECORD_LINE_WIDE || kind == packed.RECORD_CLEAN_WIDE ||
+                   kind == packed.RECORD_POLYLINE_WIDE
+        var polyline = kind == packed.RECORD_POLYLINE || kind == packed.RECORD_POLYLINE_WIDE
+        var count = kind == packed.RECORD_LINE || kind == packed.RECORD_LINE_WIDE ? 4 : 2
+        if (polyline) {
+            count = packed.varint(reader) * 2
+        }
+        var values = []
+        for (var i = 0; i < count; i++) {
+            if (wide) {
+                values.push(reader.view.getFloat64(reader.offset, true))
+                reader.offset += 8
+            } else {
+                values.push(reader.view.getFloat32(reader.offset, true))
+                reader.offset += 4
+            }
+        }
+        var message
+        if (polyline) {
+            var points = []
+            for (var i = 0; i < count; i += 2) {
+                points.push([values[i], values[i + 1]])
+            }
+            message = {"method": "polyline", "message": {"points": points}}
+        } else if (count == 4) {
+            message = {"method": "line", "message": {"start": {"x": values[0], "y": values[1]},
+                                                     "end": {"x": values[2], "y": values[3]}}}
+        } else {
+            message = {"method": "clean", "message": {"x": values[0], "y": values[1]}}
+        }
+        if (header & packed.WRAP_PERSISTENT) {
+            return {"method": "persistent", "message": {"id": id, "message": message}}
+        }
+        if (header & packed.WRAP_PROPAGATE) {
+            return {"method": "propagate", "message": message, "origin": origin}
+        }
+        return message
+    },
+
+    varint: function(reader) {
+        var value = 0, shift = 0, byte
+        do {
+            byte = reader.view.getUint8(reader.offset++)
+            value += (byte & 0x7f) * Math.pow(2, shift)
+            shift += 7
+        } while (byte & 0x80)
+        return value
+    },
+
+    string: function(reader) {
+        var length = packed.varint(reader)
+        var bytes = new Uint8Array(reader.view.buffer, reader.offset, length)
+        reader.offset += length
+        return new TextDecoder("utf-8").decode(bytes)
+    }
+}
+
+// Inflate raw deflate frame to text
+function inflate(buffer) {
+    var stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("deflate-raw"))
+    return new Response(stream).text()
+}
+
+// Board tiles, painted before the websocket sends messages newer than the tile version
+var tiles = {
+    generation: 0, // Increased on clean, so tiles loaded from before it are not painted
+
+    paint: function(info) {
+        var canvas = $('#whiteboard')
+        for (var x = 0; x * info.size < canvas.width(); x++) {
+            for (var y = 0; y * info.size < canvas.height(); y++) {
+                tiles.load(canvas[0].getContext('2d'), x, y, info)
+            }
+        }
+    },
+
+    load: function(context, x, y, info) {
+        var generation = tiles.generation
+        var image = new Image()
+        image.onload = function() {
+            if (generation == tiles.generation) {
+                context.drawImage(image, x * info.size, y * info.size)
+            }
+        }
+        image.src = "/tiles/0/" + x + "/" + y + ".png?v=" + info.version
     }
 }
 
 // Clear drawing
 function clearScreen(width, height) {
     console.debug("Cleaning screen")
+    tiles.generation += 1
     var context = $('#whiteboard')[0].getContext('2d');
     var canvas = $('#whiteboard')
     context.clearRect(0, 0, canvas.width(), canvas.height());
@@ -97,8 +344,25 @@ function newLine(start, end) {
       context.stroke();
 }
 
+// draw stroke of [x, y] points
+function newPolyline(points) {
+    if (points.length == 0) {
+        return
+    }
+    var context = $('#whiteboard')[0].getContext('2d');
+    context.beginPath();
+    context.moveTo(points[0][0], points[0][1]);
+    for (var i = 1; i < points.length; i++) {
+        context.lineTo(points[i][0], points[i][1]);
+    }
+    context.stroke();
+}
+
 
 $(function () {
+    if (tileInfo) {
+        tiles.paint(tileInfo)
+    }
     messenger.start();
     $('#connection-button').on('click', function () {
         if ($('#connection-button').html() === "Connect") {